@@ -8,7 +8,8 @@ from raven.contrib.flask import Sentry
 from redis import Redis
 
 from application.core import log_handler
-from application.redis_session import RedisSessionInterface
+from application.redis_session import (
+    RedisSessionInterface, session_serializer)
 
 app = Flask(__name__)
 app.wsgi_app = ProxyFix(app.wsgi_app)
@@ -22,7 +23,8 @@ app.secret_key = app.config['SECRET_KEY']
 app.redis_instance = Redis.from_url(url=app.config['REDIS_URL'])
 print('---- {}'.format(app.redis_instance.connection_pool))
 app.session_interface = RedisSessionInterface(
-    redis=app.redis_instance, prefix='performanceplatform_admin:session:')
+    redis=app.redis_instance, prefix='performanceplatform_admin:session:',
+    serializer=session_serializer(app.config))
 
 # adds uncaught exception handlers to app and submits to sentry
 # this will only send when SENTRY_DSN is defined in config
@@ -43,6 +45,9 @@ import application.controllers.builder.digital_take_up
 import application.controllers.builder.cost_per_transaction
 import application.controllers.upload
 
+from application.files.uploaded import UploadRequest
+app.request_class = UploadRequest
+
 
 @app.after_request
 def add_header(response):
@@ -5,6 +5,195 @@ NO_REPLY_EMAIL = 'performance@performance.service.gov.uk'
 
 ENVIRONMENT = os.getenv('ENVIRONMENT', 'development')
 
+# Send uploaded spreadsheets to backdrop this many records at a time instead
+# of in a single request. None sends the whole file at once.
+UPLOAD_BATCH_SIZE = None
+
+# Post records to backdrop as a gzipped stream, encoding and compressing
+# them as they are sent, rather than building the whole request first.
+UPLOAD_GZIP_STREAM = False
+
+# Seconds a streamed post waits to connect to backdrop, and then for each
+# part of backdrop's answer.
+BACKDROP_CONNECT_TIMEOUT = 5
+BACKDROP_READ_TIMEOUT = 300
+
+# Largest file, in bytes, that can be uploaded to a data set, keyed by
+# "<data-group>/<data-type>". Other data sets use UploadedFile.MAX_FILE_SIZE.
+UPLOAD_MAX_FILE_SIZES = {}
+
+# Uploads larger than this many bytes are spooled to disk instead of being
+# held in memory.
+UPLOAD_SPOOL_SIZE = 512 * 1024
+
+# Directory larger uploads are spooled to, such as a tmpfs. None uses the
+# system's temporary directory.
+UPLOAD_SPOOL_DIR = None
+
+# Time each stage of turning an upload's rows into records, as well as
+# counting the rows through it. This slows parsing down noticeably.
+UPLOAD_TIME_PIPELINE = False
+
+# Handle uploads in a background job, which the browser polls for progress,
+# instead of within the request that posted them.
+UPLOAD_JOBS = False
+
+# How many upload jobs each process works on at once.
+UPLOAD_JOB_WORKERS = 2
+
+# Seconds before a job and its result are removed from redis.
+UPLOAD_JOB_TTL = 24 * 60 * 60
+
+# Seconds a queued job's file, and the bearer token of the data set it is
+# for, are kept in redis. Both are removed once the job finishes, and a job
+# which has not started by then fails.
+UPLOAD_JOB_PENDING_TTL = 60 * 60
+
+# Seconds a running job can go without a heartbeat before its process is
+# taken to have died. The job is then queued again if nothing had been
+# posted, or fails if some of it may have been.
+UPLOAD_JOB_HEARTBEAT_TIMEOUT = 60
+
+# Scan uploads for viruses while they are being parsed, instead of parsing
+# them once the scan has finished. Nothing is posted until the scan is clean.
+UPLOAD_CONCURRENT_VALIDATION = False
+
+# How many scans and parses each process runs at once for the above.
+UPLOAD_VALIDATION_WORKERS = 4
+
+# Remember whether each upload had a virus and what its records were, by a
+# sha256 of the file and the data set it went to, so that uploading the same
+# file again needs neither a scan nor a parse.
+UPLOAD_CACHE = False
+
+# With the cache on, do not send a file to a data set again if it is the same
+# as the last one which was sent there successfully. The upload reports it
+# unchanged. A data set emptied other than by an upload is not noticed, so
+# leave this off where data sets are emptied by hand.
+UPLOAD_SKIP_UNCHANGED = False
+
+# Seconds an upload is remembered for.
+UPLOAD_CACHE_TTL = 7 * 24 * 60 * 60
+
+# Most bytes the cache takes in redis. The oldest uploads are forgotten to
+# make room for new ones.
+UPLOAD_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# Send only the rows of an upload which are new or have changed since the
+# data set last accepted them. Only data sets with auto_ids are sent deltas,
+# as backdrop replaces the record with the same ids as a row it is sent.
+UPLOAD_DELTAS = False
+
+# Seconds the rows a data set last accepted are remembered for, after which
+# its next upload is sent in full.
+UPLOAD_DELTA_TTL = 90 * 24 * 60 * 60
+
+# Check every row of an upload as it is parsed, so that all of the rows
+# which would stop it being parsed are reported at once, instead of the
+# first. Records are still streamed as they are parsed, so batches posted
+# before the first bad row was found stay posted, as they would without
+# the check, and the problems say how many records were uploaded.
+UPLOAD_CHECK_ROWS = False
+
+# How many bad rows are reported, at most, by the above.
+UPLOAD_MAX_ROW_PROBLEMS = 50
+
+# How many uploads sent to the bulk upload endpoint each process checks and
+# posts at once.
+UPLOAD_BULK_WORKERS = 4
+
+# How uploads are checked for viruses when VIRUS_CHECK is on: 'clamdscan'
+# runs the command for each file, 'clamd' sends files to clamd over a pool
+# of open connections as they are uploaded.
+VIRUS_SCANNER = 'clamdscan'
+
+# Where clamd listens, as unix:<path> or tcp:<host>:<port>.
+CLAMD_ADDRESS = 'unix:/var/run/clamav/clamd.ctl'
+
+# Seconds to wait for clamd to connect or reply.
+CLAMD_TIMEOUT = 30
+
+# How many idle connections to clamd each process keeps.
+CLAMD_POOL_SIZE = 4
+
+# Seconds an idle connection is kept, which should be less than clamd's
+# IdleTimeout.
+CLAMD_IDLE_TIMEOUT = 25
+
+# How sessions are stored in redis: 'json' or 'msgpack', which are both
+# smaller and quicker to load than 'pickle'. Sessions stored in any of these
+# are read whichever is chosen, so it can be changed freely, but a session
+# is only stored again in the new format once it changes, as an unchanged
+# session only has its expiry renewed.
+SESSION_SERIALIZER = 'json'
+
+# Sessions larger than this many bytes are compressed with zlib. None never
+# compresses them.
+SESSION_COMPRESS_OVER = 1024
+
+# Sessions which a request did not change are not stored again. Their expiry
+# is moved on at most once in this many seconds instead of on every request.
+SESSION_REFRESH_INTERVAL = 60
+
+# Routes, by endpoint, which never use the session, so it is not read from
+# redis for them. Writing to the session in one of them is an error. The
+# session of any other route is only read once it is first used.
+SESSION_SKIP_ENDPOINTS = ['static', 'status']
+
+# Remember which user signon said a bearer token belongs to, so that a burst
+# of notifications from signon checks each token with it only once. A token
+# revoked in signon is still accepted until it is forgotten.
+SIGNON_TOKEN_CACHE = False
+
+# Seconds a token's user is remembered for.
+SIGNON_TOKEN_CACHE_TTL = 60
+
+# Seconds a token which signon rejected is remembered for.
+SIGNON_INVALID_TOKEN_CACHE_TTL = 10
+
+# Most tokens each process remembers itself. Others are looked up in redis.
+SIGNON_TOKEN_CACHE_SIZE = 1000
+
+# Most connections to stagecraft each process keeps open for reuse.
+STAGECRAFT_POOL_SIZE = 10
+
+# Keep connections to stagecraft open between requests. When off, each
+# request to stagecraft opens a new connection.
+STAGECRAFT_KEEP_ALIVE = True
+
+# Seconds to wait for stagecraft to accept a connection, and to reply.
+STAGECRAFT_CONNECT_TIMEOUT = 5
+STAGECRAFT_READ_TIMEOUT = 60
+
+# Each process logs how many requests it has sent to stagecraft, and how
+# many connections it opened for them, after every this many requests.
+STAGECRAFT_STATS_LOG_INTERVAL = 1000
+
+# Keep stagecraft's module types, organisations and data sets in redis, so
+# that forms which list them need not ask stagecraft each time. Data sets
+# are kept for each user, as stagecraft lists only those they can see, and
+# are forgotten whenever this app creates a data set or data group.
+STAGECRAFT_CACHE = False
+
+# Seconds each of the above is used for before it is fetched again.
+STAGECRAFT_CACHE_TTLS = {
+    'module-types': 60 * 60,
+    'organisations': 60 * 60,
+    'data-sets': 5 * 60,
+}
+
+# Seconds after that for which it is still used, while it is fetched again
+# in the background. The data sets, which are cached for each user's token,
+# are fetched again at once instead, so an expired token is still refused.
+STAGECRAFT_CACHE_STALE_FOR = 60 * 60
+
+# How many background fetches each process runs at once.
+STAGECRAFT_CACHE_WORKERS = 2
+
+# How many requests to stagecraft each process makes at once, when a page
+# needs several which do not depend on each other.
+STAGECRAFT_PREFETCH_WORKERS = 8
+
 ROLES = [
     {
         "role": "dashboard-editor",
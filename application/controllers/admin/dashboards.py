@@ -2,6 +2,7 @@ from application import app
 from application.forms import DashboardCreationForm, ModuleTypes, DataSources
 from application.helpers import (
     base_template_context,
+    prefetch,
     requires_authentication,
     requires_feature,
 )
@@ -11,8 +12,10 @@ from flask import (
 )
 from application.forms import(
     convert_to_dashboard_form,
-    convert_to_module_for_form)
+    convert_to_module_for_form,
+    get_organisation_choices)
 
+from collections import namedtuple
 import cgi
 import json
 import requests
@@ -21,6 +24,25 @@ import functools
 
 DASHBOARD_ROUTE = '/admin/dashboards'
 
+FormSources = namedtuple('FormSources', [
+    'module_types', 'data_sources', 'organisation_choices', 'dashboard'])
+
+
+def fetch_form_sources(admin_client, dashboard_uuid=None):
+    """Fetch everything a dashboard form offers to choose from, and the
+    dashboard to fill it with if one is given, all at the same time"""
+    calls = [
+        (ModuleTypes, admin_client),
+        (DataSources, admin_client, session['oauth_token']['access_token']),
+        (get_organisation_choices, admin_client),
+    ]
+    if dashboard_uuid is not None:
+        calls.append((admin_client.get_dashboard, dashboard_uuid))
+    results = [result.get() for result in prefetch(*calls)]
+    if dashboard_uuid is None:
+        results.append(None)
+    return FormSources(*results)
+
 
 def update_modules_form_and_redirect(func):
     @functools.wraps(func)
@@ -34,19 +56,20 @@ def update_modules_form_and_redirect(func):
                 m.module_type.data = section_type['id']
             return modules
 
-        module_types = ModuleTypes(admin_client)
-        data_sources = DataSources(
-            admin_client, session['oauth_token']['access_token'])
+        sources = fetch_form_sources(admin_client)
+        module_types = sources.module_types
 
         form = DashboardCreationForm(
-            admin_client, module_types, data_sources, request.form)
+            admin_client, module_types, sources.data_sources, request.form,
+            organisation_choices=sources.organisation_choices)
 
         if 'modules_order' in request.form:
             form = reorder_modules(request.form,
                                    form,
                                    admin_client,
                                    module_types,
-                                   data_sources)
+                                   sources.data_sources,
+                                   sources.organisation_choices)
 
         session['pending_dashboard'] = form.data
         if uuid is not None:
@@ -125,23 +148,24 @@ def dashboard_form(admin_client, uuid=None):
     if uuid is not None:
         template_context['uuid'] = uuid
 
-    module_types = ModuleTypes(admin_client)
-    data_sources = DataSources(
-        admin_client, session['oauth_token']['access_token'])
-    if should_use_session(session, uuid):
-        form = DashboardCreationForm(admin_client,
-                                     module_types,
-                                     data_sources,
-                                     data=session['pending_dashboard'])
+    use_session = should_use_session(session, uuid)
+    sources = fetch_form_sources(
+        admin_client, None if use_session else uuid)
+    module_types = sources.module_types
+    data_sources = sources.data_sources
+    if use_session:
+        form = DashboardCreationForm(
+            admin_client, module_types, data_sources,
+            data=session['pending_dashboard'],
+            organisation_choices=sources.organisation_choices)
     elif uuid is None:
-        form = DashboardCreationForm(admin_client,
-                                     module_types,
-                                     data_sources,
-                                     request.form)
+        form = DashboardCreationForm(
+            admin_client, module_types, data_sources, request.form,
+            organisation_choices=sources.organisation_choices)
     else:
-        dashboard_dict = admin_client.get_dashboard(uuid)
         form = convert_to_dashboard_form(
-            dashboard_dict, admin_client, module_types, data_sources)
+            sources.dashboard, admin_client, module_types, data_sources,
+            sources.organisation_choices)
 
     if 'pending_dashboard' in session:
         del session['pending_dashboard']
@@ -222,12 +246,13 @@ def clone_module(admin_client, target_dashboard_uuid=None):
 def dashboard_clone(admin_client):
     template_context = base_template_context()
     template_context['user'] = session['oauth_user']
-    dashboard_dict = admin_client.get_dashboard(request.args.get('uuid'))
+    sources = fetch_form_sources(admin_client, request.args.get('uuid'))
     form = convert_to_dashboard_form(
-        dashboard_dict,
+        sources.dashboard,
         admin_client,
-        ModuleTypes(admin_client),
-        DataSources(admin_client, session['oauth_token']['access_token']))
+        sources.module_types,
+        sources.data_sources,
+        sources.organisation_choices)
     form['title'].data = ''
     form['slug'].data = ''
     form['published'].data = False
@@ -399,6 +424,7 @@ def remove(request_form, session):
     index = get_module_index('remove_module_', request.form)
     if index is not None:
         session['pending_dashboard']['modules'].pop(index)
+        session.modified = True
         return True
 
     return False
@@ -408,7 +434,8 @@ def reorder_modules(request_data,
                     form,
                     admin_client,
                     module_types,
-                    data_sources):
+                    data_sources,
+                    organisation_choices=None):
     form_data = form.data
     new_modules = []
     new_order = request_data.get('modules_order').split(',')
@@ -417,4 +444,5 @@ def reorder_modules(request_data,
             form_data['modules'][int(val) - 1])
     form_data['modules'] = new_modules
     return DashboardCreationForm(
-        admin_client, module_types, data_sources, data=form_data)
+        admin_client, module_types, data_sources, data=form_data,
+        organisation_choices=organisation_choices)
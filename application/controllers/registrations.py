@@ -1,9 +1,9 @@
 from flask import (session, render_template, url_for, flash, redirect)
 import boto.ses
 from application import app
-from performanceplatform.client.admin import AdminAPI
 from application.forms import AboutYouForm, AboutYourServiceForm
 from application.helpers import base_template_context, to_error_list
+from application.stagecraft import stagecraft_client
 
 REGISTER_ROUTE = '/register'
 
@@ -16,7 +16,7 @@ def start():
 
 @app.route('{0}/about-you'.format(REGISTER_ROUTE), methods=['GET', 'POST'])
 def about_you():
-    admin_client = AdminAPI(app.config['STAGECRAFT_HOST'], None)
+    admin_client = stagecraft_client(None)
     form = AboutYouForm(admin_client)
     template_context = base_template_context()
     if form.validate_on_submit():
@@ -4,7 +4,17 @@ from flask.json import jsonify
 from requests.exceptions import HTTPError
 
 from application import app
-from application.files.spreadsheet import Spreadsheet
+from application.files.parsers import ParseError
+from application.files.parsers.records import encode_records
+from application.files.parsers.util import batches
+from application.files.spreadsheet import Spreadsheet, Workbook
+from application.files.streaming import CountedRecords, post_gzip_stream
+from application.files.upload_cache import upload_cache
+from application.files.upload_deltas import row_fingerprints
+from application.files.upload_jobs import UploadJob, UploadWorkers
+from application.files.pools import LazyThreadPool
+from application.files.uploaded import (
+    max_file_size, UploadSpool, VIRUS_FOUND)
 from application.helpers import(
     requires_authentication,
     base_template_context,
@@ -12,6 +22,9 @@ from application.helpers import(
 from performanceplatform.client.data_set import DataSet
 import traceback
 
+_bulk_pool = LazyThreadPool('UPLOAD_BULK_WORKERS', 4)
+upload_workers = UploadWorkers('UPLOAD_JOB_WORKERS', 2)
+
 
 @app.errorhandler(StandardError)
 def internal_error(err):
@@ -74,55 +87,458 @@ def upload_post(data_group, data_type, admin_client):
             'There is no data set of for data-group: {} and data-type: {}'
             .format(data_group, data_type))
 
-    messages, status = upload_file_and_get_status(data_set)
+    if should_queue(request.files['file']):
+        job = UploadJob.create(app.redis_instance, data_set,
+                               request.files['file'])
+        start_upload_workers()
+        upload_workers.wake()
+        if json_request(request):
+            return job_response(job)
+        return redirect(url_for('upload_job_status', data_group=data_group,
+                                data_type=data_type, job_id=job.job_id))
+
+    stages = set()
+    messages, status = upload_file_and_get_status(
+        data_set, lambda stage, rows=None: stages.add(stage))
 
     return response(status, data_group, data_type, messages,
-                    url_for('upload_list_data_sets'))
+                    url_for('upload_list_data_sets'), 'unchanged' in stages)
+
+
+@app.route('/upload-data/<data_group>/<data_type>/jobs/<job_id>',
+           methods=['GET'])
+@requires_authentication
+def upload_job_status(data_group, data_type, job_id, admin_client):
+    job = UploadJob.find(app.redis_instance, job_id)
+    if job is None:
+        abort(404, 'There is no upload job {}'.format(job_id))
+
+    state = job.state()
+    if (state['data_group'], state['data_type']) != (data_group, data_type):
+        abort(404, 'There is no upload job {}'.format(job_id))
+
+    if state['stage'] == UploadJob.FINISHED:
+        return response(state['status_code'], data_group, data_type,
+                        state['payload'], url_for('upload_list_data_sets'),
+                        state['unchanged'])
+
+    return job_response(job, state)
+
+
+@app.route('/upload-data/bulk', methods=['POST'])
+@requires_authentication
+def upload_bulk(admin_client):
+    """Upload several files, or the sheets of a workbook, at once
+
+    Each file is posted with the data set it is for, <data-group>/<data-type>,
+    as its field name. A workbook is posted as `workbook` along with a form
+    field for each data set which names the sheet to upload to it. The
+    uploads are checked and posted side by side, and the result of each is
+    reported as response() would report it on its own.
+    """
+    uploads = bulk_uploads(request.files, request.form)
+    if not uploads:
+        abort(400, 'There are no files to upload')
+
+    pending = [
+        _bulk_pool.apply_async(upload_to_data_set, (
+            admin_client, data_group, data_type, file_data, sheet))
+        for data_group, data_type, file_data, sheet in uploads]
+    try:
+        results = [upload.get() for upload in pending]
+    finally:
+        for _, _, file_data, _ in uploads:
+            if isinstance(file_data, Workbook):
+                file_data.cleanup()
+
+    r = jsonify({'results': results})
+    r.status_code = max(result['status'] for result in results)
+    return r
+
+
+def bulk_uploads(files, form):
+    """Return the data group, data type, file and sheet of each upload
+
+    The sheets of a workbook all share one Workbook, so that it is only
+    scanned and opened once.
+    """
+    uploads = []
+    for field, file_data in files.iteritems(multi=True):
+        data_group, _, data_type = field.partition('/')
+        if data_group and data_type:
+            uploads.append((data_group, data_type, file_data, None))
+
+    workbook = files.get('workbook')
+    if workbook is not None:
+        sheets = []
+        for field, sheet in form.iteritems(multi=True):
+            data_group, _, data_type = field.partition('/')
+            if data_group and data_type:
+                sheets.append((data_group, data_type, sheet))
+
+        workbook = Workbook(workbook, [sheet for _, _, sheet in sheets])
+        uploads.extend((data_group, data_type, workbook, sheet)
+                       for data_group, data_type, sheet in sheets)
+
+    return uploads
+
+
+def upload_to_data_set(admin_client, data_group, data_type, file_data,
+                       sheet=None):
+    """Upload a file, or a sheet of one, and return what became of it"""
+    result = {
+        'data_group': data_group,
+        'data_type': data_type,
+        'filename': file_data.filename,
+    }
+    if sheet is not None:
+        result['sheet'] = sheet
 
+    try:
+        data_set = admin_client.get_data_set(data_group, data_type)
+        if data_set is None:
+            messages, status = [
+                'There is no data set of for data-group: {} and data-type: {}'
+                .format(data_group, data_type)], 404
+        else:
+            problems, our_problem = upload_spreadsheet(
+                data_set, file_data, sheet=sheet)
+            messages, status = get_messages_and_status_for_problems(
+                our_problem, problems)
+    except HTTPError as err:
+        messages, status = ['[{}] {}'.format(err.response.status_code,
+                                             err.response.json())], 500
+    except ParseError as err:
+        messages, status = err.problems(), 400
+    except Exception:
+        app.logger.exception('Bulk upload to {}/{} failed'.format(
+            data_group, data_type))
+        messages, status = ['There has been an error'], 500
+
+    result.update(payload=messages, status=status)
+    return result
+
+
+def should_queue(file_data):
+    """Whether an upload should be handled by a background job
+
+    Uploads with no file, an empty file or one over the size limit are
+    turned away straight away, as they would be without jobs.
+    """
+    stream = file_data.stream
+    return (app.config.get('UPLOAD_JOBS', False) and
+            len(file_data.filename) > 0 and
+            isinstance(stream, UploadSpool) and
+            0 < stream.size < stream.limit)
+
+
+def job_response(job, state=None):
+    if state is None:
+        state = job.state()
+    state['status_url'] = url_for('upload_job_status',
+                                  data_group=state['data_group'],
+                                  data_type=state['data_type'],
+                                  job_id=job.job_id)
+
+    if json_request(request):
+        r = jsonify(state)
+        r.status_code = 202
+        return r
+
+    template_context = base_template_context()
+    template_context.update({
+        'user': session['oauth_user'],
+        'job': state,
+    })
+    return render_template('upload/job.html', **template_context), 202
+
+
+def start_upload_workers():
+    """Start this process's upload job workers, if jobs are on"""
+    if app.config.get('UPLOAD_JOBS', False):
+        upload_workers.start(app.redis_instance, run_upload_job)
+
+app.before_first_request(start_upload_workers)
+
+
+def run_next_upload_job():
+    job = UploadJob.next_queued(app.redis_instance)
+    if job is not None:
+        run_upload_job(job)
+
+
+def run_upload_job(job):
+    stages = set()
+
+    def progress(stage, rows=None):
+        stages.add(stage)
+        job.update(stage, rows)
+
+    data_set = job.data_set()
+    if data_set is None:
+        job.finish(500, ['The upload waited too long to start. Please '
+                         'upload the file again.'])
+        return
 
-def upload_spreadsheet(data_set, file_data):
+    try:
+        problems, our_problem = upload_spreadsheet(
+            data_set, job.file_storage(), progress=progress)
+    except Exception:
+        app.logger.exception('Upload job {} failed'.format(job.job_id))
+        problems, our_problem = ['There has been an error'], True
+
+    messages, status = get_messages_and_status_for_problems(
+        our_problem, problems)
+    job.finish(status, messages, unchanged='unchanged' in stages)
+
+
+def _no_progress(stage, rows=None):
+    pass
+
+
+def upload_spreadsheet(data_set, file_data, progress=_no_progress,
+                       sheet=None):
+    """Check an uploaded spreadsheet and post its records to backdrop
+
+    progress is called with the stage the upload has reached and, while
+    records are being posted, how many rows have been sent. The stage is
+    'unchanged' if the file had already been posted to the data set, or
+    none of its rows had changed, and so nothing was posted. Only the
+    named sheet of a workbook is read, if one is given. file_data can be a
+    Workbook shared with the uploads of its other sheets.
+    """
     problems = []
     our_problem = False
 
     if len(file_data.filename) == 0:
         problems += ["Please choose a file to upload"]
     else:
-        with Spreadsheet(file_data) as spreadsheet:
-            problems += spreadsheet.validate()
+        size_limit = max_file_size(data_set['data_group'],
+                                   data_set['data_type'])
+        if isinstance(file_data, Workbook):
+            spreadsheet = file_data.sheet(sheet, size_limit)
+        else:
+            spreadsheet = Spreadsheet(file_data, size_limit, sheet=sheet)
+        with spreadsheet:
+            progress('validating')
+            problems += spreadsheet.validate_without_scan()
+            if problems:
+                return problems, our_problem
+
+            cache = upload_cache()
+            cached = None
+            if cache is not None:
+                content_hash = spreadsheet.content_hash()
+                cached = cache.find(content_hash, data_set)
+
+            if (cache is not None and
+                    app.config.get('UPLOAD_SKIP_UNCHANGED', False) and
+                    cache.last_posted(data_set) == content_hash):
+                progress('unchanged')
+                return problems, our_problem
+
+            found, records = validate_spreadsheet(spreadsheet, cached)
+            problems += found
 
             if len(problems) == 0:
-                url = '{0}/data/{1}/{2}'.format(app.config['BACKDROP_HOST'],
-                                                data_set['data_group'],
-                                                data_set['data_type'])
-                data_set = DataSet(url, data_set['bearer_token'],
-                                   retry_on_error=False)
-                try:
-                    data_set.post(spreadsheet.as_json())
-                except HTTPError as err:
-                    # only 400 errors are actually user errors, anything else
-                    # is our fault
-                    our_problem = err.response.status_code > 400
-                    if err.response.status_code == 400:
-                        json_error = err.response.json()
-                        if 'messages' in json_error:
-                            problems += json_error['messages']
-                        else:
-                            problems += 'Unknown validation error: {}'.format(
-                                json_error
-                            )
-                    else:
-                        problems += ['[{}] {}'.format(err.response.status_code,
-                                                      err.response.json())]
+                progress('uploading')
+                # Records are parsed here so the cache can keep them, unless
+                # they are streamed in batches
+                if (records is None and cache is not None and
+                        not app.config.get('UPLOAD_BATCH_SIZE')):
+                    records, problems = parse_for_cache(spreadsheet)
+                if not problems:
+                    problems, our_problem = post_spreadsheet(
+                        data_set, spreadsheet, records, progress)
+
+                if cache is not None and len(problems) == 0:
+                    cache.store_posted(content_hash, data_set)
+                elif cache is not None:
+                    cache.forget_posted(data_set)
+
+            if cache is not None and (cached is None or
+                                      len(problems) == 0):
+                cache.store(content_hash, data_set,
+                            is_virus=scan_verdict(found, cached),
+                            records=records if isinstance(records, list)
+                            else None)
 
     return problems, our_problem
 
 
-def response(status_code, data_group, data_type, payload, redirect_url_for):
+def post_spreadsheet(data_set, spreadsheet, records, progress=_no_progress):
+    """Post a spreadsheet's records to backdrop, or those which have changed
+
+    records are parsed from the spreadsheet as they are posted if None. For
+    data sets whose uploads are sent as deltas, rows which are the same as
+    when they were last accepted are left out. Deltas are small, so they
+    are gathered up before posting even when posts are streamed.
+    """
+    url = '{0}/data/{1}/{2}'.format(app.config['BACKDROP_HOST'],
+                                    data_set['data_group'],
+                                    data_set['data_type'])
+    backdrop_data_set = DataSet(url, data_set['bearer_token'],
+                                retry_on_error=False)
+    fingerprints = row_fingerprints(data_set)
+
+    if records is None:
+        records = spreadsheet.iter_json(max_problems=max_row_problems())
+    if fingerprints is not None:
+        records = fingerprints.changed(records)
+
+    batch_size = app.config.get('UPLOAD_BATCH_SIZE')
+    if batch_size:
+        problems, our_problem = post_in_batches(
+            backdrop_data_set, records, batch_size, progress)
+    elif app.config.get('UPLOAD_GZIP_STREAM', False) and fingerprints is None:
+        records = CountedRecords(records)
+        try:
+            problems, our_problem = post_records(backdrop_data_set, records)
+        except ParseError as err:
+            problems, our_problem = err.problems(), False
+        progress('uploading', records.count)
+    else:
+        try:
+            records = list(records)
+        except ParseError as err:
+            records, problems, our_problem = [], err.problems(), False
+        else:
+            if records or fingerprints is None:
+                problems, our_problem = post_records(backdrop_data_set,
+                                                     records)
+            else:
+                problems, our_problem = [], False
+        progress('uploading', len(records))
+
+    if spreadsheet.pipeline is not None:
+        app.logger.info('Rows in {0}: {1}'.format(
+            spreadsheet.filename, spreadsheet.pipeline))
+
+    if fingerprints is not None and not problems:
+        fingerprints.save()
+        app.logger.info('Rows of {0}: {1}'.format(
+            spreadsheet.filename, fingerprints))
+        if fingerprints.sent == 0:
+            progress('unchanged')
+
+    return problems, our_problem
+
+
+def validate_spreadsheet(spreadsheet, cached=None):
+    """Return the problems with a spreadsheet and its records, if parsed
+
+    An upload found in the cache is not scanned again, and its records are
+    not parsed again. Otherwise the records are only parsed here when
+    UPLOAD_CONCURRENT_VALIDATION is on, and are left to be parsed as they
+    are posted.
+    """
+    virus_check = app.config.get('VIRUS_CHECK', False)
+    if cached is not None and (cached.is_virus is not None or
+                               not virus_check):
+        if virus_check and cached.is_virus:
+            return [VIRUS_FOUND], None
+        if cached.records is not None:
+            return [], cached.records
+        return [], None
+
+    if app.config.get('UPLOAD_CONCURRENT_VALIDATION', False):
+        return spreadsheet.validate_and_parse(max_row_problems())
+    return spreadsheet.validate(), None
+
+
+def max_row_problems():
+    """How many bad rows to report, or None to stop at the first"""
+    if app.config.get('UPLOAD_CHECK_ROWS', False):
+        return app.config.get('UPLOAD_MAX_ROW_PROBLEMS', 50)
+    return None
+
+
+def parse_for_cache(spreadsheet):
+    """Return the records of a spreadsheet, for the cache, and problems"""
+    try:
+        return spreadsheet.as_json(max_row_problems()), []
+    except ParseError as err:
+        return None, err.problems()
+
+
+def scan_verdict(problems, cached=None):
+    """Whether validation found a virus, or None if it was not scanned"""
+    if cached is not None and cached.is_virus is not None:
+        return cached.is_virus
+    if not app.config.get('VIRUS_CHECK', False):
+        return None
+    if VIRUS_FOUND in problems:
+        return True
+    if problems:
+        # The scanner failed, or the file was not scanned at all
+        return None
+    return False
+
+
+def post_records(data_set, records):
+    problems = []
+    our_problem = False
+
+    try:
+        if app.config.get('UPLOAD_GZIP_STREAM', False):
+            post_gzip_stream(data_set, records)
+        else:
+            data_set.post(encode_records(records))
+    except HTTPError as err:
+        # only 400 errors are actually user errors, anything else
+        # is our fault
+        our_problem = err.response.status_code > 400
+        if err.response.status_code == 400:
+            json_error = err.response.json()
+            if 'messages' in json_error:
+                problems += json_error['messages']
+            else:
+                problems += ['Unknown validation error: {}'.format(
+                    json_error
+                )]
+        else:
+            problems += ['[{}] {}'.format(err.response.status_code,
+                                          err.response.json())]
+
+    return problems, our_problem
+
+
+def post_in_batches(data_set, records, batch_size, progress=_no_progress):
+    """Stream records to backdrop, batch_size records per request
+
+    Batches already accepted by backdrop stay there if a later batch fails,
+    so problems say which records were rejected and how many went before.
+    """
+    posted = 0
+
+    try:
+        for batch in batches(records, batch_size):
+            problems, our_problem = post_records(data_set, batch)
+            if problems:
+                return ['Records {}-{}: {}'.format(
+                    posted + 1, posted + len(batch), problem)
+                    for problem in problems], our_problem
+            posted += len(batch)
+            progress('uploading', posted)
+    except ParseError as err:
+        problems = err.problems()
+        if posted:
+            problems.append(
+                'The first {} records were uploaded'.format(posted))
+        return problems, False
+
+    return [], False
+
+
+def response(status_code, data_group, data_type, payload, redirect_url_for,
+             unchanged=False):
     data = {
         'data_group': data_group,
         'data_type': data_type,
         'payload': payload
     }
+    if unchanged:
+        data['unchanged'] = True
 
     if json_request(request):
         r = jsonify(data)
@@ -138,8 +554,8 @@ def json_request(request):
     return request.headers.get('Accept', 'text/html') == 'application/json'
 
 
-def upload_file_and_get_status(data_set):
-    problems, our_problem = \
-        upload_spreadsheet(data_set, request.files['file'])
+def upload_file_and_get_status(data_set, progress=_no_progress):
+    problems, our_problem = upload_spreadsheet(
+        data_set, request.files['file'], progress)
 
     return get_messages_and_status_for_problems(our_problem, problems)
@@ -0,0 +1,228 @@
+"""A client for clamd which keeps its connections open between scans
+
+Files are sent with the INSTREAM command inside an IDSESSION, so one
+connection can scan upload after upload without clamd or the app setting up
+a new one each time. See clamd(8) for the protocol.
+"""
+import select
+import socket
+import struct
+import threading
+import time
+
+# clamd refuses chunks bigger than its StreamMaxLength, which is at least this
+CHUNK_SIZE = 64 * 1024
+
+
+class ClamdError(IOError):
+    pass
+
+
+class ClamdConnectionError(ClamdError):
+    """Raised when clamd cannot be reached, or drops the connection"""
+
+
+class ScanCancelled(Exception):
+    """Raised by a scan which was told to stop before it finished"""
+
+
+def parse_address(address):
+    """Return the socket family and address for a clamd address
+
+    >>> parse_address('unix:/var/run/clamav/clamd.ctl')
+    (1, '/var/run/clamav/clamd.ctl')
+    >>> parse_address('tcp:localhost:3310')
+    (2, ('localhost', 3310))
+    """
+    scheme, _, location = address.partition(':')
+    if scheme == 'unix':
+        return socket.AF_UNIX, location
+    if scheme == 'tcp':
+        host, _, port = location.rpartition(':')
+        return socket.AF_INET, (host, int(port))
+    raise ValueError('clamd address must start unix: or tcp:, not {0}'
+                     .format(address))
+
+
+class ClamdConnection(object):
+    """An IDSESSION with clamd, which can run one scan after another"""
+
+    def __init__(self, address, timeout):
+        family, location = parse_address(address)
+        self.socket = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            self.socket.settimeout(timeout)
+            self.socket.connect(location)
+            self.socket.sendall('zIDSESSION\0')
+        except socket.error:
+            self.socket.close()
+            raise
+        self.last_used = time.time()
+        self.replies = ''
+
+    def is_usable(self, idle_timeout):
+        """Whether the connection can be used for another scan
+
+        clamd closes sessions which have been idle for a while, and a closed
+        connection is readable, so anything to read means it is done with.
+        """
+        if time.time() - self.last_used > idle_timeout:
+            return False
+        try:
+            readable, _, _ = select.select([self.socket], [], [], 0)
+        except (select.error, socket.error):
+            return False
+        return not readable
+
+    def start_instream(self):
+        self.socket.sendall('zINSTREAM\0')
+
+    def send_chunk(self, data):
+        for start in xrange(0, len(data), CHUNK_SIZE):
+            chunk = data[start:start + CHUNK_SIZE]
+            self.socket.sendall(struct.pack('!L', len(chunk)) + chunk)
+
+    def end_instream(self):
+        """Finish the stream and return clamd's reply, without its id"""
+        self.socket.sendall(struct.pack('!L', 0))
+        reply = self._read_reply()
+        self.last_used = time.time()
+        return reply.partition(': ')[2] if reply[:1].isdigit() else reply
+
+    def _read_reply(self):
+        while '\0' not in self.replies:
+            data = self.socket.recv(4096)
+            if not data:
+                raise ClamdConnectionError('clamd closed the connection')
+            self.replies += data
+        reply, self.replies = self.replies.split('\0', 1)
+        return reply
+
+    def close(self):
+        try:
+            self.socket.sendall('zEND\0')
+        except socket.error:
+            pass
+        self.socket.close()
+
+
+class InStreamScan(object):
+    """A scan which is sent the file a piece at a time
+
+    Nothing else can use the connection until result() or abort() is
+    called.
+    """
+
+    def __init__(self, scanner, connection):
+        self.scanner = scanner
+        self.connection = connection
+        connection.start_instream()
+
+    def write(self, data):
+        try:
+            self.connection.send_chunk(data)
+        except socket.error as e:
+            self.abort()
+            raise ClamdConnectionError('Could not send to clamd: {0}'.format(
+                e))
+
+    def result(self):
+        """Return True if clamd found a virus and False if it did not"""
+        try:
+            reply = self.connection.end_instream()
+        except socket.error as e:
+            self.abort()
+            raise ClamdConnectionError('Could not read from clamd: {0}'
+                                       .format(e))
+        except ClamdError:
+            self.abort()
+            raise
+
+        if reply.endswith('ERROR'):
+            self.abort()
+            raise ClamdError(reply)
+
+        self.scanner.release(self.connection)
+        self.connection = None
+        if reply.endswith('FOUND'):
+            return True
+        return False
+
+    def abort(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+class ClamdScanner(object):
+    """Scans files with clamd over a pool of open connections
+
+    address is unix:<path> or tcp:<host>:<port>. At most pool_size idle
+    connections are kept, each for no more than idle_timeout seconds, which
+    should be less than clamd's IdleTimeout.
+    """
+
+    def __init__(self, address, timeout=30, pool_size=4, idle_timeout=25):
+        self.address = address
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def start_scan(self):
+        try:
+            return InStreamScan(self, self.connection())
+        except socket.error as e:
+            raise ClamdConnectionError(
+                'Could not connect to clamd at {0}: {1}'.format(
+                    self.address, e))
+
+    def scan(self, stream, cancelled=None):
+        """Return True if clamd finds a virus in the rest of stream
+
+        A pooled connection which clamd has dropped is only found out by
+        using it, so a scan whose connection fails is tried once more from
+        the same place in the stream on a new connection. A scan which clamd
+        answers with an error, such as the stream being too long, is not
+        tried again. If the cancelled event is
+        set the scan stops with ScanCancelled before the next chunk is sent.
+        """
+        position = stream.tell()
+        try:
+            return self._scan(stream, cancelled)
+        except ClamdConnectionError:
+            stream.seek(position)
+            self.clear()
+            return self._scan(stream, cancelled)
+
+    def _scan(self, stream, cancelled):
+        scan = self.start_scan()
+        for chunk in iter(lambda: stream.read(CHUNK_SIZE), ''):
+            if cancelled is not None and cancelled.is_set():
+                scan.abort()
+                raise ScanCancelled()
+            scan.write(chunk)
+        return scan.result()
+
+    def connection(self):
+        with self.lock:
+            while self.idle:
+                connection = self.idle.pop()
+                if connection.is_usable(self.idle_timeout):
+                    return connection
+                connection.close()
+        return ClamdConnection(self.address, self.timeout)
+
+    def release(self, connection):
+        with self.lock:
+            if len(self.idle) < self.pool_size:
+                self.idle.append(connection)
+                return
+        connection.close()
+
+    def clear(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for connection in idle:
+            connection.close()
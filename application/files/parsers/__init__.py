@@ -1,3 +1,17 @@
 
 class ParseError(StandardError):
-    pass
+
+    def problems(self):
+        """Return what to tell whoever uploaded the file"""
+        return [str(self)]
+
+
+class BadRows(ParseError):
+    """Raised once every row has been read, if any were bad"""
+
+    def __init__(self, row_problems):
+        super(BadRows, self).__init__(row_problems[0])
+        self.row_problems = row_problems
+
+    def problems(self):
+        return self.row_problems
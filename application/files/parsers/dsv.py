@@ -2,14 +2,62 @@ from application.files.parsers import ParseError
 
 import csv
 import itertools
+import math
+import re
 
 
-def parse_csv(incoming_data):
+# How many rows after the header are looked at to choose a type per column
+TYPE_SAMPLE_SIZE = 100
+
+ISO_TIMESTAMP = re.compile(
+    r'\d{4}-\d{2}-\d{2}'
+    r'([T ]\d{2}:\d{2}(:\d{2}(\.\d+)?)?(Z|[+-]\d{2}:?\d{2})?)?$')
+
+# Anything int() or float() accept starts like this, so a cell which does
+# not can be left as a string without trying either of them
+NUMBER_PREFIX = re.compile(r'\s*[-+]?(\d|\.\d|inf|nan)',
+                           re.IGNORECASE | re.UNICODE)
+
+
+def parse_csv(incoming_data, strict=True):
+    """Return the rows of a CSV file, with numbers converted
+
+    Unless strict, a row which is not UTF-8 does not stop the parse, and
+    cells which cannot be decoded are left as Undecoded.
+    """
+    return (row for _, row in parse_numbered_csv(incoming_data, strict))
+
+
+def parse_numbered_csv(incoming_data, strict=True):
+    """Return (line number, row) for each row parse_csv would return
+
+    A row is numbered by the line of the file it ends on, counting the
+    comment lines and empty rows which are left out, so a problem with it
+    can be found in the file.
+
+    >>> list(parse_numbered_csv(['# note\\n', 'a\\n', '\\n', '1\\n']))
+    [(2, [u'a']), (4, [1])]
+    """
+    line_number = [0]
+
+    def numbered_lines():
+        for number, line in enumerate(lines(incoming_data), start=1):
+            line_number[0] = number
+            yield line
+
     reader = unicode_csv_reader(
-        ignore_comment_lines(lines(incoming_data)), "utf-8")
-    return parse_cells_as_numbers(
-        ignore_empty_rows(
-            ignore_comment_column(reader)))
+        ignore_comment_lines(numbered_lines()), "utf-8", strict)
+    rows = ((line_number[0], row) for row in reader)
+    rows = _keeping_numbers(ignore_comment_column, rows)
+    rows = itertools.ifilterfalse(lambda (_, row): is_empty_row(row), rows)
+    return _keeping_numbers(parse_cells_as_numbers, rows)
+
+
+def _keeping_numbers(transform, numbered_rows):
+    # transform gives back one row, in order, for each row it is given
+    numbers, rows = itertools.tee(numbered_rows)
+    return itertools.izip((number for number, _ in numbers),
+                          transform(row for _, row in rows))
 
 
 def lines(stream):
@@ -34,7 +82,101 @@ def is_empty_row(row):
 
 
 def parse_cells_as_numbers(rows):
-    return [[parse_as_number(cell) for cell in row] for row in rows]
+    """Convert cells to numbers where they can be, exactly as parse_as_number
+
+    The first row is the header. A sample of the rows after it is used to
+    choose a converter for each column once, so that a column of text does
+    not pay for a failed int() and float() on every cell. Any cell which
+    does not fit its column's converter falls back to parse_as_number.
+    """
+    rows = iter(rows)
+    header = next(rows, None)
+    if header is None:
+        return
+    yield [parse_as_number(cell) for cell in header]
+
+    sample = list(itertools.islice(rows, TYPE_SAMPLE_SIZE))
+    converters = infer_column_converters(sample)
+    column_count = len(converters)
+
+    for row in itertools.chain(sample, rows):
+        if len(row) == column_count:
+            yield [convert(cell) for convert, cell
+                   in itertools.izip(converters, row)]
+        else:
+            yield [parse_as_number(cell) for cell in row]
+
+
+def infer_column_converters(rows):
+    """Return a converter for each column of the given rows
+
+    >>> [c.__name__ for c in infer_column_converters([
+    ...     ['1', '1.5', '2014-08-05T00:00:00Z', 'foo'],
+    ...     ['2', '3', '2014-08-12T00:00:00Z', ''],
+    ... ])]
+    ['_as_int', '_as_float', '_as_timestamp', '_as_string']
+    """
+    columns = {}
+    for row in rows:
+        for index, cell in enumerate(row):
+            columns.setdefault(index, set()).add(_cell_type(cell))
+
+    return [_converter_for(columns.get(index, set()))
+            for index in range(len(columns))]
+
+
+def _cell_type(cell):
+    if not cell:
+        return None
+    if ISO_TIMESTAMP.match(cell):
+        return 'timestamp'
+    value = parse_as_number(cell)
+    if isinstance(value, (int, long)):
+        return 'int'
+    if isinstance(value, float):
+        return 'float'
+    return 'string'
+
+
+def _converter_for(cell_types):
+    cell_types = cell_types - set([None])
+    if cell_types == set(['int']):
+        return _as_int
+    if cell_types and cell_types <= set(['int', 'float']):
+        return _as_float
+    if cell_types == set(['timestamp']):
+        return _as_timestamp
+    return _as_string
+
+
+def _as_int(cell):
+    try:
+        return int(cell)
+    except ValueError:
+        return parse_as_number(cell)
+
+
+def _as_float(cell):
+    try:
+        value = float(cell)
+    except ValueError:
+        return parse_as_number(cell)
+    # "12" is an int to parse_as_number, as is a number too big for a float
+    if value.is_integer() or math.isinf(value):
+        return parse_as_number(cell)
+    return value
+
+
+def _as_timestamp(cell):
+    if ISO_TIMESTAMP.match(cell):
+        return cell
+    return parse_as_number(cell)
+
+
+def _as_string(cell):
+    if NUMBER_PREFIX.match(cell):
+        return parse_as_number(cell)
+    return cell
 
 
 def parse_as_number(cell):
@@ -80,11 +222,25 @@ def ignore_comment_column(rows):
             yield row
 
 
-def unicode_csv_reader(incoming_data, encoding):
+class Undecoded(str):
+    """A cell which could not be decoded, left as it was read"""
+
+
+def unicode_csv_reader(incoming_data, encoding, strict=True):
     reader = csv.reader(incoming_data)
 
+    for row in reader:
+        try:
+            cells = [unicode(cell, encoding) for cell in row]
+        except UnicodeError:
+            if strict:
+                raise ParseError("Non-UTF8 characters found.")
+            cells = [_decode(cell, encoding) for cell in row]
+        yield cells
+
+
+def _decode(cell, encoding):
     try:
-        for row in reader:
-            yield [unicode(cell, encoding) for cell in row]
+        return unicode(cell, encoding)
     except UnicodeError:
-        raise ParseError("Non-UTF8 characters found.")
+        return Undecoded(cell)
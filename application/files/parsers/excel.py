@@ -4,6 +4,7 @@ import datetime
 import logging
 import pytz
 import xlrd
+import zipfile
 
 
 class ExcelError(ParseError):
@@ -21,49 +22,116 @@ class ExcelError(ParseError):
 EXCEL_ERROR = ExcelError("error in cell")
 
 
-def is_excel(incoming_data):
-    matches_excel = False
-    try:
-        book = xlrd.open_workbook(file_contents=incoming_data.read())
-        book.sheet_by_index(0)
-        matches_excel = True
-    except xlrd.XLRDError:
-        logging.warning('File is not an excel spreadsheet')
+OLE2_SIGNATURE = '\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'
+ZIP_SIGNATURE = 'PK\x03\x04'
+XLSX_MARKER = '[Content_Types].xml'
+
+
+def sniff_excel_format(incoming_data):
+    """Return 'xls' or 'xlsx' if the data looks like an excel file, or None
+
+    Only the magic bytes at the start of the file, and for zip files the
+    archive's list of contents, are looked at. The stream is rewound
+    afterwards.
+    """
+    excel_format = None
+    header = incoming_data.read(len(OLE2_SIGNATURE))
+
+    if header == OLE2_SIGNATURE:
+        excel_format = 'xls'
+    elif header.startswith(ZIP_SIGNATURE):
+        incoming_data.seek(0)
+        try:
+            if XLSX_MARKER in zipfile.ZipFile(incoming_data).namelist():
+                excel_format = 'xlsx'
+        except zipfile.BadZipfile:
+            pass
 
     incoming_data.seek(0)
-    return matches_excel
+    return excel_format
+
+
+def open_excel(incoming_data):
+    """Return the opened workbook if the data is an excel file, or None
+
+    Files which do not carry an excel signature are never handed to xlrd.
+    xls workbooks are opened on demand so that no sheet is loaded until it
+    is read. The stream is rewound afterwards.
+    """
+    book = None
+    excel_format = sniff_excel_format(incoming_data)
+    if excel_format is not None:
+        try:
+            # xlrd only supports loading sheets on demand for xls files
+            book = xlrd.open_workbook(file_contents=incoming_data.read(),
+                                      on_demand=(excel_format == 'xls'))
+        except xlrd.XLRDError:
+            logging.warning('File is not an excel spreadsheet')
+            book = None
 
+    incoming_data.seek(0)
+    return book
 
-def parse_excel(incoming_data):
-    book = xlrd.open_workbook(file_contents=incoming_data.read())
 
-    return _extract_rows(book.sheet_by_index(0), book)
+def iter_workbook_rows(book, sheet_name=None):
+    """Yield the rows of the named sheet, or the first, one at a time
 
+    Cells are converted as each row is read, without building a list of
+    every row. The workbook's file contents are released once the last row
+    has been read.
+    """
+    sheet = _sheet(book, sheet_name)
 
-def _extract_rows(sheet, book):
-    return [_extract_values(sheet.row(i), book) for i in range(sheet.nrows)]
+    try:
+        for row in iter_sheet_rows(sheet):
+            yield row
+    finally:
+        book.release_resources()
 
 
-def _extract_values(row, book):
-    return [_extract_cell_value(cell, book) for cell in row]
+def iter_sheet_rows(sheet):
+    """Yield the rows of a sheet which has been loaded, one at a time"""
+    for i in xrange(sheet.nrows):
+        yield [_extract_value(ctype, value, sheet.book)
+               for ctype, value
+               in zip(sheet.row_types(i), sheet.row_values(i))]
+
+
+def sheet_by_name(book, sheet_name):
+    """Return the named sheet of a workbook, or raise ParseError"""
+    try:
+        return book.sheet_by_name(sheet_name)
+    except xlrd.XLRDError:
+        raise ParseError('There is no sheet named "{0}"'.format(
+            sheet_name.encode('utf-8')))
+
+
+def _sheet(book, sheet_name):
+    if sheet_name is None:
+        return book.sheet_by_index(0)
+    try:
+        return sheet_by_name(book, sheet_name)
+    except ParseError:
+        book.release_resources()
+        raise
 
 
-def _extract_cell_value(cell, book):
+def _extract_value(ctype, cell_value, book):
     value = None
-    if cell.ctype == xlrd.XL_CELL_DATE:
-        time_tuple = xlrd.xldate_as_tuple(cell.value, book.datemode)
+    if ctype == xlrd.XL_CELL_DATE:
+        time_tuple = xlrd.xldate_as_tuple(cell_value, book.datemode)
         dt = datetime.datetime(*time_tuple)
         value = dt.replace(tzinfo=pytz.UTC).isoformat()
-    elif cell.ctype == xlrd.XL_CELL_NUMBER:
-        value = cell.value
+    elif ctype == xlrd.XL_CELL_NUMBER:
+        value = cell_value
         if value == int(value):
             value = int(value)
-    elif cell.ctype == xlrd.XL_CELL_EMPTY:
+    elif ctype == xlrd.XL_CELL_EMPTY:
         value = None
-    elif cell.ctype == xlrd.XL_CELL_ERROR:
+    elif ctype == xlrd.XL_CELL_ERROR:
         logging.warn("Encountered errors in cells when parsing excel file")
         value = EXCEL_ERROR
     else:
-        value = cell.value
+        value = cell_value
 
     return value
@@ -0,0 +1,201 @@
+from collections import Mapping
+from json.encoder import encode_basestring_ascii
+import json
+
+from performanceplatform.client.base import JsonEncoder
+
+
+class Schema(object):
+    """The keys of a spreadsheet's header, shared by every Record of it
+
+    As with a dictionary made from the header, a key which appears more than
+    once takes the value from its last column.
+    """
+
+    def __init__(self, header):
+        self.index = dict((key, position)
+                          for position, key in enumerate(header))
+        self.keys = [key for position, key in enumerate(header)
+                     if self.index[key] == position]
+        self.positions = [self.index[key] for key in self.keys]
+        if self.positions == range(len(header)):
+            self.positions = None
+
+        # A format string for a record's JSON with its values left to fill in
+        self.json_template = '{{{0}}}'.format(', '.join(
+            encode_basestring_ascii(_key_string(key)).replace('%', '%%') +
+            ': %s' for key in self.keys))
+
+
+class Record(object):
+    """A read only mapping of a Schema's keys to the values of one row
+
+    It holds nothing but the row and the shared schema, in slots rather
+    than an instance dictionary, so it takes a fraction of the memory of a
+    dictionary with the same items, and it compares equal to one. The row
+    is not copied.
+
+    The mapping methods are written out here rather than inherited from
+    Mapping, as a class whose bases have no __slots__ gives every instance
+    a __dict__ regardless of its own. It is registered as a Mapping instead.
+
+    >>> schema = Schema(['name', 'size'])
+    >>> record = Record(schema, ['bottle', 123])
+    >>> record['size']
+    123
+    >>> record == {'name': 'bottle', 'size': 123}
+    True
+    >>> record
+    {'name': 'bottle', 'size': 123}
+    """
+
+    __slots__ = ('schema', 'row')
+
+    def __init__(self, schema, row):
+        self.schema = schema
+        self.row = row
+
+    def __getitem__(self, key):
+        return self.row[self.schema.index[key]]
+
+    def get(self, key, default=None):
+        position = self.schema.index.get(key)
+        return default if position is None else self.row[position]
+
+    def __iter__(self):
+        return iter(self.schema.keys)
+
+    def __len__(self):
+        return len(self.schema.keys)
+
+    def __contains__(self, key):
+        return key in self.schema.index
+
+    def keys(self):
+        return list(self.schema.keys)
+
+    def values(self):
+        return [self[key] for key in self.schema.keys]
+
+    def items(self):
+        return [(key, self[key]) for key in self.schema.keys]
+
+    def iterkeys(self):
+        return iter(self)
+
+    def itervalues(self):
+        return (self[key] for key in self.schema.keys)
+
+    def iteritems(self):
+        return ((key, self[key]) for key in self.schema.keys)
+
+    def __eq__(self, other):
+        if not isinstance(other, Mapping):
+            return NotImplemented
+        return dict(self.iteritems()) == dict(other.items())
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '{{{0}}}'.format(', '.join(
+            '{0!r}: {1!r}'.format(key, self[key]) for key in self))
+
+    def to_json(self):
+        values = self.row
+        if self.schema.positions is not None:
+            values = [values[position] for position in self.schema.positions]
+
+        encoded = [VALUE_ENCODERS.get(type(value), _encode_other)(value)
+                   for value in values]
+        # repr gives these for floats which JSON writes differently
+        if 'nan' in encoded or 'inf' in encoded or '-inf' in encoded:
+            encoded = [SPECIAL_FLOATS.get(value, value) for value in encoded]
+
+        return self.schema.json_template % tuple(encoded)
+
+
+Mapping.register(Record)
+
+
+def encode_records(records):
+    """Return records as a JSON array, in the form backdrop is posted
+
+    Records are written straight from their rows; anything else is encoded
+    the way the performance platform client would.
+
+    >>> schema = Schema(['name', 'size'])
+    >>> print(encode_records([Record(schema, [u'bottle', 1.5]), {'a': None}]))
+    [{"name": "bottle", "size": 1.5}, {"a": null}]
+    """
+    return '[{0}]'.format(', '.join([
+        record.to_json() if isinstance(record, Record)
+        else _encode_other(record)
+        for record in records]))
+
+
+def iter_encoded_records(records):
+    """Yield the JSON array of records a piece at a time
+
+    The pieces join to what encode_records returns, without the whole array
+    being held at once.
+
+    >>> schema = Schema(['name'])
+    >>> list(iter_encoded_records([Record(schema, [u'bottle']), {'a': 1}]))
+    ['[', '{"name": "bottle"}', ', ', '{"a": 1}', ']']
+    """
+    yield '['
+    separator = ''
+    for record in records:
+        if separator:
+            yield separator
+        yield (record.to_json() if isinstance(record, Record)
+               else _encode_other(record))
+        separator = ', '
+    yield ']'
+
+
+def _encode_float(value):
+    return SPECIAL_FLOATS.get(repr(value)) or repr(value)
+
+
+def _key_string(key):
+    # The same coercion json.dumps applies to the keys of a dictionary
+    if isinstance(key, basestring):
+        return key
+    if key is True:
+        return 'true'
+    if key is False:
+        return 'false'
+    if key is None:
+        return 'null'
+    if isinstance(key, float):
+        return _encode_float(key)
+    if isinstance(key, (int, long)):
+        return str(key)
+    raise TypeError('key {0!r} is not a string'.format(key))
+
+
+def _encode_other(value):
+    return json.dumps(value, cls=JsonEncoder)
+
+
+# How the json module writes the floats which repr gives as these
+SPECIAL_FLOATS = {
+    'nan': 'NaN',
+    'inf': 'Infinity',
+    '-inf': '-Infinity',
+}
+
+VALUE_ENCODERS = {
+    unicode: encode_basestring_ascii,
+    str: encode_basestring_ascii,
+    int: str,
+    long: str,
+    float: repr,
+    bool: lambda value: 'true' if value else 'false',
+    type(None): lambda value: 'null',
+}
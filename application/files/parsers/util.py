@@ -1,12 +1,19 @@
 from application.files.parsers import ParseError
+from application.files.parsers.dsv import Undecoded
+from application.files.parsers.excel import ExcelError
+from application.files.parsers.records import Record, Schema
 
+import itertools
+import time
 
-def remove_blanks(rows):
-    def blank_filter(r):
-        return not all(v is None or
-                       (isinstance(v, basestring) and len(v) == 0) for v in r)
 
-    return filter(blank_filter, rows)
+def is_blank(row):
+    return all(v is None or
+               (isinstance(v, basestring) and len(v) == 0) for v in row)
+
+
+def remove_blanks(rows):
+    return itertools.ifilterfalse(is_blank, rows)
 
 
 def make_dicts(rows):
@@ -15,18 +22,263 @@ def make_dicts(rows):
     Given an iterator of rows consisting of a iterator of lists of values
     produces an iterator of dictionaries using the first row as the keys for
     all subsequent rows.
+
+    The header is counted as row 1, so any ParseError names the row which
+    could not be turned into a dictionary.
+    """
+    return RowPipeline(
+        [SkipBlankRows(), CheckColumnCount(), MakeDicts()]).run(rows)
+
+
+def record_pipeline(timed=False, max_problems=None):
+    """Return the pipeline which turns parsed rows into Records
+
+    Records compare equal to the dictionaries make_dicts would give, but
+    share the header between them instead of each holding its keys.
+
+    Given max_problems, every row is checked as it goes through, instead of
+    the parse stopping at the first bad row, and up to max_problems of them
+    are listed by the pipeline's problems().
+    """
+    if max_problems is None:
+        check = CheckColumnCount()
+    else:
+        check = CheckRows(max_problems)
+    return RowPipeline([SkipBlankRows(), check, MakeRecords()], timed=timed)
+
+
+class RowPipeline(object):
+    """Lazily passes the rows after a header through a list of stages
+
+    Each row is handed on as soon as it has been through every stage, so
+    nothing is held apart from the row in flight. Rows are numbered from 2,
+    after the header, unless run_numbered is given their numbers, and
+    counted in and out of every stage.
+
+    Timing each stage costs about as much as the stages themselves, so it is
+    only done for a pipeline made with timed=True.
+
+    >>> pipeline = record_pipeline()
+    >>> list(pipeline.run([['a', 'b'], [1, 2], ['', None], [3, 4]]))
+    [{'a': 1, 'b': 2}, {'a': 3, 'b': 4}]
+    >>> str(pipeline).split('; ')[0]
+    'skip_blanks: 3 in, 1 dropped, 2 out'
+    """
+
+    def __init__(self, stages, timed=False):
+        self.stages = stages
+        self.timed = timed
+        self.rows_in = 0
+
+    def run(self, rows):
+        return self.run_numbered(enumerate(rows, start=1))
+
+    def run_numbered(self, numbered_rows):
+        """Run (row number, row) pairs, such as parse_numbered_csv gives"""
+        numbered_rows = iter(numbered_rows)
+        _, header = next(numbered_rows)
+        for stage in self.stages:
+            stage.start(header)
+
+        if self.timed:
+            return self._run_timed(numbered_rows)
+        return self._run(numbered_rows)
+
+    def _run(self, numbered_rows):
+        steps = [(stage, stage.process) for stage in self.stages]
+        drop = Stage.DROP
+
+        try:
+            for row_number, row in numbered_rows:
+                self.rows_in += 1
+                for stage, process in steps:
+                    row = process(row_number, row)
+                    if row is drop:
+                        stage.rows_dropped += 1
+                        break
+                else:
+                    yield row
+        except StopRows:
+            return
+
+    def _run_timed(self, numbered_rows):
+        try:
+            for row_number, row in numbered_rows:
+                self.rows_in += 1
+                for stage in self.stages:
+                    started = time.time()
+                    row = stage.process(row_number, row)
+                    stage.seconds += time.time() - started
+                    if row is Stage.DROP:
+                        stage.rows_dropped += 1
+                        break
+                else:
+                    yield row
+        except StopRows:
+            return
+
+    def problems(self):
+        """Return the bad rows the stages found, if they were checking"""
+        return [problem for stage in self.stages
+                for problem in stage.problems]
+
+    def counters(self):
+        """Return the rows in, dropped and out and the time of each stage"""
+        counters = []
+        rows_in = self.rows_in
+        for stage in self.stages:
+            rows_out = rows_in - stage.rows_dropped
+            counters.append((stage.name, {
+                'rows_in': rows_in,
+                'rows_dropped': stage.rows_dropped,
+                'rows_out': rows_out,
+                'seconds': stage.seconds,
+            }))
+            rows_in = rows_out
+        return counters
+
+    def __str__(self):
+        return '; '.join(
+            '{0}: {rows_in} in, {rows_dropped} dropped, {rows_out} out'
+            .format(name, **counts) for name, counts in self.counters())
+
+
+class StopRows(Exception):
+    """Raised by a stage to end its pipeline without reading another row"""
+
+
+class Stage(object):
+    """One step of a RowPipeline
+
+    Subclasses implement process, which is given a row and its number and
+    returns the row to hand on, or DROP to leave it out. start is given the
+    header before any rows.
     """
-    rows = iter(rows)
-    keys = next(rows)
 
-    for row in remove_blanks(rows):
-        key_count = len(keys)
+    DROP = object()
+
+    name = None
+    problems = ()
+
+    def __init__(self):
+        self.rows_dropped = 0
+        self.seconds = 0.0
+
+    def start(self, header):
+        pass
+
+    def process(self, row_number, row):
+        raise NotImplementedError
+
+
+class SkipBlankRows(Stage):
+
+    name = 'skip_blanks'
+
+    def process(self, row_number, row):
+        return self.DROP if is_blank(row) else row
+
+
+class CheckColumnCount(Stage):
+
+    name = 'check_columns'
+
+    def start(self, header):
+        self.key_count = len(header)
+
+    def process(self, row_number, row):
         row_count = len(row)
-        if key_count < row_count:
+        if self.key_count < row_count:
             raise ParseError(
-                'Some rows in the CSV file contain more values than columns')
-        if key_count > row_count:
+                'Some rows in the CSV file contain more values than columns '
+                '(first found in row {0})'.format(row_number))
+        if self.key_count > row_count:
             raise ParseError(
-                'Some rows in the CSV file contain fewer values than columns')
+                'Some rows in the CSV file contain fewer values than columns '
+                '(first found in row {0})'.format(row_number))
+        return row
+
+
+class CheckRows(Stage):
+    """Leaves out, and lists, the rows which would stop the parse
+
+    A row is bad if it has more or fewer values than the header, or a cell
+    which could not be read. Once max_problems bad rows have been found the
+    pipeline stops.
+    """
+
+    name = 'check_rows'
+
+    def __init__(self, max_problems):
+        super(CheckRows, self).__init__()
+        self.max_problems = max_problems
+        self.problems = []
+
+    def start(self, header):
+        self.key_count = len(header)
+
+    def process(self, row_number, row):
+        problem = self.problem(row)
+        if problem is None:
+            return row
+
+        self.problems.append('Row {0} contains {1}'.format(row_number,
+                                                           problem))
+        if len(self.problems) >= self.max_problems:
+            raise StopRows()
+        return self.DROP
+
+    def problem(self, row):
+        row_count = len(row)
+        if self.key_count < row_count:
+            return 'more values than columns'
+        if self.key_count > row_count:
+            return 'fewer values than columns'
+        for value in row:
+            if isinstance(value, ExcelError):
+                return 'a cell with an error'
+            if isinstance(value, Undecoded):
+                return 'non-UTF8 characters'
+        return None
+
+
+class MakeDicts(Stage):
+
+    name = 'make_dicts'
+
+    def start(self, header):
+        self.keys = header
+
+    def process(self, row_number, row):
+        return dict(zip(self.keys, row))
+
+
+class MakeRecords(Stage):
+
+    name = 'make_records'
+
+    def start(self, header):
+        self.schema = Schema(header)
+
+    def process(self, row_number, row):
+        return Record(self.schema, row)
+
+
+def batches(items, batch_size):
+    """Return an iterator of lists holding at most batch_size items
+
+    Only one batch is held in memory at a time, so a large iterator of rows
+    can be sent on in fixed size pieces.
+
+    >>> list(batches(iter([1, 2, 3, 4, 5]), 2))
+    [[1, 2], [3, 4], [5]]
+    >>> list(batches([], 2))
+    []
+    """
+    items = iter(items)
 
-        yield dict(zip(keys, row))
+    while True:
+        batch = list(itertools.islice(items, batch_size))
+        if not batch:
+            return
+        yield batch
@@ -0,0 +1,25 @@
+from multiprocessing.pool import ThreadPool
+import threading
+
+from application import app
+
+
+class LazyThreadPool(object):
+    """A pool of threads which is only started when it is first used
+
+    Each process that forks from the app therefore gets its own. The number
+    of threads is read from the setting named by size_setting.
+    """
+
+    def __init__(self, size_setting, default_size):
+        self.size_setting = size_setting
+        self.default_size = default_size
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def apply_async(self, function, args=()):
+        with self.lock:
+            if self.pool is None:
+                self.pool = ThreadPool(
+                    app.config.get(self.size_setting, self.default_size))
+        return self.pool.apply_async(function, args)
@@ -1,7 +1,27 @@
-from application.files.parsers.dsv import parse_csv
-from application.files.parsers.excel import parse_excel, is_excel
-from application.files.parsers.util import make_dicts
+import hashlib
+import threading
+
+from application import app
+from application.files.clamd import ScanCancelled
+from application.files.parsers import BadRows, ParseError
+from application.files.parsers.dsv import parse_numbered_csv
+from application.files.parsers.excel import (
+    iter_sheet_rows, iter_workbook_rows, open_excel, sheet_by_name)
+from application.files.parsers.util import record_pipeline
+from application.files.pools import LazyThreadPool
 from application.files.uploaded import UploadedFile
+from werkzeug.datastructures import FileStorage
+
+_pool = LazyThreadPool('UPLOAD_VALIDATION_WORKERS', 4)
+
+# How many records are parsed between checks that the scan has not failed
+CANCEL_CHECK_INTERVAL = 1000
+
+NOT_EXCEL = 'Only excel files have sheets to choose from'
+
+
+class ParseCancelled(Exception):
+    pass
 
 
 class Spreadsheet(UploadedFile):
@@ -13,27 +33,238 @@ class Spreadsheet(UploadedFile):
         'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
     ]
 
-    def as_json(self):
-        json = None
+    pipeline = None
+
+    def __init__(self, file_storage, max_file_size=None, sheet=None):
+        super(Spreadsheet, self).__init__(file_storage, max_file_size)
+        self.sheet = sheet
+
+    def content_hash(self):
+        """Return the sha256 of the upload, and the sheet read from it"""
+        content_hash = super(Spreadsheet, self).content_hash()
+        if self.sheet is None:
+            return content_hash
+        return hashlib.sha256('{0}:{1}'.format(
+            content_hash, self.sheet.encode('utf-8'))).hexdigest()
+
+    def as_json(self, max_problems=None):
+        return list(self.iter_json(max_problems=max_problems))
+
+    def iter_json(self, spreadsheet=None, max_problems=None):
+        """Yield the upload's records, read from spreadsheet if given
+
+        Given max_problems, a bad row does not stop the parse. No more
+        records are yielded once one is found, but the rows after it are
+        still read and checked, and BadRows is raised at the end listing up
+        to max_problems of them.
+        """
+        rows = self.numbered_rows(spreadsheet, strict=max_problems is None)
 
-        with open(self.filename) as spreadsheet:
-            if is_excel(spreadsheet):
-                lines = parse_excel(spreadsheet)
-            else:
-                lines = parse_csv(spreadsheet)
+        self.pipeline = record_pipeline(
+            timed=app.config.get('UPLOAD_TIME_PIPELINE', False),
+            max_problems=max_problems)
+        records = self.pipeline.run_numbered(rows)
+        if max_problems is None:
+            for record in records:
+                yield record
+            return
 
-            json = list(make_dicts(lines))
+        for record in records:
+            if self.pipeline.problems():
+                break
+            yield record
+        for _ in records:
+            pass
+        if self.pipeline.problems():
+            raise BadRows(self.pipeline.problems())
 
-        return json
+    def numbered_rows(self, spreadsheet=None, strict=True):
+        """Return the upload's rows, read from spreadsheet if given
+
+        Each row comes with its number in the file: its row of the sheet,
+        or the line of the CSV file it ends on.
+        """
+        if spreadsheet is None:
+            spreadsheet = self.open()
+
+        book = open_excel(spreadsheet)
+        if book is not None:
+            return enumerate(iter_workbook_rows(book, self.sheet), start=1)
+        elif self.sheet is not None:
+            raise ParseError(NOT_EXCEL)
+        else:
+            return parse_numbered_csv(spreadsheet, strict)
+
+    def parse(self, max_row_problems=None):
+        """Return the problems parsing the upload and, if none, its records
+
+        Given max_row_problems, every row is checked as it is parsed, and up
+        to that many bad rows are returned instead of the first.
+        """
+        return self._parse(self.open(), threading.Event(), max_row_problems)
+
+    def validate_and_parse(self, max_row_problems=None):
+        """Return the problems with the upload and, if none, its records
+
+        When VIRUS_CHECK is on the virus scan and the parse run at the same
+        time, each reading the file for itself. Whichever fails first stops
+        the other, and the records are only returned once the scan has
+        found the file clean. Up to max_row_problems bad rows are returned
+        instead of the first, if it is given, as parse() returns them.
+        """
+        problems = self.validate_without_scan()
+        if problems:
+            return problems, None
+
+        if not app.config.get('VIRUS_CHECK', False):
+            return self.parse(max_row_problems)
+
+        lock = threading.Lock()
+        cancelled = threading.Event()
+        scanning = _pool.apply_async(
+            self._scan, (self.open_reader(lock), cancelled))
+        parsing = _pool.apply_async(
+            self._parse, (self.open_reader(lock), cancelled,
+                          max_row_problems))
+
+        scan_problems = scanning.get()
+        problems, records = parsing.get()
+        if scan_problems:
+            return scan_problems, None
+        return problems, records
+
+    def _scan(self, stream, cancelled):
+        try:
+            problems = self.scan_for_viruses(stream, cancelled)
+        except ScanCancelled:
+            return []
+        if problems:
+            cancelled.set()
+        return problems
+
+    def _parse(self, stream, cancelled, max_row_problems=None):
+        records = []
+        try:
+            for record in self.iter_json(stream, max_row_problems):
+                records.append(record)
+                if (len(records) % CANCEL_CHECK_INTERVAL == 0 and
+                        cancelled.is_set()):
+                    raise ParseCancelled()
+        except ParseCancelled:
+            return [], None
+        except ParseError as e:
+            cancelled.set()
+            return e.problems(), None
+        return [], records
 
     def is_valid_content_type(self):
         return self.content_type in self.ALLOWED_CONTENT_TYPES
 
-    def validate(self):
-        problems = super(Spreadsheet, self).validate()
+    def validate_without_scan(self):
+        problems = super(Spreadsheet, self).validate_without_scan()
 
         if not self.is_valid_content_type():
             problems.append(
                 'Invalid content type for file "{}"'.format(self.content_type))
 
         return problems
+
+
+class Workbook(UploadedFile):
+    """A workbook uploaded once for several data sets, a sheet for each
+
+    However many of its sheets are uploaded, the workbook is scanned once
+    and opened once, and each sheet is read from it once, by whichever
+    upload needs it first. The file contents are let go once every sheet
+    in sheet_names has been read. Each sheet is uploaded as the
+    WorkbookSheet returned by sheet(), and they can be uploaded side by
+    side.
+    """
+
+    def __init__(self, file_storage, sheet_names, max_file_size=None):
+        super(Workbook, self).__init__(file_storage, max_file_size)
+        self.sheet_names = set(sheet_names)
+        self.spool_lock = threading.Lock()
+        self.scan_lock = threading.Lock()
+        self.sheets_lock = threading.Lock()
+        self.scan_problems = None
+        self.book = None
+        self.opened = False
+        self.sheets = {}
+
+    def sheet(self, sheet_name, max_file_size=None):
+        """Return the upload of the named sheet, held to max_file_size"""
+        return WorkbookSheet(self, sheet_name, max_file_size)
+
+    def reader(self):
+        """Return a reader of the workbook which its sheets can share"""
+        return self.open_reader(self.spool_lock)
+
+    def scan_once(self):
+        """Return the problems with the workbook found by its one scan"""
+        with self.scan_lock:
+            if self.scan_problems is None:
+                self.scan_problems = self.scan_for_viruses(self.reader())
+            return self.scan_problems
+
+    def read_sheet(self, sheet_name):
+        """Return the named sheet, or raise ParseError if there is none"""
+        with self.sheets_lock:
+            if sheet_name not in self.sheets:
+                self.sheets[sheet_name] = self._read_sheet(sheet_name)
+                if (self.book is not None and
+                        self.sheet_names.issubset(self.sheets)):
+                    self.book.release_resources()
+            sheet = self.sheets[sheet_name]
+
+        if isinstance(sheet, basestring):
+            raise ParseError(sheet)
+        return sheet
+
+    def _read_sheet(self, sheet_name):
+        # Returns the problem instead of a sheet that could not be read
+        if not self.opened:
+            self.book = open_excel(self.reader())
+            self.opened = True
+        if self.book is None:
+            return NOT_EXCEL
+        try:
+            return sheet_by_name(self.book, sheet_name)
+        except ParseError as e:
+            return str(e)
+
+    def cleanup(self):
+        if self.book is not None:
+            self.book.release_resources()
+        super(Workbook, self).cleanup()
+
+
+class WorkbookSheet(Spreadsheet):
+    """A sheet of a Workbook, uploaded to a data set of its own
+
+    The sheet shares the workbook's file, scan and opened sheets instead of
+    copying, scanning or opening the file again. The workbook is left open
+    when the sheet is cleaned up, as other sheets may still be reading it.
+    """
+
+    def __init__(self, workbook, sheet, max_file_size=None):
+        super(WorkbookSheet, self).__init__(
+            FileStorage(stream=workbook.file, filename=workbook.filename),
+            max_file_size, sheet=sheet)
+        self.workbook = workbook
+
+    def open(self):
+        return self.workbook.reader()
+
+    def open_reader(self, lock):
+        return self.workbook.reader()
+
+    def numbered_rows(self, spreadsheet=None, strict=True):
+        return enumerate(
+            iter_sheet_rows(self.workbook.read_sheet(self.sheet)), start=1)
+
+    def scan_for_viruses(self, stream=None, cancelled=None):
+        return self.workbook.scan_once()
+
+    def cleanup(self):
+        pass
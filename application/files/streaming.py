@@ -0,0 +1,174 @@
+"""Posting records to backdrop as a gzipped stream
+
+Records are encoded and compressed as they are sent, in a chunked request,
+so neither the JSON nor its compressed form is ever held whole.
+"""
+import logging
+import socket
+import time
+import zlib
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+from urllib3.util import Timeout
+
+from application import app
+from application.files.parsers.records import iter_encoded_records
+
+logger = logging.getLogger(__name__)
+
+# Compressed data is sent once there is at least this much of it
+CHUNK_SIZE = 64 * 1024
+# Most times a request is tried, as the client tries them
+MAX_TRIES = 5
+
+
+def gzip_stream(pieces, chunk_size=CHUNK_SIZE):
+    """Yield the gzip of the strings in pieces, chunk_size bytes or so at a
+    time"""
+    # A wbits of 16 + MAX_WBITS writes a gzip header and trailer
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    buffered = []
+    size = 0
+    for piece in pieces:
+        compressed = compressor.compress(piece)
+        if compressed:
+            buffered.append(compressed)
+            size += len(compressed)
+            if size >= chunk_size:
+                yield ''.join(buffered)
+                buffered = []
+                size = 0
+    buffered.append(compressor.flush())
+    yield ''.join(buffered)
+
+
+class CountedRecords(object):
+    """Counts the records taken from it"""
+
+    def __init__(self, records):
+        self.records = records
+        self.count = 0
+
+    def __iter__(self):
+        for record in self.records:
+            self.count += 1
+            yield record
+
+
+class StreamingAdapter(HTTPAdapter):
+    """An HTTPAdapter which gives chunked requests timeouts and errors
+
+    requests sends a body it has no length for in chunks, without the
+    timeouts it gives other requests, and lets urllib3's own errors out if
+    it cannot connect. Connections from this adapter are made within
+    connect_timeout seconds and then wait at most read_timeout seconds to
+    send or receive, and failures raise requests' errors.
+    """
+
+    def __init__(self, connect_timeout, read_timeout, **kwargs):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        super(StreamingAdapter, self).__init__(**kwargs)
+
+    def get_connection(self, url, proxies=None):
+        pool = super(StreamingAdapter, self).get_connection(url, proxies)
+        pool.timeout = Timeout(connect=self.connect_timeout,
+                               read=self.read_timeout)
+        if not getattr(pool.ConnectionCls, 'read_timeout', None):
+            pool.ConnectionCls = self._timed(pool.ConnectionCls)
+        return pool
+
+    def _timed(self, connection_class):
+        read_timeout = self.read_timeout
+
+        class TimedConnection(connection_class):
+
+            def connect(self):
+                connection_class.connect(self)
+                self.sock.settimeout(read_timeout)
+
+        TimedConnection.read_timeout = read_timeout
+        return TimedConnection
+
+    def send(self, request, **kwargs):
+        try:
+            return super(StreamingAdapter, self).send(request, **kwargs)
+        except NewConnectionError as e:
+            raise requests.ConnectionError(e, request=request)
+        except ConnectTimeoutError as e:
+            raise requests.ConnectTimeout(e, request=request)
+        except requests.ConnectionError as e:
+            if e.args and isinstance(e.args[0], socket.timeout):
+                raise requests.ReadTimeout(e, request=request)
+            raise
+
+
+def post_gzip_stream(data_set, records):
+    """Post records to a data set as DataSet.post does, but streamed
+
+    HTTPError is raised for an error response, and logged, as it is by the
+    client. The request times out after BACKDROP_CONNECT_TIMEOUT seconds
+    connecting, or BACKDROP_READ_TIMEOUT waiting for backdrop. A ParseError
+    from records stops the request before it is complete, so backdrop
+    stores none of them.
+
+    The body cannot be sent twice, so where the client would try again the
+    request is only tried again if it could not connect.
+    """
+    headers = {
+        'Accept': 'application/json',
+        'Content-Type': 'application/json',
+        'Content-Encoding': 'gzip',
+        'User-Agent': 'Performance Platform Client {}'.format(
+            data_set.get_version()),
+        'Govuk-Request-Id': _request_id(data_set),
+    }
+    if data_set.token is not None:
+        headers['Authorization'] = 'Bearer ' + data_set.token
+
+    body = _Body(gzip_stream(iter_encoded_records(records)))
+    tries = MAX_TRIES if data_set.retry_on_error else 1
+    with requests.Session() as session:
+        adapter = StreamingAdapter(
+            app.config.get('BACKDROP_CONNECT_TIMEOUT', 5),
+            app.config.get('BACKDROP_READ_TIMEOUT', 300))
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
+        for attempt in range(tries):
+            try:
+                response = session.post(data_set.base_url, headers=headers,
+                                        data=body)
+                break
+            except requests.ConnectionError:
+                if attempt + 1 == tries or body.started:
+                    raise
+                time.sleep(2 ** attempt)
+
+    try:
+        response.raise_for_status()
+    except requests.HTTPError:
+        logger.error('[PP-C] {}'.format(response.text))
+        raise
+    return response
+
+
+class _Body(object):
+    """A request body which knows whether sending it has begun"""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.started = False
+
+    def __iter__(self):
+        self.started = True
+        for chunk in self.chunks:
+            yield chunk
+
+
+def _request_id(data_set):
+    # The id the client would send, from the function it was given
+    request_id_fn = getattr(data_set, '_request_id_fn', None)
+    return request_id_fn() if request_id_fn is not None else 'Not-Set'
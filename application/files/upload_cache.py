@@ -0,0 +1,137 @@
+from collections import namedtuple
+import json
+import time
+
+from application import app
+from application.files.parsers.records import encode_records
+
+
+CachedUpload = namedtuple('CachedUpload', ['is_virus', 'records'])
+
+
+class UploadCache(object):
+    """What was found in earlier uploads, kept in redis by content and data set
+
+    Each entry holds whether the upload had a virus (None if it was not
+    scanned) and its records as JSON. Entries expire after ttl seconds, and
+    the oldest are removed to keep their total size under max_bytes. Records
+    too big to fit are not kept.
+
+    The content last posted to each data set is kept too, for as long, so
+    that sending it again can be skipped. Only the last is kept, as the
+    data set holds what was posted most recently, not what was posted
+    before.
+    """
+
+    PREFIX = 'performanceplatform_admin:upload_cache:'
+    # When each entry was stored, and how many bytes it takes
+    INDEX = PREFIX + 'index'
+    SIZES = PREFIX + 'sizes'
+
+    def __init__(self, redis, ttl, max_bytes):
+        self.redis = redis
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+
+    def key(self, content_hash, data_set):
+        return '{0}{1}:{2}/{3}'.format(self.PREFIX, content_hash,
+                                       data_set['data_group'],
+                                       data_set['data_type'])
+
+    def last_posted_key(self, data_set):
+        return '{0}last_posted:{1}/{2}'.format(self.PREFIX,
+                                               data_set['data_group'],
+                                               data_set['data_type'])
+
+    def find(self, content_hash, data_set):
+        """Return the CachedUpload for the content, or None"""
+        fields = self.redis.hgetall(self.key(content_hash, data_set))
+        if 'stored' not in fields:
+            return None
+
+        virus = fields.get('virus')
+        return CachedUpload(
+            is_virus=None if virus is None else virus == '1',
+            records=json.loads(fields['records'])
+            if 'records' in fields else None)
+
+    def last_posted(self, data_set):
+        """Return the hash of the content last posted to the data set"""
+        return self.redis.get(self.last_posted_key(data_set))
+
+    def store_posted(self, content_hash, data_set):
+        """Remember that the content is what the data set was last sent"""
+        self.redis.set(self.last_posted_key(data_set), content_hash,
+                       ex=self.ttl)
+
+    def forget_posted(self, data_set):
+        """Forget what the data set was last sent, as a post failed and
+        could have left part of another upload in it"""
+        self.redis.delete(self.last_posted_key(data_set))
+
+    def store(self, content_hash, data_set, is_virus, records=None):
+        key = self.key(content_hash, data_set)
+        fields = {'stored': time.time()}
+        if is_virus is not None:
+            fields['virus'] = int(is_virus)
+        if records is not None:
+            encoded = encode_records(records)
+            if len(encoded) <= self.max_bytes:
+                fields['records'] = encoded
+        size = sum(len(str(value)) for value in fields.values())
+
+        self._make_room(key, size)
+
+        pipe = self.redis.pipeline()
+        pipe.delete(key)
+        pipe.hmset(key, fields)
+        pipe.expire(key, self.ttl)
+        pipe.zadd(self.INDEX, **{key: fields['stored']})
+        pipe.hset(self.SIZES, key, size)
+        pipe.execute()
+
+    def _make_room(self, key, size):
+        """Remove the oldest entries until one of size bytes fits"""
+        keys = self.redis.zrange(self.INDEX, 0, -1)
+        if not keys:
+            return
+
+        pipe = self.redis.pipeline()
+        for stored_key in keys:
+            pipe.exists(stored_key)
+        exists = pipe.execute()
+        sizes = self.redis.hmget(self.SIZES, keys)
+
+        total = size
+        entries = []
+        gone = []
+        for stored_key, is_stored, stored_size in zip(keys, exists, sizes):
+            # Expired entries, and the one about to be replaced
+            if not is_stored or stored_key == key:
+                gone.append(stored_key)
+            else:
+                entries.append((stored_key, int(stored_size or 0)))
+                total += int(stored_size or 0)
+
+        for stored_key, stored_size in entries:
+            if total <= self.max_bytes:
+                break
+            gone.append(stored_key)
+            total -= stored_size
+
+        if gone:
+            pipe = self.redis.pipeline()
+            pipe.delete(*gone)
+            pipe.zrem(self.INDEX, *gone)
+            pipe.hdel(self.SIZES, *gone)
+            pipe.execute()
+
+
+def upload_cache():
+    """Return the cache of uploads, or None if it is switched off"""
+    if not app.config.get('UPLOAD_CACHE', False):
+        return None
+    return UploadCache(app.redis_instance,
+                       app.config.get('UPLOAD_CACHE_TTL', 7 * 24 * 60 * 60),
+                       app.config.get('UPLOAD_CACHE_MAX_BYTES',
+                                      64 * 1024 * 1024))
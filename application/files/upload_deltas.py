@@ -0,0 +1,92 @@
+import hashlib
+import json
+
+from performanceplatform.client.base import JsonEncoder
+
+from application import app
+
+
+def auto_ids(data_set):
+    """Return the fields backdrop makes a data set's record ids from
+
+    >>> auto_ids({'auto_ids': '_timestamp, channel, period'})
+    ['_timestamp', 'channel', 'period']
+    >>> auto_ids({'auto_ids': []})
+    []
+    """
+    fields = data_set.get('auto_ids') or []
+    if isinstance(fields, basestring):
+        fields = fields.split(',')
+    return [field.strip() for field in fields if field.strip()]
+
+
+def _digest(value):
+    return hashlib.sha1(
+        json.dumps(value, sort_keys=True, cls=JsonEncoder)).digest()[:8]
+
+
+class RowFingerprints(object):
+    """Fingerprints of the rows of a data set which backdrop last accepted
+
+    Each row is known by a hash of its auto id fields and remembered by a
+    hash of all of its fields, so a row which has not changed since it was
+    last sent can be left out. Backdrop replaces a record with the same auto
+    ids, so the rows which are sent update it as the whole file would have.
+    """
+
+    PREFIX = 'performanceplatform_admin:upload_rows:'
+
+    def __init__(self, redis, data_set, auto_ids, ttl):
+        self.redis = redis
+        self.key = '{0}{1}/{2}'.format(self.PREFIX, data_set['data_group'],
+                                       data_set['data_type'])
+        self.auto_ids = auto_ids
+        self.ttl = ttl
+        self.pending = {}
+        self.rows = 0
+        self.sent = 0
+
+    def changed(self, records):
+        """Yield the records which are new or differ from when last sent"""
+        known = self.redis.hgetall(self.key)
+        for record in records:
+            self.rows += 1
+            values = [record.get(field) for field in self.auto_ids]
+            # A row missing an id field is always sent, for backdrop to
+            # reject
+            if None not in values:
+                row_id = _digest(values)
+                fingerprint = _digest(dict(record))
+                if known.get(row_id) == fingerprint:
+                    continue
+                self.pending[row_id] = fingerprint
+            self.sent += 1
+            yield record
+
+    def save(self):
+        """Remember the rows sent, once backdrop has accepted them"""
+        if self.pending:
+            pipe = self.redis.pipeline()
+            pipe.hmset(self.key, self.pending)
+            pipe.expire(self.key, self.ttl)
+            pipe.execute()
+            self.pending = {}
+
+    def __str__(self):
+        return '{0} of {1} rows sent, the rest unchanged'.format(
+            self.sent, self.rows)
+
+
+def row_fingerprints(data_set):
+    """Return the fingerprints of a data set's rows if uploads to it are sent
+    as deltas, otherwise None
+
+    Only data sets with auto ids can be, as without them backdrop adds every
+    record it is sent as a new one.
+    """
+    fields = auto_ids(data_set)
+    if not app.config.get('UPLOAD_DELTAS', False) or not fields:
+        return None
+    return RowFingerprints(app.redis_instance, data_set, fields,
+                           app.config.get('UPLOAD_DELTA_TTL',
+                                          90 * 24 * 60 * 60))
@@ -0,0 +1,315 @@
+from io import BytesIO
+from uuid import uuid4
+import json
+import logging
+import threading
+import time
+
+from redis.client import Script
+from werkzeug.datastructures import FileStorage
+
+from application import app
+
+
+logger = logging.getLogger(__name__)
+
+
+# Moves the job at the front of the queue KEYS[1] to the list of jobs being
+# worked on, KEYS[2], and gives it a heartbeat, whose key is ARGV[1] followed
+# by the job id and ':heartbeat', of ARGV[2] seconds, counting the attempt.
+# This all happens at once so that the job is never seen being worked on
+# without a heartbeat.
+CLAIM_JOB = """
+local job_id = redis.call('RPOPLPUSH', KEYS[1], KEYS[2])
+if job_id then
+    redis.call('SET', ARGV[1] .. job_id .. ':heartbeat', 1, 'EX', ARGV[2])
+    if redis.call('EXISTS', ARGV[1] .. job_id) == 1 then
+        redis.call('HINCRBY', ARGV[1] .. job_id, 'attempts', 1)
+    end
+end
+return job_id
+"""
+_claim_job = Script(None, CLAIM_JOB)
+
+# Takes every job whose heartbeat has stopped off the list of jobs being
+# worked on, KEYS[1], and returns their ids
+TAKE_STALE_JOBS = """
+local stale = {}
+for _, job_id in ipairs(redis.call('LRANGE', KEYS[1], 0, -1)) do
+    if redis.call('EXISTS', ARGV[1] .. job_id .. ':heartbeat') == 0 then
+        redis.call('LREM', KEYS[1], 0, job_id)
+        stale[#stale + 1] = job_id
+    end
+end
+return stale
+"""
+_take_stale_jobs = Script(None, TAKE_STALE_JOBS)
+
+
+class UploadJob(object):
+    """An upload which is handled after the request that posted it
+
+    The job, the uploaded file and the queue of jobs waiting to run are kept
+    in redis, so any process can pick up a job and any process can report on
+    it. The job's state expires UPLOAD_JOB_TTL seconds after it was queued.
+    The file and the data set, with its bearer token, are only kept for
+    UPLOAD_JOB_PENDING_TTL seconds, and are removed as soon as the job
+    finishes.
+
+    A job being worked on is moved to a list of its own and keeps a
+    heartbeat. If the process working on it dies the heartbeat stops, and
+    the job is queued again, unless it may have posted some of its records
+    or has been tried too often, in which case it fails.
+    """
+
+    PREFIX = 'performanceplatform_admin:upload_job:'
+    QUEUE = PREFIX + 'queue'
+    PROCESSING = PREFIX + 'processing'
+
+    FINISHED = 'finished'
+    # Stages in which nothing has been posted, so the job can start again
+    RESTARTABLE_STAGES = ('queued', 'validating')
+    MAX_ATTEMPTS = 3
+
+    def __init__(self, redis, job_id):
+        self.redis = redis
+        self.job_id = job_id
+        self.key = self.PREFIX + job_id
+        self.file_key = self.key + ':file'
+        self.data_set_key = self.key + ':data_set'
+        self.heartbeat_key = self.key + ':heartbeat'
+
+    @classmethod
+    def create(cls, redis, data_set, file_storage):
+        job = cls(redis, str(uuid4()))
+        ttl = app.config.get('UPLOAD_JOB_TTL', 24 * 60 * 60)
+        pending_ttl = min(ttl, app.config.get('UPLOAD_JOB_PENDING_TTL',
+                                              60 * 60))
+
+        file_storage.stream.seek(0)
+        pipe = redis.pipeline()
+        pipe.hmset(job.key, {
+            'data_group': data_set['data_group'],
+            'data_type': data_set['data_type'],
+            'filename': file_storage.filename,
+            'stage': 'queued',
+            'rows': 0,
+        })
+        pipe.expire(job.key, ttl)
+        pipe.set(job.data_set_key, json.dumps(data_set), ex=pending_ttl)
+        pipe.set(job.file_key, file_storage.stream.read(), ex=pending_ttl)
+        pipe.lpush(cls.QUEUE, job.job_id)
+        pipe.execute()
+
+        return job
+
+    @classmethod
+    def find(cls, redis, job_id):
+        job = cls(redis, job_id)
+        if not redis.exists(job.key):
+            return None
+        return job
+
+    @classmethod
+    def next_queued(cls, redis):
+        """Take the job at the front of the queue, or None if it is empty
+
+        The job is moved to the list of jobs being worked on, and its
+        heartbeat started, until it finishes.
+        """
+        while True:
+            job_id = _claim_job(keys=[cls.QUEUE, cls.PROCESSING],
+                                args=[cls.PREFIX, heartbeat_timeout()],
+                                client=redis)
+            if job_id is None:
+                return None
+            job = cls.find(redis, job_id)
+            if job is not None:
+                return job
+            # Jobs which expired while queued are skipped
+            pipe = redis.pipeline()
+            pipe.lrem(cls.PROCESSING, job_id)
+            pipe.delete(cls(redis, job_id).heartbeat_key)
+            pipe.execute()
+
+    @classmethod
+    def recover_stale(cls, redis):
+        """Queue again, or fail, every job whose heartbeat has stopped
+
+        Returns the jobs which were found.
+        """
+        stale = []
+        job_ids = _take_stale_jobs(keys=[cls.PROCESSING], args=[cls.PREFIX],
+                                   client=redis)
+        for job_id in job_ids:
+            job = cls.find(redis, job_id)
+            if job is not None:
+                job.recover()
+                stale.append(job)
+        return stale
+
+    def recover(self):
+        stage, attempts = self.redis.hmget(self.key, 'stage', 'attempts')
+        if stage == self.FINISHED:
+            return
+        if stage not in self.RESTARTABLE_STAGES:
+            logger.warning('Upload job {} stopped while {}'.format(
+                self.job_id, stage))
+            self.finish(500, [
+                'The upload stopped before it had finished, and some of '
+                'its rows may have been uploaded. Please upload the file '
+                'again.'])
+        elif int(attempts or 0) >= self.MAX_ATTEMPTS:
+            logger.warning('Upload job {} stopped {} times'.format(
+                self.job_id, attempts))
+            self.finish(500, ['The upload could not be finished. Please '
+                              'upload the file again.'])
+        else:
+            logger.info('Queueing upload job {} again'.format(self.job_id))
+            pipe = self.redis.pipeline()
+            pipe.hset(self.key, 'stage', 'queued')
+            # Back to the front of the queue, as it has waited already
+            pipe.rpush(self.QUEUE, self.job_id)
+            pipe.execute()
+
+    def state(self):
+        """Return what can be shown about the job"""
+        state = self.redis.hgetall(self.key)
+        state.pop('attempts', None)
+        state['job_id'] = self.job_id
+        state['rows'] = int(state.get('rows', 0))
+        state['unchanged'] = 'unchanged' in state
+        if 'payload' in state:
+            state['payload'] = json.loads(state['payload'])
+            state['status_code'] = int(state['status_code'])
+        return state
+
+    def is_finished(self):
+        return self.redis.hget(self.key, 'stage') == self.FINISHED
+
+    def data_set(self):
+        """Return the data set to upload to, or None if it has expired"""
+        data_set = self.redis.get(self.data_set_key)
+        return json.loads(data_set) if data_set is not None else None
+
+    def file_storage(self):
+        content = self.redis.get(self.file_key) or ''
+        return FileStorage(stream=BytesIO(content),
+                           filename=self.redis.hget(self.key, 'filename'))
+
+    def heartbeat(self):
+        self.redis.set(self.heartbeat_key, 1, ex=heartbeat_timeout())
+
+    def update(self, stage, rows=None):
+        fields = {'stage': stage}
+        if rows is not None:
+            fields['rows'] = rows
+        self.redis.hmset(self.key, fields)
+
+    def finish(self, status_code, payload, unchanged=False):
+        fields = {
+            'stage': self.FINISHED,
+            'status_code': status_code,
+            'payload': json.dumps(payload),
+        }
+        if unchanged:
+            fields['unchanged'] = 1
+
+        pipe = self.redis.pipeline()
+        pipe.hmset(self.key, fields)
+        pipe.delete(self.file_key, self.data_set_key, self.heartbeat_key)
+        pipe.lrem(self.PROCESSING, self.job_id)
+        pipe.execute()
+
+
+def heartbeat_timeout():
+    return app.config.get('UPLOAD_JOB_HEARTBEAT_TIMEOUT', 60)
+
+
+class UploadWorkers(object):
+    """Threads which run queued upload jobs, as long as the process lives
+
+    The threads are only started when asked, so each process that forks
+    from the app starts its own. The number of threads is read from the
+    setting named by size_setting. Idle threads look for jobs every
+    poll_interval seconds, or as soon as they are woken, and look for jobs
+    whose process has died every heartbeat timeout.
+    """
+
+    def __init__(self, size_setting, default_size, poll_interval=1):
+        self.size_setting = size_setting
+        self.default_size = default_size
+        self.poll_interval = poll_interval
+        self.threads = []
+        self.lock = threading.Lock()
+        self.woken = threading.Event()
+        self.stopping = threading.Event()
+        self.next_recovery = 0
+
+    def start(self, redis, run_job):
+        """Start the threads, if they have not been, to run_job each job"""
+        with self.lock:
+            if self.threads:
+                return
+            self.stopping.clear()
+            for _ in range(app.config.get(self.size_setting,
+                                          self.default_size)):
+                thread = threading.Thread(target=self._work,
+                                          args=(redis, run_job))
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def wake(self):
+        """Have an idle thread look for a job now"""
+        self.woken.set()
+
+    def stop(self):
+        with self.lock:
+            threads, self.threads = self.threads, []
+        self.stopping.set()
+        self.woken.set()
+        for thread in threads:
+            thread.join()
+
+    def _work(self, redis, run_job):
+        while not self.stopping.is_set():
+            try:
+                self._recover_if_due(redis)
+                job = UploadJob.next_queued(redis)
+            except Exception:
+                logger.exception('Could not take an upload job')
+                job = None
+
+            if job is None:
+                self.woken.wait(self.poll_interval)
+                self.woken.clear()
+            else:
+                self._run(job, run_job)
+
+    def _recover_if_due(self, redis):
+        with self.lock:
+            if time.time() < self.next_recovery:
+                return
+            self.next_recovery = time.time() + heartbeat_timeout()
+        UploadJob.recover_stale(redis)
+
+    def _run(self, job, run_job):
+        finished = threading.Event()
+        beating = threading.Thread(target=self._beat, args=(job, finished))
+        beating.daemon = True
+        beating.start()
+        try:
+            run_job(job)
+        except Exception:
+            logger.exception('Upload job {} failed'.format(job.job_id))
+        finally:
+            finished.set()
+
+    def _beat(self, job, finished):
+        while not finished.wait(heartbeat_timeout() / 3.0):
+            try:
+                job.heartbeat()
+            except Exception:
+                logger.exception('Could not keep upload job {} alive'.format(
+                    job.job_id))
@@ -1,10 +1,18 @@
 from application import app
+from application.files.clamd import (
+    CHUNK_SIZE, ClamdError, ClamdScanner, ScanCancelled)
+from flask import Request
+import hashlib
+import logging
 import mimetypes
-import os
+import shutil
 
 from subprocess import Popen, PIPE
+from tempfile import SpooledTemporaryFile
 from werkzeug.utils import secure_filename
 
+VIRUS_FOUND = 'File may contain a virus'
+
 
 class FileUploadError(IOError):
 
@@ -12,22 +20,197 @@ class FileUploadError(IOError):
         self.message = message
 
 
+class UploadSpool(SpooledTemporaryFile):
+    """A temporary file for an upload which stops storing it past a limit
+
+    Uploads smaller than spool_size are kept in memory, larger ones are
+    written to an unnamed file in directory, which is gone as soon as the
+    spool is closed or the process exits, so uploads never share a file.
+    Once `limit` bytes have been stored the rest of the upload is counted
+    but thrown away, so an oversized file never gets written out in full.
+    `size` is the number of bytes that were offered.
+
+    If given a clamd scan, everything stored is sent on to it as well, so
+    the file has been scanned by the time it has all arrived. A sha256 of
+    what was stored is kept as it arrives too.
+    """
+
+    def __init__(self, limit, spool_size=None, scan=None, directory=None):
+        if spool_size is None:
+            spool_size = app.config.get('UPLOAD_SPOOL_SIZE', 0)
+        if directory is None:
+            directory = app.config.get('UPLOAD_SPOOL_DIR')
+        SpooledTemporaryFile.__init__(self, max_size=spool_size,
+                                      prefix='upload-', dir=directory)
+        self.limit = limit
+        self.size = 0
+        self.scan = scan
+        self.digest = hashlib.sha256()
+
+    def write(self, data):
+        storable = max(0, self.limit - self.size)
+        self.size += len(data)
+        if storable:
+            stored = data[:storable]
+            SpooledTemporaryFile.write(self, stored)
+            self.digest.update(stored)
+            if self.scan is not None:
+                self._send_to_scan(stored)
+
+    def _send_to_scan(self, data):
+        try:
+            self.scan.write(data)
+        except ClamdError as e:
+            # The file is scanned once it has all arrived instead
+            logging.warning('Stopped scanning upload as it arrived: {0}'
+                            .format(e))
+            self.scan = None
+
+    def take_scan(self):
+        """Return the scan of the upload, if there is one, and let it go"""
+        scan, self.scan = self.scan, None
+        return scan
+
+    def close(self):
+        if self.scan is not None:
+            self.take_scan().abort()
+        SpooledTemporaryFile.close(self)
+
+
+class SpoolReader(object):
+    """Reads an upload's spool from a position of its own
+
+    Readers which share a lock can be used by different threads at once,
+    each reading the whole file.
+    """
+
+    def __init__(self, spool, lock):
+        self.spool = spool
+        self.lock = lock
+        self.position = 0
+
+    def read(self, size=-1):
+        with self.lock:
+            self.spool.seek(self.position)
+            data = self.spool.read(size)
+            self.position = self.spool.tell()
+        return data
+
+    def readline(self, size=-1):
+        with self.lock:
+            self.spool.seek(self.position)
+            line = self.spool.readline(size)
+            self.position = self.spool.tell()
+        return line
+
+    def seek(self, offset, whence=0):
+        with self.lock:
+            if whence == 1:
+                offset += self.position
+            elif whence == 2:
+                self.spool.seek(0, 2)
+                offset += self.spool.tell()
+        self.position = offset
+
+    def tell(self):
+        return self.position
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+
+_clamd_scanners = {}
+
+
+def clamd_scanner():
+    """Return the scanner for the configured clamd, shared by the process"""
+    address = app.config.get('CLAMD_ADDRESS')
+    if address not in _clamd_scanners:
+        _clamd_scanners[address] = ClamdScanner(
+            address,
+            timeout=app.config.get('CLAMD_TIMEOUT', 30),
+            pool_size=app.config.get('CLAMD_POOL_SIZE', 4),
+            idle_timeout=app.config.get('CLAMD_IDLE_TIMEOUT', 25))
+    return _clamd_scanners[address]
+
+
+def uses_clamd():
+    return (app.config.get('VIRUS_CHECK', False) and
+            app.config.get('VIRUS_SCANNER', 'clamdscan') == 'clamd')
+
+
+def max_file_size(data_group, data_type):
+    """Return the upload size limit for a data set, in bytes"""
+    return app.config.get('UPLOAD_MAX_FILE_SIZES', {}).get(
+        '{0}/{1}'.format(data_group, data_type),
+        UploadedFile.MAX_FILE_SIZE)
+
+
+def largest_max_file_size():
+    """Return the largest upload size limit of any data set, in bytes"""
+    return max([UploadedFile.MAX_FILE_SIZE] +
+               app.config.get('UPLOAD_MAX_FILE_SIZES', {}).values())
+
+
+class UploadRequest(Request):
+    """Spools uploaded files with the size limit of the data set in the URL
+
+    The limit is enforced as the request body is parsed, rather than after
+    the whole file has been saved. Files uploaded in bulk, which can be for
+    any data set, are held to the largest limit until each is checked
+    against its own.
+    """
+
+    def _get_file_stream(self, total_content_length, content_type,
+                         filename=None, content_length=None):
+        view_args = self.view_args or {}
+        if 'data_group' in view_args and 'data_type' in view_args:
+            limit = max_file_size(view_args['data_group'],
+                                  view_args['data_type'])
+        elif self.endpoint == 'upload_bulk':
+            limit = largest_max_file_size()
+        else:
+            limit = UploadedFile.MAX_FILE_SIZE
+
+        scan = None
+        if uses_clamd():
+            try:
+                scan = clamd_scanner().start_scan()
+            except ClamdError as e:
+                logging.warning('Not scanning upload as it arrives: {0}'
+                                .format(e))
+        return UploadSpool(limit, scan=scan)
+
+
 class UploadedFile(object):
+    """An uploaded file, held to max_file_size
+
+    A file already spooled by UploadRequest is used as it is, and is held to
+    the smaller of max_file_size and the limit it was spooled with.
+    """
 
     # This is ~ 1mb in octets
     MAX_FILE_SIZE = 1000000  # exclusive, so anything >= to this is invalid
 
-    def __init__(self, file_storage):
-        filename = os.path.join('/tmp', secure_filename(file_storage.filename))
-
-        try:
-            file_storage.save(filename)
-        except IOError as e:
-            raise FileUploadError(e.message)
+    def __init__(self, file_storage, max_file_size=None):
+        if isinstance(file_storage.stream, UploadSpool):
+            self.file = file_storage.stream
+            self.limit = min(self.file.limit,
+                             max_file_size or self.file.limit)
+        else:
+            if max_file_size is None:
+                max_file_size = self.MAX_FILE_SIZE
+            self.file = UploadSpool(max_file_size)
+            self.limit = max_file_size
+            try:
+                shutil.copyfileobj(file_storage.stream, self.file)
+            except IOError as e:
+                self.file.close()
+                raise FileUploadError(e.message)
 
-        self.filename = filename
-        self.file_size = os.path.getsize(filename)
-        self.content_type, _ = mimetypes.guess_type(filename)
+        self.filename = secure_filename(file_storage.filename)
+        self.file_size = self.file.size
+        self.content_type, _ = mimetypes.guess_type(self.filename)
 
     def __enter__(self):
         return self
@@ -35,15 +218,64 @@ class UploadedFile(object):
     def __exit__(self, type, value, traceback):
         self.cleanup()
 
-    def is_virus(self):
+    def open(self):
+        """Return the uploaded file, rewound to the start"""
+        self.file.seek(0)
+        return self.file
+
+    def content_hash(self):
+        """Return the sha256 of the upload, as hex"""
+        return self.file.digest.hexdigest()
+
+    def open_reader(self, lock):
+        """Return a reader of the upload which other threads can share
+
+        Every reader given the same lock can be read at the same time.
+        """
+        return SpoolReader(self.file, lock)
+
+    def is_virus(self, stream=None, cancelled=None):
+        """Return True if the scanner finds a virus in the upload
+
+        stream is the upload to scan, which is read from the start if not
+        given. A scan stops with ScanCancelled if the cancelled event is set.
+        """
+        if app.config.get('VIRUS_SCANNER', 'clamdscan') == 'clamd':
+            return self.is_virus_by_clamd(stream, cancelled)
+        return self.is_virus_by_clamdscan(stream, cancelled)
+
+    def is_virus_by_clamd(self, stream=None, cancelled=None):
+        scan = self.file.take_scan()
         try:
-            proc = Popen(['clamdscan', self.filename],
-                         stdout=PIPE, stderr=PIPE)
+            if scan is not None:
+                try:
+                    return scan.result()
+                except ClamdError as e:
+                    logging.warning('Scanning upload as it arrived failed, '
+                                    'scanning it again: {0}'.format(e))
+            return clamd_scanner().scan(stream or self.open(), cancelled)
+        except ClamdError as e:
+            raise FileUploadError(
+                'Error running the virus scanner: {0}'.format(e))
+
+    def is_virus_by_clamdscan(self, stream=None, cancelled=None):
+        try:
+            if stream is None:
+                # clamdscan reads the file from stdin, which moves an upload
+                # that is still in memory onto disk
+                proc = Popen(['clamdscan', '-'], stdin=self.open(),
+                             stdout=PIPE, stderr=PIPE)
+            else:
+                proc = Popen(['clamdscan', '-'], stdin=PIPE,
+                             stdout=PIPE, stderr=PIPE)
         except OSError as os_error:
             raise FileUploadError(
                 'Virus scanner is not installed'
             )
 
+        if stream is not None:
+            self._pipe_to_clamdscan(proc, stream, cancelled)
+
         _, stderr = proc.communicate()
         return_code = proc.returncode
 
@@ -56,13 +288,33 @@ class UploadedFile(object):
                 'Error running the virus scanner: {0}'.format(stderr)
             )
 
+    def _pipe_to_clamdscan(self, proc, stream, cancelled):
+        for chunk in iter(lambda: stream.read(CHUNK_SIZE), ''):
+            if cancelled is not None and cancelled.is_set():
+                proc.kill()
+                proc.communicate()
+                raise ScanCancelled()
+            try:
+                proc.stdin.write(chunk)
+            except IOError:
+                # clamdscan has stopped reading, and will say why
+                break
+
     def is_empty(self):
         return self.file_size == 0
 
     def is_too_big(self):
-        return self.file_size >= self.MAX_FILE_SIZE
+        return self.file_size >= self.limit
 
     def validate(self):
+        problems = self.validate_without_scan()
+
+        if app.config.get('VIRUS_CHECK', False) == True:
+            problems += self.scan_for_viruses()
+
+        return problems
+
+    def validate_without_scan(self):
         problems = []
 
         if self.is_empty():
@@ -71,15 +323,16 @@ class UploadedFile(object):
         if self.is_too_big():
             problems.append('File is too big ({0})'.format(self.file_size))
 
-        if app.config.get('VIRUS_CHECK', False) == True:
-            try:
-                if self.is_virus():
-                    problems.append('File may contain a virus')
-            except FileUploadError as upload_err:
-                problems.append(upload_err.message)
-
         return problems
 
+    def scan_for_viruses(self, stream=None, cancelled=None):
+        """Return the problems found by scanning the upload for viruses"""
+        try:
+            if self.is_virus(stream, cancelled):
+                return [VIRUS_FOUND]
+        except FileUploadError as upload_err:
+            return [upload_err.message]
+        return []
+
     def cleanup(self):
-        if os.path.isfile(self.filename):
-            os.remove(self.filename)
+        self.file.close()
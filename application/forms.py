@@ -45,7 +45,8 @@ def flatten_modules(modules, module_types):
 
 
 def convert_to_dashboard_form(
-        dashboard_dict, admin_client, module_types, data_sources):
+        dashboard_dict, admin_client, module_types, data_sources,
+        organisation_choices=None):
 
     dashboard_dict['modules'] = flatten_modules(
         dashboard_dict['modules'],
@@ -68,7 +69,8 @@ def convert_to_dashboard_form(
     return DashboardCreationForm(admin_client,
                                  module_types,
                                  data_sources,
-                                 data=dashboard_dict)
+                                 data=dashboard_dict,
+                                 organisation_choices=organisation_choices)
 
 
 class ModuleTypes():
@@ -165,9 +167,12 @@ class DashboardCreationForm(Form):
 
     def __init__(
             self, admin_client, module_types, data_sources,  *args, **kwargs):
+        # Choices already fetched with get_organisation_choices, if any
+        organisation_choices = kwargs.pop('organisation_choices', None)
         super(DashboardCreationForm, self).__init__(*args, **kwargs)
-        self.owning_organisation.choices = get_organisation_choices(
-            admin_client)
+        if organisation_choices is None:
+            organisation_choices = get_organisation_choices(admin_client)
+        self.owning_organisation.choices = organisation_choices
         for m in self.modules:
             m.module_type.choices = module_types.get_visualisation_choices()
             m.data_group.choices = data_sources.group_choices()
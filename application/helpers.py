@@ -2,17 +2,21 @@ import random
 import string
 from werkzeug.utils import redirect
 from application import app
+from application.files.pools import LazyThreadPool
+from application.stagecraft import stagecraft_client
+from application.token_cache import token_cache
 from collections import defaultdict
 from flask import abort, session, redirect, request, url_for, flash
 from functools import wraps
 from os import getenv
-from performanceplatform.client.admin import AdminAPI
 from requests_oauthlib import OAuth2Session
 from requests import Timeout, ConnectionError
 
 
 environment = app.config.get('ENVIRONMENT', 'development')
 
+_prefetch_pool = LazyThreadPool('STAGECRAFT_PREFETCH_WORKERS', 8)
+
 
 @app.context_processor
 def view_helpers():
@@ -93,8 +97,7 @@ def api_permission_required(permission=None):
 
 
 def get_admin_client(session):
-    return AdminAPI(app.config['STAGECRAFT_HOST'],
-                    session['oauth_token']['access_token'])
+    return stagecraft_client(session['oauth_token']['access_token'])
 
 
 def base_template_context():
@@ -160,6 +163,13 @@ def _get_valid_token(auth_header):
 
 
 def _get_user(token):
+    cache = token_cache()
+    cached = cache.find(token) if cache is not None else None
+    if cached is not None:
+        if cached.user is None:
+            abort(cached.status, cached.reason)
+        return cached.user
+
     gds_session = OAuth2Session(
         app.config['SIGNON_OAUTH_ID'],
         token={'access_token': token, 'type': 'Bearer'},
@@ -170,11 +180,28 @@ def _get_user(token):
     except (Timeout, ConnectionError):
         abort(500, 'Error connecting to signon service')
     if str(user_request.status_code)[0] in ('4', '5'):
+        # Only signon rejecting the token itself is worth remembering
+        if cache is not None and user_request.status_code in (401, 403):
+            cache.store_rejected(token, user_request.status_code,
+                                 user_request.reason)
         abort(user_request.status_code, user_request.reason)
     try:
-        return user_request.json()
+        user = user_request.json()
     except ValueError:
         abort(500, 'Unable to parse signon json')
+    if cache is not None and user is not None:
+        cache.store(token, user)
+    return user
+
+
+def prefetch(*calls):
+    """Start each call, a function followed by its arguments, on a pool of
+    threads and return their results, to get(), in the same order
+
+    Calls which do not depend on each other then take as long as the
+    slowest of them, rather than all of them added together.
+    """
+    return [_prefetch_pool.apply_async(call[0], call[1:]) for call in calls]
 
 
 def to_error_list(form_errors):
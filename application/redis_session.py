@@ -1,65 +1,285 @@
+from base64 import b64decode, b64encode
+import json
 import pickle
-from datetime import timedelta
+import time
+import zlib
+from datetime import datetime, timedelta
 from uuid import uuid4
+import msgpack
+import pytz
 from redis import Redis
+from redis.client import Script
 from werkzeug.datastructures import CallbackDict
-from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.local import LocalProxy
+from flask.sessions import NullSession, SessionInterface, SessionMixin
 import logging
 # see http://flask.pocoo.org/snippets/75/
 
 
+def _tag(value):
+    """Turn a session value into one which JSON and msgpack can hold
+
+    Tuples, datetimes and byte strings which are not text are tagged, as
+    Flask's own session serializer does, so they load as they were stored.
+
+    >>> _tag({'flashes': [('info', 'Saved')]})
+    {'flashes': [{' t': [u'info', u'Saved']}]}
+    >>> _tag('\\xff')
+    {' b': '/w=='}
+    """
+    if isinstance(value, tuple):
+        return {' t': [_tag(item) for item in value]}
+    elif isinstance(value, list):
+        return [_tag(item) for item in value]
+    elif isinstance(value, dict):
+        return dict((key, _tag(item)) for key, item in value.iteritems())
+    elif isinstance(value, datetime):
+        return {' d': value.isoformat()}
+    elif isinstance(value, str):
+        try:
+            return value.decode('utf-8')
+        except UnicodeDecodeError:
+            return {' b': b64encode(value)}
+    return value
+
+
+def _untag(obj):
+    if len(obj) != 1:
+        return obj
+    tag, value = next(obj.iteritems())
+    if tag == ' t':
+        return tuple(value)
+    elif tag == ' d':
+        return _untag_datetime(value)
+    elif tag == ' b':
+        return b64decode(value)
+    return obj
+
+
+def _untag_datetime(value):
+    """Read a datetime stored with isoformat(), with its UTC offset if any
+
+    >>> _untag_datetime('2014-05-01T12:30:05.000250+01:00').utcoffset()
+    datetime.timedelta(0, 3600)
+    >>> _untag_datetime('2014-05-01T12:30:05').tzinfo is None
+    True
+    """
+    tzinfo = None
+    if value[-6] in '+-':
+        minutes = int(value[-5:-3]) * 60 + int(value[-2:])
+        tzinfo = pytz.FixedOffset(-minutes if value[-6] == '-' else minutes)
+        value = value[:-6]
+    parsed = datetime.strptime(
+        value, '%Y-%m-%dT%H:%M:%S.%f' if '.' in value
+        else '%Y-%m-%dT%H:%M:%S')
+    return parsed.replace(tzinfo=tzinfo)
+
+
+def _untag_all(value):
+    if isinstance(value, dict):
+        return _untag(dict(
+            (key, _untag_all(item)) for key, item in value.iteritems()))
+    elif isinstance(value, list):
+        return [_untag_all(item) for item in value]
+    return value
+
+
+class CompactSerializer(object):
+    """Stores sessions as JSON or msgpack, compressed once they are large
+
+    Each stored session starts with a byte saying how it was stored, which
+    pickle never starts with, so sessions pickled before this was used, or
+    stored in another format, are still read.
+
+    >>> serializer = CompactSerializer('json', compress_over=100)
+    >>> serializer.dumps({'user': 'foo'})
+    '\\x01{"user":"foo"}'
+    >>> len(serializer.dumps({'user': 'foo' * 100})) < 100
+    True
+    >>> serializer.loads(pickle.dumps({'user': 'foo'}))
+    {'user': 'foo'}
+    """
+
+    JSON = '\x01'
+    JSON_ZLIB = '\x02'
+    MSGPACK = '\x03'
+    MSGPACK_ZLIB = '\x04'
+
+    def __init__(self, format='json', compress_over=None):
+        if format not in ('json', 'msgpack'):
+            raise ValueError(
+                'Unknown session serializer "{0}"'.format(format))
+        self.format = format
+        self.compress_over = compress_over
+
+    def dumps(self, session):
+        if self.format == 'msgpack':
+            marker, compressed_marker = self.MSGPACK, self.MSGPACK_ZLIB
+            body = msgpack.packb(_tag(session), use_bin_type=True)
+        else:
+            marker, compressed_marker = self.JSON, self.JSON_ZLIB
+            body = json.dumps(_tag(session), separators=(',', ':'))
+
+        if self.compress_over is not None and len(body) > self.compress_over:
+            compressed = zlib.compress(body)
+            if len(compressed) < len(body):
+                return compressed_marker + compressed
+        return marker + body
+
+    def loads(self, value):
+        marker, body = value[:1], value[1:]
+        if marker in (self.JSON_ZLIB, self.MSGPACK_ZLIB):
+            body = zlib.decompress(body)
+
+        if marker in (self.JSON, self.JSON_ZLIB):
+            return json.loads(body, object_hook=_untag)
+        elif marker in (self.MSGPACK, self.MSGPACK_ZLIB):
+            return _untag_all(msgpack.unpackb(body, raw=False))
+        return pickle.loads(value)
+
+
+def session_serializer(config):
+    """Return the serializer for sessions chosen by SESSION_SERIALIZER"""
+    name = config.get('SESSION_SERIALIZER', 'json')
+    if name == 'pickle':
+        return pickle
+    return CompactSerializer(name,
+                             config.get('SESSION_COMPRESS_OVER', 1024))
+
+
+# Deletes every session in the set KEYS[1], whose keys are ARGV[1] followed
+# by the session id, and then the set itself
+DELETE_USER_SESSIONS = """
+local sids = redis.call('ZRANGE', KEYS[1], 0, -1)
+for i = 1, #sids, 500 do
+    local keys = {}
+    for j = i, math.min(i + 499, #sids) do
+        keys[#keys + 1] = ARGV[1] .. sids[j]
+    end
+    redis.call('DEL', unpack(keys))
+end
+redis.call('DEL', KEYS[1])
+return #sids
+"""
+# Shared so that, once loaded, the script is run by its hash alone
+_delete_user_sessions = Script(None, DELETE_USER_SESSIONS)
+
+# Adds the session id ARGV[1] to the set KEYS[1], to expire at ARGV[2],
+# removes those which expired by ARGV[3], and keeps the set for at least
+# ARGV[4] seconds, without cutting short a longer expiry it already has
+INDEX_USER_SESSION = """
+redis.call('ZADD', KEYS[1], ARGV[2], ARGV[1])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[3])
+if redis.call('TTL', KEYS[1]) < tonumber(ARGV[4]) then
+    redis.call('EXPIRE', KEYS[1], ARGV[4])
+end
+"""
+_index_user_session = Script(None, INDEX_USER_SESSION)
+
+
 class RedisSession(CallbackDict, SessionMixin):
 
     def __init__(
-            self, redis=None, initial=None, sid=None, new=False, prefix=''):
+            self, redis=None, initial=None, sid=None, new=False, prefix='',
+            ttl=None):
         def on_update(self):
             self.modified = True
         CallbackDict.__init__(self, initial, on_update)
         self.sid = sid
         self.new = new
         self.modified = False
+        # Seconds the stored session had left when it was opened
+        self.ttl = ttl
         self.redis = redis
         self.logger = logging.getLogger(__name__)
         self.prefix = prefix
 
-    def store_session_for_user(self, uid):
+    def user_sessions_key(self, uid):
+        return '{}user_sessions:{}'.format(self.prefix, uid)
+
+    def store_session_for_user(self, uid, expires_in, pipe=None):
         """ Associate the current session with the given uid
 
-        Used for later destroying those sessions when reauthing with signon
+        Used for later destroying those sessions when reauthing with signon.
+        Each session is kept in a sorted set by when it expires, and those
+        which have expired are removed as another is stored. The set is
+        kept at least as long as the session, and as long as any other.
         uid - a signon user_id
+        expires_in - seconds until the session expires
+        pipe - a pipeline to add the commands to, instead of running them
         """
         self.logger.debug(
             'saving session id {} for user {} to redis'.format(self.sid, uid)
         )
-        self.redis.lpush(
-            '{}user_sessions:{}'.format(self.prefix, uid),
-            self.sid,
-        )
+        now = time.time()
+        _index_user_session(
+            keys=[self.user_sessions_key(uid)],
+            args=[self.sid, now + expires_in, now, expires_in],
+            client=self.redis if pipe is None else pipe)
 
     def delete_sessions_for_user(self, uid):
         """ Delete all sessions for a user with given uid
 
+        The sessions and the set of them are deleted by one script, in a
+        single round trip to redis however many sessions the user has.
         uid - a signon user_id
         """
         self.logger.debug('deleting sessions for {}'.format(uid))
-        session_ids = self.redis.lrange(
-            '{}user_sessions:{}'.format(self.prefix, uid),
-            0,
-            1
-        )
-        for sid in session_ids:
-            self.logger.debug('signing out {}'.format(sid))
-            self.redis.delete('{}{}'.format(self.prefix, sid))
+        deleted = _delete_user_sessions(
+            keys=[self.user_sessions_key(uid)], args=[self.prefix],
+            client=self.redis)
+        self.logger.debug('signed out {} sessions'.format(deleted))
+
+
+class _SessionLoader(object):
+
+    def __init__(self, load):
+        self.load = load
+        self.session = None
+
+    def __call__(self):
+        if self.session is None:
+            self.session = self.load()
+        return self.session
+
+
+class LazySession(LocalProxy):
+    """A session which is only read from redis when it is first used
+
+    It behaves exactly as the session it stands for, which load returns.
+    """
+    __slots__ = ()
+
+    def __init__(self, load):
+        LocalProxy.__init__(self, _SessionLoader(load))
+
+    @property
+    def loaded_session(self):
+        """The session if it has been read, otherwise None"""
+        return self._LocalProxy__local.session
+
+
+class SkippedSession(NullSession):
+    """The empty session of a route which never reads the stored one"""
+
+    def _fail(self, *args, **kwargs):
+        raise RuntimeError('the session is unavailable to this route, as it '
+                           'is in SESSION_SKIP_ENDPOINTS.')
+    __setitem__ = __delitem__ = clear = pop = popitem = \
+        update = setdefault = _fail
+    del _fail
 
 
 class RedisSessionInterface(SessionInterface):
-    serializer = pickle
+    serializer = CompactSerializer()
     session_class = RedisSession
 
-    def __init__(self, redis=None, prefix=''):
+    def __init__(self, redis=None, prefix='', serializer=None):
         if redis is None:
             redis = Redis()
         self.redis = redis
+        if serializer is not None:
+            self.serializer = serializer
         self.prefix = prefix + 'session:'
 
     def generate_sid(self):
@@ -72,32 +292,84 @@ class RedisSessionInterface(SessionInterface):
         return timedelta(hours=2)
 
     def open_session(self, app, request):
+        if request.endpoint in app.config.get('SESSION_SKIP_ENDPOINTS', []):
+            return SkippedSession()
         sid = request.cookies.get(app.session_cookie_name)
         if not sid:
             sid = self.generate_sid()
             return self.session_class(
                 redis=self.redis, sid=sid, new=True, prefix=self.prefix)
-        val = self.redis.get(self.prefix + sid)
+        return LazySession(lambda: self.load_session(sid))
+
+    def load_session(self, sid):
+        pipe = self.redis.pipeline()
+        pipe.get(self.prefix + sid)
+        pipe.ttl(self.prefix + sid)
+        val, ttl = pipe.execute()
         if val is not None:
             data = self.serializer.loads(val)
             return self.session_class(
-                redis=self.redis, initial=data, sid=sid, prefix=self.prefix)
+                redis=self.redis, initial=data, sid=sid, prefix=self.prefix,
+                ttl=ttl)
         return self.session_class(
             redis=self.redis, sid=sid, new=True, prefix=self.prefix)
 
     def save_session(self, app, session, response):
+        if isinstance(session, LazySession):
+            # A session which was never read cannot have changed
+            if session.loaded_session is None:
+                return
+            session = session.loaded_session
         domain = self.get_cookie_domain(app)
         if not session:
-            self.redis.delete(self.prefix + session.sid)
+            if not session.new:
+                self.redis.delete(self.prefix + session.sid)
             if session.modified:
                 response.delete_cookie(app.session_cookie_name,
                                        domain=domain)
             return
-        redis_exp = self.get_redis_expiration_time(app, session)
+        redis_exp = int(
+            self.get_redis_expiration_time(app, session).total_seconds())
         cookie_exp = self.get_expiration_time(app, session)
+
+        if not session.new and not session.modified:
+            if not self.needs_refresh(app, session, redis_exp):
+                return
+            # An unchanged session only needs its expiry moved, unless it
+            # expired since it was opened
+            pipe = self.redis.pipeline()
+            pipe.expire(self.prefix + session.sid, redis_exp)
+            self.index_session(session, redis_exp, pipe)
+            if pipe.execute()[0]:
+                if cookie_exp is not None:
+                    response.set_cookie(app.session_cookie_name, session.sid,
+                                        expires=cookie_exp, httponly=True,
+                                        domain=domain)
+                return
+
         val = self.serializer.dumps(dict(session))
-        self.redis.setex(self.prefix + session.sid, val,
-                         int(redis_exp.total_seconds()))
+        pipe = self.redis.pipeline()
+        pipe.setex(self.prefix + session.sid, val, redis_exp)
+        self.index_session(session, redis_exp, pipe)
+        pipe.execute()
         response.set_cookie(app.session_cookie_name, session.sid,
                             expires=cookie_exp, httponly=True,
                             domain=domain)
+
+    def index_session(self, session, expires_in, pipe):
+        """Keep a signed in session in its user's set of sessions for as long
+        as the session itself, so that reauth can find it"""
+        user = session.get('oauth_user') or {}
+        if user.get('uid'):
+            session.store_session_for_user(user['uid'], expires_in, pipe)
+
+    def needs_refresh(self, app, session, redis_exp):
+        """Whether an unchanged session's expiry is due to be moved on
+
+        It is moved once SESSION_REFRESH_INTERVAL seconds have passed since
+        it last was, rather than on every request.
+        """
+        if session.ttl is None:
+            return True
+        interval = app.config.get('SESSION_REFRESH_INTERVAL', 60)
+        return redis_exp - session.ttl >= interval
@@ -0,0 +1,112 @@
+import hashlib
+import json
+import logging
+import time
+
+from application import app
+from application.files.pools import LazyThreadPool
+
+
+logger = logging.getLogger(__name__)
+
+_refresh_pool = LazyThreadPool('STAGECRAFT_CACHE_WORKERS', 2)
+
+
+class ReferenceCache(object):
+    """Stagecraft's reference data, such as its module types, kept in redis
+
+    Each resource is fresh for its ttl in seconds. For stale_for seconds
+    after that it is still returned, while one process fetches it again in
+    the background. A resource can be cached separately for each scope,
+    such as the token it was fetched with. A scoped resource is fetched
+    again as soon as it is stale instead, so that a token which stagecraft
+    no longer accepts is refused. Invalidating a resource forgets it in
+    every scope.
+    """
+
+    PREFIX = 'performanceplatform_admin:reference:'
+    # Seconds a process has to fetch a stale resource before another may
+    REFRESH_TIMEOUT = 30
+
+    def __init__(self, redis, ttls, stale_for):
+        self.redis = redis
+        self.ttls = ttls
+        self.stale_for = stale_for
+
+    def key(self, resource, scope=''):
+        return '{0}{1}:{2}'.format(self.PREFIX, resource, scope)
+
+    def generation_key(self, resource):
+        return '{0}{1}:generation'.format(self.PREFIX, resource)
+
+    def fetch(self, resource, load, scope=''):
+        """Return the resource, calling load for it when it is not cached"""
+        key = self.key(resource, scope)
+        pipe = self.redis.pipeline()
+        pipe.get(key)
+        pipe.get(self.generation_key(resource))
+        stored, generation = pipe.execute()
+        generation = int(generation or 0)
+
+        if stored is not None:
+            entry = json.loads(stored)
+            age = time.time() - entry['fetched_at']
+            stale = age >= self.ttls[resource]
+            if entry['generation'] == generation and not (stale and scope):
+                if stale and self.redis.set(key + ':refreshing', 1, nx=True,
+                                            ex=self.REFRESH_TIMEOUT):
+                    _refresh_pool.apply_async(
+                        self._refresh_in_background,
+                        (resource, key, generation, load))
+                return entry['value']
+
+        return self._refresh(resource, key, generation, load)
+
+    def invalidate(self, resource):
+        """Forget the resource in every scope, as it has changed"""
+        self.redis.incr(self.generation_key(resource))
+
+    def forget(self, resource, scope):
+        """Forget the resource in one scope, such as a token now refused"""
+        self.redis.delete(self.key(resource, scope))
+
+    def _refresh(self, resource, key, generation, load):
+        value = load()
+        self.redis.setex(key, json.dumps({
+            'generation': generation,
+            'fetched_at': time.time(),
+            'value': value,
+        }), self.ttls[resource] + self.stale_for)
+        return value
+
+    def _refresh_in_background(self, resource, key, generation, load):
+        try:
+            self._refresh(resource, key, generation, load)
+        except Exception:
+            logger.exception('Could not refresh {0}'.format(key))
+        finally:
+            self.redis.delete(key + ':refreshing')
+
+
+def token_scope(token):
+    """The scope of a resource which stagecraft filters by its caller
+
+    >>> token_scope(None)
+    ''
+    >>> len(token_scope('abc'))
+    64
+    """
+    return hashlib.sha256(token).hexdigest() if token else ''
+
+
+def reference_cache():
+    """Return the cache of stagecraft's reference data, or None if it is
+    switched off"""
+    if not app.config.get('STAGECRAFT_CACHE', False):
+        return None
+    ttls = {'module-types': 60 * 60, 'organisations': 60 * 60,
+            'data-sets': 5 * 60}
+    ttls.update(app.config.get('STAGECRAFT_CACHE_TTLS', {}))
+    return ReferenceCache(app.redis_instance, ttls,
+                          app.config.get('STAGECRAFT_CACHE_STALE_FOR',
+                                         60 * 60))
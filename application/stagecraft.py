@@ -0,0 +1,218 @@
+import cookielib
+import json
+import threading
+
+from performanceplatform.client import base as client_base
+from performanceplatform.client.admin import AdminAPI
+import requests
+from requests.adapters import HTTPAdapter
+
+from application import app
+from application.reference_cache import reference_cache, token_scope
+
+
+class CountingAdapter(HTTPAdapter):
+    """An HTTPAdapter which counts the requests it sends and the connections
+    it opens for them"""
+
+    def __init__(self, **kwargs):
+        self.counts_lock = threading.Lock()
+        self.requests_sent = 0
+        self.connections_opened = 0
+        super(CountingAdapter, self).__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        with self.counts_lock:
+            self.requests_sent += 1
+        return super(CountingAdapter, self).send(request, **kwargs)
+
+    def get_connection(self, url, proxies=None):
+        pool = super(CountingAdapter, self).get_connection(url, proxies)
+        if not getattr(pool.ConnectionCls, 'counted', False):
+            pool.ConnectionCls = self._counted(pool.ConnectionCls)
+        return pool
+
+    def _counted(self, connection_class):
+        adapter = self
+
+        class CountedConnection(connection_class):
+            counted = True
+
+            def connect(self):
+                with adapter.counts_lock:
+                    adapter.connections_opened += 1
+                return connection_class.connect(self)
+
+        return CountedConnection
+
+
+class StagecraftPool(object):
+    """Keep-alive connections to stagecraft, shared by the whole process
+
+    The session is only made when it is first used, so each process that
+    forks from the app gets its own. It never keeps cookies, as it is shared
+    by every user's requests.
+    """
+
+    def __init__(self):
+        self.session = None
+        self.lock = threading.Lock()
+        self.next_stats_log = None
+
+    def get_session(self):
+        with self.lock:
+            if self.session is None:
+                self.session = self._make_session()
+        return self.session
+
+    def _make_session(self):
+        session = requests.Session()
+        session.cookies.set_policy(
+            cookielib.DefaultCookiePolicy(allowed_domains=[]))
+        adapter = CountingAdapter(
+            pool_connections=1,
+            pool_maxsize=app.config.get('STAGECRAFT_POOL_SIZE', 10))
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        if not app.config.get('STAGECRAFT_KEEP_ALIVE', True):
+            session.headers['Connection'] = 'close'
+        return session
+
+    def timeout(self):
+        return (app.config.get('STAGECRAFT_CONNECT_TIMEOUT', 5),
+                app.config.get('STAGECRAFT_READ_TIMEOUT', 60))
+
+    def stats(self):
+        """How many requests have been sent and connections opened"""
+        requests_sent = connections = 0
+        if self.session is not None:
+            for adapter in set(self.session.adapters.values()):
+                requests_sent += adapter.requests_sent
+                connections += adapter.connections_opened
+        return {
+            'requests': requests_sent,
+            'connections': connections,
+            'reused': max(requests_sent - connections, 0),
+        }
+
+    def log_stats_if_due(self):
+        """Log the stats every STAGECRAFT_STATS_LOG_INTERVAL requests"""
+        interval = app.config.get('STAGECRAFT_STATS_LOG_INTERVAL', 1000)
+        if not interval:
+            return
+        stats = self.stats()
+        with self.lock:
+            if self.next_stats_log is None:
+                self.next_stats_log = interval
+            if stats['requests'] < self.next_stats_log:
+                return
+            while self.next_stats_log <= stats['requests']:
+                self.next_stats_log += interval
+        app.logger.info(
+            'Stagecraft connections: {requests} requests, {connections} '
+            'connections opened, {reused} reused'.format(**stats))
+
+
+_pool = StagecraftPool()
+
+
+class PooledAdminAPI(AdminAPI):
+    """An AdminAPI which sends its requests over the process's connections
+    to stagecraft, with the token it was made with"""
+
+    def __init__(self, base_url, token, pool=None, **kwargs):
+        super(PooledAdminAPI, self).__init__(base_url, token, **kwargs)
+        self.pool = pool or _pool
+
+    def list_module_types(self):
+        return self._cached('module-types',
+                            super(PooledAdminAPI, self).list_module_types)
+
+    def list_organisations(self, query=None):
+        load = super(PooledAdminAPI, self).list_organisations
+        return self._cached('organisations', lambda: load(query),
+                            json.dumps(query, sort_keys=True))
+
+    def list_data_sets(self):
+        # Stagecraft only lists the data sets the token's user can see
+        return self._cached('data-sets',
+                            super(PooledAdminAPI, self).list_data_sets,
+                            token_scope(self.token))
+
+    def create_data_set(self, data):
+        created = super(PooledAdminAPI, self).create_data_set(data)
+        self._invalidate('data-sets')
+        return created
+
+    def create_data_group(self, data):
+        created = super(PooledAdminAPI, self).create_data_group(data)
+        self._invalidate('data-sets')
+        return created
+
+    def add_module_type(self, data):
+        added = super(PooledAdminAPI, self).add_module_type(data)
+        self._invalidate('module-types')
+        return added
+
+    def _cached(self, resource, load, scope=''):
+        cache = reference_cache()
+        if cache is None:
+            return load()
+        return cache.fetch(resource, load, scope)
+
+    def _invalidate(self, resource):
+        cache = reference_cache()
+        if cache is not None:
+            cache.invalidate(resource)
+
+    def _forget(self, resource, scope):
+        cache = reference_cache()
+        if cache is not None:
+            cache.forget(resource, scope)
+
+    def _request(self, method, path, data=None, params=None):
+        # As BaseClient._request, which sends with requests.request and so
+        # opens a connection every time, but over the pool's session
+        if self.dry_run:
+            return super(PooledAdminAPI, self)._request(
+                method, path, data=data, params=params)
+
+        headers = {
+            'Accept': 'application/json',
+            'User-Agent': 'Performance Platform Client {}'.format(
+                self.get_version()),
+            'Govuk-Request-Id': self._request_id_fn(),
+        }
+        if self.token is not None:
+            headers['Authorization'] = 'Bearer ' + self.token
+        if data is not None:
+            headers['Content-Type'] = 'application/json'
+            if not isinstance(data, str):
+                data = client_base._encode_json(data)
+            headers, data = client_base._gzip_payload(
+                headers, data, self.should_gzip)
+
+        send = self.pool.get_session().request
+        if self.retry_on_error:
+            send = client_base._exponential_backoff(send)
+        response = send(method=method, url=self.base_url + path,
+                        headers=headers, data=data, params=params,
+                        timeout=self.pool.timeout())
+        self.pool.log_stats_if_due()
+
+        try:
+            response.raise_for_status()
+        except requests.HTTPError:
+            client_base.log.error('[PP-C] {}'.format(response.text))
+            if response.status_code == 401:
+                self._forget('data-sets', token_scope(self.token))
+            raise
+
+        if response.status_code != 204:
+            return response.json()
+        return None
+
+
+def stagecraft_client(token):
+    """Return a client for stagecraft which sends the given bearer token"""
+    return PooledAdminAPI(app.config['STAGECRAFT_HOST'], token)
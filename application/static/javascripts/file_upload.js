@@ -18,7 +18,10 @@
       }
 
       if (message.payload) {
-        if (message.payload.length) {
+        if (message.unchanged) {
+          addToList('This file is the same as the last one uploaded to ' +
+              message.data_type + ', so it was not sent again.');
+        } else if (message.payload.length) {
           addToList('Failed to upload to ' + message.data_type + '. Please refresh the page to try again:');
           for (var i = 0; i < message.payload.length; i++) {
             addToList(message.payload[i]);
@@ -37,11 +40,46 @@
   }
 
 
+  // Uploads handled by a background job return its status url instead of
+  // the result, which is polled until the job has finished
+  function waitForJob(dropzone, file, message) {
+    if (!message.status_url) {
+      return false;
+    }
+
+    $(file.previewElement)
+      .parent()
+      .find('.dz-message')
+      .text('Uploading ' + file.name + '... ' +
+            (message.rows ? message.rows + ' rows so far' : ''));
+
+    setTimeout(function () {
+      $.ajax({
+        url: message.status_url,
+        dataType: 'json',
+        headers: { 'Accept': 'application/json' }
+      }).done(function (status) {
+        if (!waitForJob(dropzone, file, status)) {
+          setMessage('success').call(dropzone, file, status);
+        }
+      }).fail(function (xhr) {
+        setMessage('error').call(dropzone, file,
+                                 xhr.responseJSON || xhr.statusText);
+      });
+    }, 2000);
+
+    return true;
+  }
+
   window.Dropzone.prototype.defaultOptions['maxFiles'] = 1;
   window.Dropzone.prototype.defaultOptions['previewTemplate'] = '<div></div>';
   window.Dropzone.prototype.defaultOptions['init'] = function() {
     this.on("error", setMessage('error'));
-    this.on("success", setMessage('success'));
+    this.on("success", function (file, message) {
+      if (!waitForJob(this, file, message)) {
+        setMessage('success').call(this, file, message);
+      }
+    });
     this.on("sending", function(file) {
       $(file.previewElement)
         .parent()
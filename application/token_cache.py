@@ -0,0 +1,90 @@
+from collections import namedtuple, OrderedDict
+import hashlib
+import json
+import threading
+import time
+
+from application import app
+
+
+# What signon answered for a token: the user it belongs to, or, if it was
+# rejected, the status and reason signon gave
+CachedToken = namedtuple('CachedToken', ['user', 'status', 'reason'])
+
+
+class TokenCache(object):
+    """Who signon said each bearer token belongs to, kept for a short while
+
+    Answers are kept in the process, in a cache of at most max_size tokens
+    which forgets the least recently used first, and in redis so that other
+    processes need not ask signon again. Users are kept for ttl seconds and
+    rejected tokens for invalid_ttl. Tokens are only stored as a hash.
+    """
+
+    PREFIX = 'performanceplatform_admin:signon_tokens:'
+
+    def __init__(self, redis, ttl, invalid_ttl, max_size):
+        self.redis = redis
+        self.ttl = ttl
+        self.invalid_ttl = invalid_ttl
+        self.max_size = max_size
+        # Hashed token to when it expires and its CachedToken
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def key(self, token):
+        return self.PREFIX + hashlib.sha256(token).hexdigest()
+
+    def find(self, token):
+        """Return the CachedToken for the token, or None"""
+        key = self.key(token)
+        now = time.time()
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None and entry[0] > now:
+                self.entries[key] = entry
+                return entry[1]
+
+        pipe = self.redis.pipeline()
+        pipe.get(key)
+        pipe.ttl(key)
+        stored, ttl = pipe.execute()
+        if stored is None:
+            return None
+        cached = CachedToken(*json.loads(stored))
+        self._remember(key, cached, now + (ttl or 0))
+        return cached
+
+    def store(self, token, user):
+        self._store(token, CachedToken(user, None, None), self.ttl)
+
+    def store_rejected(self, token, status, reason):
+        self._store(token, CachedToken(None, status, reason),
+                    self.invalid_ttl)
+
+    def _store(self, token, cached, ttl):
+        key = self.key(token)
+        self.redis.setex(key, json.dumps(cached), ttl)
+        self._remember(key, cached, time.time() + ttl)
+
+    def _remember(self, key, cached, expires_at):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (expires_at, cached)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+
+_token_caches = {}
+
+
+def token_cache():
+    """Return the process's cache of signon tokens, or None if it is off"""
+    if not app.config.get('SIGNON_TOKEN_CACHE', False):
+        return None
+    settings = (app.config.get('SIGNON_TOKEN_CACHE_TTL', 60),
+                app.config.get('SIGNON_INVALID_TOKEN_CACHE_TTL', 10),
+                app.config.get('SIGNON_TOKEN_CACHE_SIZE', 1000))
+    if settings not in _token_caches:
+        _token_caches[settings] = TokenCache(app.redis_instance, *settings)
+    return _token_caches[settings]
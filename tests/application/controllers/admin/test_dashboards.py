@@ -901,6 +901,39 @@ class DashboardTestCase(FlaskAppTestCase):
         assert_that(kwargs['form'], instance_of(DashboardCreationForm))
         assert_that(resp.status_code, equal_to(200))
 
+    @patch("performanceplatform.client.admin.AdminAPI.get_dashboard")
+    @patch("application.controllers.admin.dashboards.render_template")
+    def test_edit_page_fetches_each_of_its_sources_once(
+            self,
+            mock_render,
+            mock_get,
+            mock_list_organisations,
+            mock_list_data_sets,
+            mock_list_module_types):
+        with open(os.path.join(
+                  os.path.dirname(__file__),
+                  '../../../fixtures/example-dashboard.json')) as file:
+            dashboard_dict = json.loads(file.read())
+        mock_render.return_value = ''
+        mock_get.return_value = dashboard_dict
+        with self.client.session_transaction() as session:
+            session['oauth_token'] = {'access_token': 'token'}
+            session['oauth_user'] = {
+                'permissions': ['signin', 'admin']
+            }
+
+        resp = self.client.get('/admin/dashboards/uuid')
+
+        assert_that(resp.status_code, equal_to(200))
+        mock_get.assert_called_once_with('uuid')
+        assert_that(mock_list_organisations.call_count, equal_to(1))
+        assert_that(mock_list_data_sets.call_count, equal_to(1))
+        assert_that(mock_list_module_types.call_count, equal_to(1))
+        form = mock_render.call_args[1]['form']
+        assert_that(form.owning_organisation.choices[1:], equal_to(
+            [(org['id'], org['name']) for org in
+             sorted(organisations_list(), key=lambda org: org['name'])]))
+
     @patch("performanceplatform.client.admin.AdminAPI.get_dashboard")
     @patch("application.controllers.admin.dashboards.render_template")
     def test_clone_dashboard_renders_a_prefilled_create_page(
@@ -1,3 +1,5 @@
+from contextlib import contextmanager
+
 from mock import patch, Mock
 from nose.tools import assert_equal
 from hamcrest import assert_that, equal_to, ends_with, contains_string
@@ -9,6 +11,7 @@ from tests.application.support.flask_app_test_case import(
 from application import app
 from application.controllers.authentication import get_authorization_url
 from application.redis_session import RedisSession
+from application.token_cache import _token_caches, TokenCache
 from requests import ConnectionError, Timeout
 from performanceplatform.client.admin import AdminAPI
 
@@ -229,6 +232,65 @@ class SignonCallbacksTestCase(FlaskAppTestCase):
         response = self.do_reauth_post()
         self.assertEqual(401, response.status_code, response.data)
 
+    def test_reauth_burst_asks_signon_about_the_token_once(
+            self,
+            session_delete_sessions_for_user_patch,
+            oauth_get_patch,
+            reauth_patch):
+        self.mock_signon_json(
+            oauth_get_patch).return_value = self.allowed_user_update_json()
+        oauth_get_patch.return_value.status_code = 200
+
+        with self.token_cache():
+            for _ in range(3):
+                response = self.do_reauth_post()
+                self.assertEqual(200, response.status_code, response.data)
+
+        assert_that(oauth_get_patch.call_count, equal_to(1))
+        assert_that(reauth_patch.call_count, equal_to(3))
+
+    def test_rejected_token_is_not_checked_again(
+            self,
+            session_delete_sessions_for_user_patch,
+            oauth_get_patch,
+            reauth_patch):
+        oauth_get_patch.return_value.status_code = 401
+        oauth_get_patch.return_value.reason = 'Unauthorized'
+        self.expected_unused(reauth_patch)
+
+        with self.token_cache():
+            for _ in range(2):
+                response = self.do_reauth_post()
+                self.assertEqual(401, response.status_code, response.data)
+
+        assert_that(oauth_get_patch.call_count, equal_to(1))
+
+    def test_signon_being_down_is_not_remembered(
+            self,
+            session_delete_sessions_for_user_patch,
+            oauth_get_patch,
+            reauth_patch):
+        oauth_get_patch.side_effect = ConnectionError()
+
+        with self.token_cache():
+            for _ in range(2):
+                response = self.do_reauth_post()
+                self.assertEqual(500, response.status_code, response.data)
+
+        assert_that(oauth_get_patch.call_count, equal_to(2))
+
+    @contextmanager
+    def token_cache(self):
+        self.app.config['SIGNON_TOKEN_CACHE'] = True
+        try:
+            yield
+        finally:
+            self.app.config['SIGNON_TOKEN_CACHE'] = False
+            for cache in _token_caches.values():
+                cache.entries.clear()
+            for key in self.app.redis_instance.keys(TokenCache.PREFIX + '*'):
+                self.app.redis_instance.delete(key)
+
     def mock_signon_json(self, mock_signon):
         return mock_signon.return_value.json
 
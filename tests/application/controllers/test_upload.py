@@ -4,15 +4,52 @@ from hamcrest import (
 )
 from mock import patch, Mock
 from StringIO import StringIO
+import json
+import os
 from tests.application.support.flask_app_test_case import (
     FlaskAppTestCase, signed_in)
+from application.controllers.upload import run_next_upload_job
+from application.files.parsers.excel import open_excel
+from application.files.upload_cache import UploadCache
+from application.files.upload_deltas import RowFingerprints
+from application.files.upload_jobs import UploadJob
+from application.files.uploaded import clamd_scanner
+from application.reference_cache import ReferenceCache
+from tests.application.support.fake_backdrop import FakeBackdrop
+from tests.application.support.fake_clamd import EICAR, FakeClamd
 import requests
 
 
-class UploadTestCase(FlaskAppTestCase):
+class UploadFeatureTestCase(FlaskAppTestCase):
+    """Posts files to be uploaded with the config a case tests switched on
+
+    The settings in config, and any changed by configure during a test, are
+    set back once the test has finished.
+    """
+
+    config = {}
 
     def setUp(self):
-        self.app.config['WTF_CSRF_ENABLED'] = False
+        self.configure(WTF_CSRF_ENABLED=False, **self.config)
+
+    def configure(self, **settings):
+        """Change the app's config until the end of the test"""
+        previous = dict((key, self.app.config.get(key)) for key in settings)
+        self.app.config.update(settings)
+        self.addCleanup(self.app.config.update, previous)
+
+    def delete_keys(self, prefix):
+        for key in self.app.redis_instance.keys(prefix + '*'):
+            self.app.redis_instance.delete(key)
+
+    def post_csv(self, client, csv, accept='application/json'):
+        return client.post(
+            '/upload-data/carers-allowance/volumetrics',
+            data={'file': (StringIO(csv), 'MYSPECIALFILE.csv')},
+            headers={'Accept': accept})
+
+
+class UploadTestCase(UploadFeatureTestCase):
 
     @signed_in()
     @patch('performanceplatform.client.admin.AdminAPI.get_data_set')
@@ -41,7 +78,9 @@ class UploadTestCase(FlaskAppTestCase):
             data=post_data)
 
         expected_post = [{u'_timestamp': u'2014-08-05T00:00:00Z', u'foo': 40}]
-        data_set_post_patch.assert_called_once_with(expected_post)
+        assert_that(data_set_post_patch.call_count, equal_to(1))
+        posted, = data_set_post_patch.call_args[0]
+        assert_that(json.loads(posted), equal_to(expected_post))
 
         upload_done_path = '/upload-data'
         assert_that(response.headers['Location'], ends_with(upload_done_path))
@@ -287,6 +326,87 @@ class UploadTestCase(FlaskAppTestCase):
         assert_that(response.status_code, equal_to(400))
         assert_that(data_set_post_patch.called, equal_to(False))
 
+    @signed_in()
+    @patch('performanceplatform.client.admin.AdminAPI.get_data_set')
+    @patch('application.files.uploaded.UploadedFile.is_virus')
+    @patch('performanceplatform.client.data_set.DataSet.post')
+    def test_file_over_the_data_set_size_limit_is_rejected(
+            self,
+            data_set_post_patch,
+            is_virus_patch,
+            get_data_set_patch,
+            client):
+        is_virus_patch.return_value = False
+        get_data_set_patch.return_value = {
+            'data_group': 'carers-allowance',
+            'data_type': 'volumetrics',
+            'bearer_token': 'abc123', 'foo': 'bar'
+        }
+        self.configure(UPLOAD_MAX_FILE_SIZES={
+            'carers-allowance/volumetrics': 10})
+
+        response = self.post_csv(client, '_timestamp,foo\n' + '1,2\n' * 10)
+
+        assert_that(response.status_code, equal_to(400))
+        assert_that(response.json['payload'],
+                    equal_to(['File is too big (55)']))
+        assert_that(data_set_post_patch.called, equal_to(False))
+
+    @signed_in()
+    @patch('performanceplatform.client.admin.AdminAPI.get_data_set')
+    @patch('application.files.uploaded.UploadedFile.is_virus')
+    @patch('performanceplatform.client.data_set.DataSet.post')
+    def test_nothing_is_posted_from_a_checked_file_with_bad_rows(
+            self,
+            data_set_post_patch,
+            is_virus_patch,
+            get_data_set_patch,
+            client):
+        is_virus_patch.return_value = False
+        get_data_set_patch.return_value = {
+            'data_group': 'carers-allowance',
+            'data_type': 'volumetrics',
+            'bearer_token': 'abc123', 'foo': 'bar'
+        }
+        self.configure(UPLOAD_CHECK_ROWS=True)
+
+        response = self.post_csv(client, '_timestamp,foo\n1,2\n3\n4,5,6\n')
+
+        assert_that(response.status_code, equal_to(400))
+        assert_that(response.json['payload'], equal_to([
+            'Row 3 contains fewer values than columns',
+            'Row 4 contains more values than columns',
+        ]))
+        assert_that(data_set_post_patch.called, equal_to(False))
+
+    @signed_in()
+    @patch('performanceplatform.client.admin.AdminAPI.get_data_set')
+    @patch('application.controllers.upload.upload_spreadsheet')
+    def test_uploaded_file_is_closed_after_the_request(
+            self,
+            upload_spreadsheet_patch,
+            get_data_set_patch,
+            client):
+        streams = []
+
+        def upload_spreadsheet(data_set, file_data, progress):
+            streams.append(file_data.stream)
+            return [], False
+
+        upload_spreadsheet_patch.side_effect = upload_spreadsheet
+        get_data_set_patch.return_value = {
+            'data_group': 'carers-allowance',
+            'data_type': 'volumetrics',
+            'bearer_token': 'abc123'
+        }
+
+        client.post(
+            '/upload-data/carers-allowance/volumetrics',
+            data={'file': (StringIO('foo\n1'), 'MYSPECIALFILE.csv')},
+            headers={'Accept': 'application/json'})
+
+        assert_that(streams[0].closed, equal_to(True))
+
     @signed_in()
     @patch('performanceplatform.client.admin.AdminAPI.list_data_sets')
     def test_data_sets_redirects_to_sign_out_when_401_on_data_set_list(
@@ -304,6 +424,29 @@ class UploadTestCase(FlaskAppTestCase):
             response.headers['Location'],
             ends_with('/sign-out'))
 
+    @signed_in()
+    @patch('performanceplatform.client.admin.AdminAPI.list_data_sets')
+    def test_a_cached_data_set_list_still_signs_out_an_expired_token(
+            self,
+            mock_data_set_list,
+            client):
+        bad_response = requests.Response()
+        bad_response.status_code = 401
+        http_error = requests.exceptions.HTTPError()
+        http_error.response = bad_response
+        mock_data_set_list.side_effect = [[], http_error]
+        self.configure(STAGECRAFT_CACHE=True,
+                       STAGECRAFT_CACHE_TTLS={'data-sets': 0})
+        self.addCleanup(self.delete_keys, ReferenceCache.PREFIX)
+
+        client.get("/upload-data")
+        response = client.get("/upload-data")
+
+        assert_that(response.status_code, equal_to(302))
+        assert_that(
+            response.headers['Location'],
+            ends_with('/sign-out'))
+
     @signed_in()
     @patch('performanceplatform.client.admin.AdminAPI.list_data_sets')
     def test_data_sets_renders_error_page_when_500_on_data_set_list(
@@ -364,6 +507,971 @@ class UploadTestCase(FlaskAppTestCase):
                 "Your data uploaded successfully"))
 
 
+class StreamingUploadTestCase(UploadFeatureTestCase):
+
+    config = {'UPLOAD_BATCH_SIZE': 2}
+
+    @signed_in()
+    @patch('performanceplatform.client.admin.AdminAPI.get_data_set')
+    @patch('application.files.uploaded.UploadedFile.is_virus')
+    @patch('performanceplatform.client.data_set.DataSet.post')
+    def test_records_are_posted_in_batches(
+            self,
+            data_set_post_patch,
+            is_virus_patch,
+            get_data_set_patch,
+            client):
+        is_virus_patch.return_value = False
+        get_data_set_patch.return_value = {
+            'data_group': 'carers-allowance',
+            'data_type': 'volumetrics',
+            'bearer_token': 'abc123'
+        }
+
+        response = self.post_csv(client, 'foo\n1\n2\n3')
+
+        assert_that(response.status_code, equal_to(200))
+        assert_that(
+            [json.loads(c[0][0])
+             for c in data_set_post_patch.call_args_list],
+            equal_to([[{'foo': 1}, {'foo': 2}], [{'foo': 3}]]))
+
+    @signed_in()
+    @patch('performanceplatform.client.admin.AdminAPI.get_data_set')
+    @patch('application.files.uploaded.UploadedFile.is_virus')
+    @patch('performanceplatform.client.data_set.DataSet.post')
+    def test_validation_error_names_the_rejected_records(
+            self,
+            data_set_post_patch,
+            is_virus_patch,
+            get_data_set_patch,
+            client):
+        is_virus_patch.return_value = False
+        get_data_set_patch.return_value = {
+            'data_group': 'carers-allowance',
+            'data_type': 'volumetrics',
+            'bearer_token': 'abc123'
+        }
+        data_set_post_patch.side_effect = [
+            None,
+            backdrop_response(400, {'messages': ['bad foo']}),
+        ]
+
+        response = self.post_csv(client, 'foo\n1\n2\n3')
+
+        assert_that(response.status_code, equal_to(400))
+        assert_that(response.json['payload'],
+                    equal_to(['Records 3-3: bad foo']))
+
+    @signed_in()
+    @patch('performanceplatform.client.admin.AdminAPI.get_data_set')
+    @patch('application.files.uploaded.UploadedFile.is_virus')
+    @patch('performanceplatform.client.data_set.DataSet.post')
+    def test_parse_error_reports_the_row_that_failed(
+            self,
+            data_set_post_patch,
+            is_virus_patch,
+            get_data_set_patch,
+            client):
+        is_virus_patch.return_value = False
+        get_data_set_patch.return_value = {
+            'data_group': 'carers-allowance',
+            'data_type': 'volumetrics',
+            'bearer_token': 'abc123'
+        }
+
+        response = self.post_csv(client, 'foo,bar\n1,2\n3,4\n5')
+
+        assert_that(response.status_code, equal_to(400))
+        assert_that(response.json['payload'][0],
+                    contains_string('first found in row 4'))
+        assert_that(response.json['payload'][1],
+                    equal_to('The first 2 records were uploaded'))
+        assert_that(data_set_post_patch.call_count, equal_to(1))
+
+    @signed_in()
+    @patch('performanceplatform.client.admin.AdminAPI.get_data_set')
+    @patch('application.files.uploaded.UploadedFile.is_virus')
+    @patch('performanceplatform.client.data_set.DataSet.post')
+    def test_every_bad_row_is_reported_with_the_records_posted_before(
+            self,
+            data_set_post_patch,
+            is_virus_patch,
+            get_data_set_patch,
+            client):
+        self.configure(UPLOAD_CHECK_ROWS=True)
+        is_virus_patch.return_value = False
+        get_data_set_patch.return_value = {
+            'data_group': 'carers-allowance',
+            'data_type': 'volumetrics',
+            'bearer_token': 'abc123'
+        }
+
+        response = self.post_csv(client, 'foo,bar\n1,2\n3,4\n5\n6,7,8')
+
+        assert_that(response.status_code, equal_to(400))
+        assert_that(response.json['payload'], equal_to([
+            'Row 4 contains fewer values than columns',
+            'Row 5 contains more values than columns',
+            'The first 2 records were uploaded',
+        ]))
+        assert_that(data_set_post_patch.call_count, equal_to(1))
+
+    @signed_in()
+    @patch('performanceplatform.client.admin.AdminAPI.get_data_set')
+    @patch('application.files.uploaded.UploadedFile.is_virus')
+    @patch('performanceplatform.client.data_set.DataSet.post')
+    def test_no_batch_is_posted_after_a_bad_row(
+            self,
+            data_set_post_patch,
+            is_virus_patch,
+            get_data_set_patch,
+            client):
+        self.configure(UPLOAD_CHECK_ROWS=True)
+        is_virus_patch.return_value = False
+        get_data_set_patch.return_value = {
+            'data_group': 'carers-allowance',
+            'data_type': 'volumetrics',
+            'bearer_token': 'abc123'
+        }
+
+        response = self.post_csv(client, 'foo,bar\n1\n3,4\n5,6\n7,8')
+
+        assert_that(response.status_code, equal_to(400))
+        assert_that(response.json['payload'], equal_to([
+            'Row 2 contains fewer values than columns',
+        ]))
+        assert_that(data_set_post_patch.call_count, equal_to(0))
+
+
+class UploadJobTestCase(UploadFeatureTestCase):
+
+    config = {'UPLOAD_JOBS': True}
+
+    def tearDown(self):
+        self.delete_keys(UploadJob.PREFIX)
+
+    @signed_in()
+    @patch('performanceplatform.client.admin.AdminAPI.get_data_set')
+    @patch('application.controllers.upload.upload_workers')
+    def test_post_returns_a_queued_job(
+            self,
+            workers_patch,
+            get_data_set_patch,
+            client):
+        get_data_set_patch.return_value = {
+            'data_group': 'carers-allowance',
+            'data_type': 'volumetrics',
+            'bearer_token': 'abc123'
+        }
+
+        response = self.post_csv(client, 'foo\n1\n2\n3')
+
+        assert_that(response.status_code, equal_to(202))
+        assert_that(response.json, has_entries({
+            'stage': 'queued',
+            'rows': 0,
+            'data_group': 'carers-allowance',
+            'data_type': 'volumetrics',
+        }))
+        assert_that(response.json['status_url'], ends_with(
+            '/upload-data/carers-allowance/volumetrics/jobs/{}'.format(
+                response.json['job_id'])))
+        assert_that(workers_patch.wake.call_count, equal_to(1))
+
+        status = client.get(response.json['status_url'],
+                            headers={'Accept': 'application/json'})
+        assert_that(status.status_code, equal_to(202))
+        assert_that(status.json['stage'], equal_to('queued'))
+
+    @signed_in()
+    @patch('performanceplatform.client.admin.AdminAPI.get_data_set')
+    @patch('application.files.uploaded.UploadedFile.is_virus')
+    @patch('performanceplatform.client.data_set.DataSet.post')
+    @patch('application.controllers.upload.upload_workers')
+    def test_finished_job_responds_as_the_upload_would_have(
+            self,
+            workers_patch,
+            data_set_post_patch,
+            is_virus_patch,
+            get_data_set_patch,
+            client):
+        is_virus_patch.return_value = False
+        get_data_set_patch.return_value = {
+            'data_group': 'carers-allowance',
+            'data_type': 'volumetrics',
+            'bearer_token': 'abc123'
+        }
+        data_set_post_patch.side_effect = backdrop_response(
+            400, {'messages': ['bad foo']})
+
+        response = self.post_csv(client, 'foo\n1\n2\n3')
+        run_next_upload_job()
+
+        status = client.get(response.json['status_url'],
+                            headers={'Accept': 'application/json'})
+        assert_that(status.status_code, equal_to(400))
+        assert_that(status.json, equal_to({
+            'data_group': 'carers-allowance',
+            'data_type': 'volumetrics',
+            'payload': ['bad foo'],
+        }))
+        posted, = data_set_post_patch.call_args[0]
+        assert_that(json.loads(posted),
+                    equal_to([{'foo': 1}, {'foo': 2}, {'foo': 3}]))
+
+    @signed_in()
+    @patch('performanceplatform.client.admin.AdminAPI.get_data_set')
+    @patch('application.files.uploaded.UploadedFile.is_virus')
+    @patch('performanceplatform.client.data_set.DataSet.post')
+    @patch('application.controllers.upload.upload_workers')
+    def test_job_with_a_bad_row_fails_as_the_upload_would_have(
+            self,
+            workers_patch,
+            data_set_post_patch,
+            is_virus_patch,
+            get_data_set_patch,
+            client):
+        is_virus_patch.return_value = False
+        get_data_set_patch.return_value = {
+            'data_group': 'carers-allowance',
+            'data_type': 'volumetrics',
+            'bearer_token': 'abc123'
+        }
+
+        response = self.post_csv(client, 'foo,bar\n1,2\n3')
+        run_next_upload_job()
+
+        status = client.get(response.json['status_url'],
+                            headers={'Accept': 'application/json'})
+        assert_that(status.status_code, equal_to(400))
+        assert_that(status.json['payload'][0],
+                    contains_string('first found in row 3'))
+        assert_that(data_set_post_patch.call_count, equal_to(0))
+
+    @signed_in()
+    @patch('performanceplatform.client.admin.AdminAPI.get_data_set')
+    @patch('application.files.uploaded.UploadedFile.is_virus')
+    @patch('performanceplatform.client.data_set.DataSet.post')
+    @patch('application.controllers.upload.upload_workers')
+    def test_html_upload_is_redirected_to_the_job(
+            self,
+            workers_patch,
+            data_set_post_patch,
+            is_virus_patch,
+            get_data_set_patch,
+            client):
+        is_virus_patch.return_value = False
+        get_data_set_patch.return_value = {
+            'data_group': 'carers-allowance',
+            'data_type': 'volumetrics',
+            'bearer_token': 'abc123'
+        }
+
+        response = self.post_csv(client, 'foo\n1', accept='text/html')
+        job_url = response.headers['Location']
+
+        assert_that(response.status_code, equal_to(302))
+        assert_that(job_url, contains_string(
+            '/upload-data/carers-allowance/volumetrics/jobs/'))
+
+        waiting = client.get(job_url)
+        assert_that(waiting.status_code, equal_to(202))
+        assert_that(waiting.data, contains_string('waiting to be uploaded'))
+
+        job_id = job_url.rpartition('/')[2]
+        UploadJob(self.app.redis_instance, job_id).update('validating')
+        assert_that(client.get(job_url).data,
+                    contains_string('Your file is being checked.'))
+
+        UploadJob(self.app.redis_instance, job_id).update('uploading', 20)
+        assert_that(client.get(job_url).data, contains_string(
+            'Your file is being uploaded, 20 rows so far.'))
+
+        run_next_upload_job()
+
+        finished = client.get(job_url)
+        assert_that(finished.status_code, equal_to(302))
+        assert_that(finished.headers['Location'], ends_with('/upload-data'))
+        self.assert_session_contains('upload_data', {
+            'data_group': 'carers-allowance',
+            'data_type': 'volumetrics',
+            'payload': [],
+        })
+
+    @signed_in()
+    @patch('performanceplatform.client.admin.AdminAPI.get_data_set')
+    @patch('application.files.uploaded.UploadedFile.is_virus')
+    @patch('application.controllers.upload.upload_workers')
+    def test_empty_files_are_rejected_without_a_job(
+            self,
+            workers_patch,
+            is_virus_patch,
+            get_data_set_patch,
+            client):
+        is_virus_patch.return_value = False
+        get_data_set_patch.return_value = {
+            'data_group': 'carers-allowance',
+            'data_type': 'volumetrics',
+            'bearer_token': 'abc123'
+        }
+
+        response = self.post_csv(client, '')
+
+        assert_that(response.status_code, equal_to(400))
+        assert_that(response.json['payload'], equal_to(['File is empty']))
+        assert_that(workers_patch.wake.called, equal_to(False))
+
+    @signed_in()
+    @patch('performanceplatform.client.admin.AdminAPI.get_data_set')
+    @patch('performanceplatform.client.data_set.DataSet.post')
+    @patch('application.controllers.upload.upload_workers')
+    def test_job_whose_token_expired_fails_without_posting(
+            self,
+            workers_patch,
+            data_set_post_patch,
+            get_data_set_patch,
+            client):
+        get_data_set_patch.return_value = {
+            'data_group': 'carers-allowance',
+            'data_type': 'volumetrics',
+            'bearer_token': 'abc123'
+        }
+
+        response = self.post_csv(client, 'foo\n1')
+        job = UploadJob.find(self.app.redis_instance,
+                             response.json['job_id'])
+        self.app.redis_instance.delete(job.data_set_key)
+        run_next_upload_job()
+
+        status = client.get(response.json['status_url'],
+                            headers={'Accept': 'application/json'})
+        assert_that(status.status_code, equal_to(500))
+        assert_that(data_set_post_patch.called, equal_to(False))
+
+    @signed_in()
+    def test_unknown_job_is_not_found(self, client):
+        response = client.get(
+            '/upload-data/carers-allowance/volumetrics/jobs/no-such-job',
+            headers={'Accept': 'application/json'})
+
+        assert_that(response.status_code, equal_to(404))
+
+
+class ClamdUploadTestCase(UploadFeatureTestCase):
+
+    config = {'VIRUS_CHECK': True, 'VIRUS_SCANNER': 'clamd'}
+
+    def setUp(self):
+        super(ClamdUploadTestCase, self).setUp()
+        self.clamd = FakeClamd().start()
+        self.configure(CLAMD_ADDRESS=self.clamd.address)
+
+    def tearDown(self):
+        clamd_scanner().clear()
+        self.clamd.stop()
+
+    @signed_in()
+    @patch('performanceplatform.client.admin.AdminAPI.get_data_set')
+    @patch('performanceplatform.client.data_set.DataSet.post')
+    def test_upload_is_scanned_once_as_it_arrives(
+            self,
+            data_set_post_patch,
+            get_data_set_patch,
+            client):
+        get_data_set_patch.return_value = {
+            'data_group': 'carers-allowance',
+            'data_type': 'volumetrics',
+            'bearer_token': 'abc123'
+        }
+
+        response = self.post_csv(client, 'foo\n' + EICAR)
+
+        assert_that(response.status_code, equal_to(400))
+        assert_that(response.json['payload'],
+                    equal_to(['File may contain a virus']))
+        assert_that(self.clamd.server.scans,
+                    equal_to(['stream: Eicar-Test-Signature FOUND']))
+        assert_that(data_set_post_patch.called, equal_to(False))
+
+    @signed_in()
+    @patch('performanceplatform.client.admin.AdminAPI.get_data_set')
+    @patch('performanceplatform.client.data_set.DataSet.post')
+    def test_upload_can_be_parsed_while_it_is_scanned(
+            self,
+            data_set_post_patch,
+            get_data_set_patch,
+            client):
+        self.configure(UPLOAD_CONCURRENT_VALIDATION=True)
+        get_data_set_patch.return_value = {
+            'data_group': 'carers-allowance',
+            'data_type': 'volumetrics',
+            'bearer_token': 'abc123'
+        }
+
+        response = self.post_csv(client, 'foo\n1\n2')
+
+        assert_that(response.status_code, equal_to(200))
+        assert_that(json.loads(data_set_post_patch.call_args[0][0]),
+                    equal_to([{'foo': 1}, {'foo': 2}]))
+
+
+class UploadCacheTestCase(UploadFeatureTestCase):
+
+    config = {'VIRUS_CHECK': True, 'UPLOAD_CACHE': True}
+
+    def tearDown(self):
+        self.delete_keys(UploadCache.PREFIX)
+
+    @signed_in()
+    @patch('performanceplatform.client.admin.AdminAPI.get_data_set')
+    @patch('application.files.uploaded.UploadedFile.is_virus')
+    @patch('application.files.spreadsheet.Spreadsheet.iter_json')
+    @patch('performanceplatform.client.data_set.DataSet.post')
+    def test_same_file_is_not_scanned_or_parsed_again(
+            self,
+            data_set_post_patch,
+            iter_json_patch,
+            is_virus_patch,
+            get_data_set_patch,
+            client):
+        is_virus_patch.return_value = False
+        iter_json_patch.return_value = iter([{'foo': 1}])
+        get_data_set_patch.return_value = {
+            'data_group': 'carers-allowance',
+            'data_type': 'volumetrics',
+            'bearer_token': 'abc123'
+        }
+
+        self.post_csv(client, 'foo\n1')
+        response = self.post_csv(client, 'foo\n1')
+
+        assert_that(response.status_code, equal_to(200))
+        assert_that(response.json.get('unchanged'), equal_to(None))
+        assert_that(is_virus_patch.call_count, equal_to(1))
+        assert_that(iter_json_patch.call_count, equal_to(1))
+        assert_that([json.loads(c[0][0])
+                     for c in data_set_post_patch.call_args_list],
+                    equal_to([[{'foo': 1}], [{'foo': 1}]]))
+
+    @signed_in()
+    @patch('performanceplatform.client.admin.AdminAPI.get_data_set')
+    @patch('application.files.uploaded.UploadedFile.is_virus')
+    @patch('performanceplatform.client.data_set.DataSet.post')
+    def test_virus_is_remembered(
+            self,
+            data_set_post_patch,
+            is_virus_patch,
+            get_data_set_patch,
+            client):
+        is_virus_patch.return_value = True
+        get_data_set_patch.return_value = {
+            'data_group': 'carers-allowance',
+            'data_type': 'volumetrics',
+            'bearer_token': 'abc123'
+        }
+
+        self.post_csv(client, 'foo\n1')
+        response = self.post_csv(client, 'foo\n1')
+
+        assert_that(response.status_code, equal_to(400))
+        assert_that(response.json['payload'],
+                    equal_to(['File may contain a virus']))
+        assert_that(is_virus_patch.call_count, equal_to(1))
+        assert_that(data_set_post_patch.called, equal_to(False))
+
+    @signed_in()
+    @patch('performanceplatform.client.admin.AdminAPI.get_data_set')
+    @patch('application.files.uploaded.UploadedFile.is_virus')
+    @patch('performanceplatform.client.data_set.DataSet.post')
+    def test_unchanged_file_is_not_posted_again(
+            self,
+            data_set_post_patch,
+            is_virus_patch,
+            get_data_set_patch,
+            client):
+        self.configure(UPLOAD_SKIP_UNCHANGED=True)
+        is_virus_patch.return_value = False
+        get_data_set_patch.return_value = {
+            'data_group': 'carers-allowance',
+            'data_type': 'volumetrics',
+            'bearer_token': 'abc123'
+        }
+
+        self.post_csv(client, 'foo\n1')
+        response = self.post_csv(client, 'foo\n1')
+        changed = self.post_csv(client, 'foo\n2')
+
+        assert_that(response.status_code, equal_to(200))
+        assert_that(response.json['unchanged'], equal_to(True))
+        assert_that(changed.json.get('unchanged'), equal_to(None))
+        assert_that(data_set_post_patch.call_count, equal_to(2))
+
+    @signed_in()
+    @patch('performanceplatform.client.admin.AdminAPI.get_data_set')
+    @patch('application.files.uploaded.UploadedFile.is_virus')
+    @patch('performanceplatform.client.data_set.DataSet.post')
+    def test_file_is_posted_again_after_another_was_posted(
+            self,
+            data_set_post_patch,
+            is_virus_patch,
+            get_data_set_patch,
+            client):
+        self.configure(UPLOAD_SKIP_UNCHANGED=True)
+        is_virus_patch.return_value = False
+        get_data_set_patch.return_value = {
+            'data_group': 'carers-allowance',
+            'data_type': 'volumetrics',
+            'bearer_token': 'abc123'
+        }
+
+        self.post_csv(client, 'foo\n1')
+        self.post_csv(client, 'foo\n2')
+        response = self.post_csv(client, 'foo\n1')
+
+        assert_that(response.status_code, equal_to(200))
+        assert_that(response.json.get('unchanged'), equal_to(None))
+        assert_that(data_set_post_patch.call_count, equal_to(3))
+        posted, = data_set_post_patch.call_args[0]
+        assert_that(json.loads(posted), equal_to([{'foo': 1}]))
+
+    @signed_in()
+    @patch('performanceplatform.client.admin.AdminAPI.get_data_set')
+    @patch('application.files.uploaded.UploadedFile.is_virus')
+    @patch('performanceplatform.client.data_set.DataSet.post')
+    def test_file_is_posted_again_after_a_failed_post(
+            self,
+            data_set_post_patch,
+            is_virus_patch,
+            get_data_set_patch,
+            client):
+        self.configure(UPLOAD_SKIP_UNCHANGED=True)
+        is_virus_patch.return_value = False
+        get_data_set_patch.return_value = {
+            'data_group': 'carers-allowance',
+            'data_type': 'volumetrics',
+            'bearer_token': 'abc123'
+        }
+        data_set_post_patch.side_effect = [
+            None,
+            backdrop_response(500, {'message': 'part way'}),
+            None,
+        ]
+
+        self.post_csv(client, 'foo\n1')
+        self.post_csv(client, 'foo\n2')
+        response = self.post_csv(client, 'foo\n1')
+
+        assert_that(response.json.get('unchanged'), equal_to(None))
+        assert_that(data_set_post_patch.call_count, equal_to(3))
+
+    @signed_in()
+    @patch('performanceplatform.client.admin.AdminAPI.get_data_set')
+    @patch('application.files.uploaded.UploadedFile.is_virus')
+    @patch('performanceplatform.client.data_set.DataSet.post')
+    def test_file_rejected_by_backdrop_is_posted_again(
+            self,
+            data_set_post_patch,
+            is_virus_patch,
+            get_data_set_patch,
+            client):
+        self.configure(UPLOAD_SKIP_UNCHANGED=True)
+        is_virus_patch.return_value = False
+        get_data_set_patch.return_value = {
+            'data_group': 'carers-allowance',
+            'data_type': 'volumetrics',
+            'bearer_token': 'abc123'
+        }
+        data_set_post_patch.side_effect = [
+            backdrop_response(400, {'messages': ['bad foo']}),
+            None,
+        ]
+
+        self.post_csv(client, 'foo\n1')
+        response = self.post_csv(client, 'foo\n1')
+
+        assert_that(response.status_code, equal_to(200))
+        assert_that(data_set_post_patch.call_count, equal_to(2))
+
+
+class DeltaUploadTestCase(UploadFeatureTestCase):
+
+    config = {'UPLOAD_DELTAS': True}
+
+    def tearDown(self):
+        self.delete_keys(RowFingerprints.PREFIX)
+
+    def posted(self, data_set_post_patch):
+        return [json.loads(c[0][0])
+                for c in data_set_post_patch.call_args_list]
+
+    @signed_in()
+    @patch('performanceplatform.client.admin.AdminAPI.get_data_set')
+    @patch('application.files.uploaded.UploadedFile.is_virus')
+    @patch('performanceplatform.client.data_set.DataSet.post')
+    def test_only_changed_rows_are_posted(
+            self,
+            data_set_post_patch,
+            is_virus_patch,
+            get_data_set_patch,
+            client):
+        is_virus_patch.return_value = False
+        get_data_set_patch.return_value = {
+            'data_group': 'carers-allowance',
+            'data_type': 'volumetrics',
+            'bearer_token': 'abc123',
+            'auto_ids': '_timestamp, channel',
+        }
+
+        self.post_csv(client, '_timestamp,channel,count\n1,web,5')
+        response = self.post_csv(
+            client, '_timestamp,channel,count\n1,web,5\n2,web,6')
+        unchanged = self.post_csv(
+            client, '_timestamp,channel,count\n1,web,5\n2,web,6')
+
+        assert_that(response.status_code, equal_to(200))
+        assert_that(self.posted(data_set_post_patch), equal_to([
+            [{'_timestamp': 1, 'channel': 'web', 'count': 5}],
+            [{'_timestamp': 2, 'channel': 'web', 'count': 6}],
+        ]))
+        assert_that(unchanged.json['unchanged'], equal_to(True))
+
+    @signed_in()
+    @patch('performanceplatform.client.admin.AdminAPI.get_data_set')
+    @patch('application.files.uploaded.UploadedFile.is_virus')
+    @patch('performanceplatform.client.data_set.DataSet.post')
+    def test_rows_are_sent_again_if_backdrop_rejected_them(
+            self,
+            data_set_post_patch,
+            is_virus_patch,
+            get_data_set_patch,
+            client):
+        self.configure(UPLOAD_BATCH_SIZE=1)
+        is_virus_patch.return_value = False
+        get_data_set_patch.return_value = {
+            'data_group': 'carers-allowance',
+            'data_type': 'volumetrics',
+            'bearer_token': 'abc123',
+            'auto_ids': ['_timestamp'],
+        }
+        data_set_post_patch.side_effect = [
+            None,
+            backdrop_response(400, {'messages': ['bad count']}),
+            None,
+            None,
+        ]
+
+        self.post_csv(client, '_timestamp,count\n1,5\n2,6')
+        response = self.post_csv(client, '_timestamp,count\n1,5\n2,6')
+
+        assert_that(response.status_code, equal_to(200))
+        assert_that(len(self.posted(data_set_post_patch)), equal_to(4))
+
+    @signed_in()
+    @patch('performanceplatform.client.admin.AdminAPI.get_data_set')
+    @patch('application.files.uploaded.UploadedFile.is_virus')
+    @patch('performanceplatform.client.data_set.DataSet.post')
+    def test_data_sets_without_auto_ids_get_every_row(
+            self,
+            data_set_post_patch,
+            is_virus_patch,
+            get_data_set_patch,
+            client):
+        is_virus_patch.return_value = False
+        get_data_set_patch.return_value = {
+            'data_group': 'carers-allowance',
+            'data_type': 'volumetrics',
+            'bearer_token': 'abc123',
+        }
+
+        self.post_csv(client, '_timestamp,count\n1,5')
+        self.post_csv(client, '_timestamp,count\n1,5')
+
+        assert_that(data_set_post_patch.call_count, equal_to(2))
+
+
+class StreamedUploadTestCase(UploadFeatureTestCase):
+
+    config = {'UPLOAD_GZIP_STREAM': True}
+
+    def setUp(self):
+        super(StreamedUploadTestCase, self).setUp()
+        self.backdrop = FakeBackdrop().start()
+        self.configure(BACKDROP_HOST=self.backdrop.url)
+
+    def tearDown(self):
+        self.backdrop.stop()
+
+    @signed_in()
+    @patch('performanceplatform.client.admin.AdminAPI.get_data_set')
+    @patch('application.files.uploaded.UploadedFile.is_virus')
+    def test_records_are_streamed_to_backdrop(
+            self,
+            is_virus_patch,
+            get_data_set_patch,
+            client):
+        is_virus_patch.return_value = False
+        get_data_set_patch.return_value = {
+            'data_group': 'carers-allowance',
+            'data_type': 'volumetrics',
+            'bearer_token': 'abc123'
+        }
+
+        response = self.post_csv(client, 'foo,bar\n1,a\n2,b')
+
+        assert_that(response.status_code, equal_to(200))
+        request = self.backdrop.server.requests[0]
+        assert_that(request['path'],
+                    equal_to('/data/carers-allowance/volumetrics'))
+        assert_that(request['payload'], equal_to(
+            [{'foo': 1, 'bar': 'a'}, {'foo': 2, 'bar': 'b'}]))
+
+    @signed_in()
+    @patch('performanceplatform.client.admin.AdminAPI.get_data_set')
+    @patch('application.files.uploaded.UploadedFile.is_virus')
+    def test_backdrop_errors_are_reported(
+            self,
+            is_virus_patch,
+            get_data_set_patch,
+            client):
+        self.backdrop.server.reply = (400, {'messages': ['bad foo']})
+        is_virus_patch.return_value = False
+        get_data_set_patch.return_value = {
+            'data_group': 'carers-allowance',
+            'data_type': 'volumetrics',
+            'bearer_token': 'abc123'
+        }
+
+        response = self.post_csv(client, 'foo\n1')
+
+        assert_that(response.status_code, equal_to(400))
+        assert_that(response.json['payload'], equal_to(['bad foo']))
+
+    @signed_in()
+    @patch('performanceplatform.client.admin.AdminAPI.get_data_set')
+    @patch('application.files.uploaded.UploadedFile.is_virus')
+    def test_parse_error_is_reported_and_nothing_is_stored(
+            self,
+            is_virus_patch,
+            get_data_set_patch,
+            client):
+        is_virus_patch.return_value = False
+        get_data_set_patch.return_value = {
+            'data_group': 'carers-allowance',
+            'data_type': 'volumetrics',
+            'bearer_token': 'abc123'
+        }
+
+        response = self.post_csv(client, 'foo,bar\n1,2\n3')
+
+        assert_that(response.status_code, equal_to(400))
+        assert_that(response.json['payload'][0],
+                    contains_string('first found in row 3'))
+        assert_that(self.backdrop.server.requests, equal_to([]))
+
+
+class BulkUploadTestCase(UploadFeatureTestCase):
+
+    def get_data_set(self, data_group, data_type):
+        if data_type == 'missing':
+            return None
+        return {
+            'data_group': data_group,
+            'data_type': data_type,
+            'bearer_token': 'abc123'
+        }
+
+    def posted(self, post_records_patch):
+        # Data sets are posted to concurrently, so each is found by its url
+        return dict(
+            (c[0][0].base_url.rpartition('/data/')[2], list(c[0][1]))
+            for c in post_records_patch.call_args_list)
+
+    @signed_in()
+    @patch('performanceplatform.client.admin.AdminAPI.get_data_set')
+    @patch('application.files.uploaded.UploadedFile.is_virus')
+    @patch('application.controllers.upload.post_records')
+    def test_several_files_are_uploaded_at_once(
+            self,
+            post_records_patch,
+            is_virus_patch,
+            get_data_set_patch,
+            client):
+        is_virus_patch.return_value = False
+        get_data_set_patch.side_effect = self.get_data_set
+        post_records_patch.return_value = ([], False)
+
+        response = client.post(
+            '/upload-data/bulk',
+            data={
+                'carers-allowance/volumetrics': (StringIO('foo\n1'),
+                                                 'volumetrics.csv'),
+                'carers-allowance/weekly': (StringIO('bar\n2'),
+                                            'weekly.csv'),
+            },
+            headers={'Accept': 'application/json'})
+
+        assert_that(response.status_code, equal_to(200))
+        assert_that(
+            sorted(response.json['results'], key=lambda r: r['data_type']),
+            equal_to([
+                {'data_group': 'carers-allowance', 'data_type': 'volumetrics',
+                 'filename': 'volumetrics.csv', 'payload': [], 'status': 200},
+                {'data_group': 'carers-allowance', 'data_type': 'weekly',
+                 'filename': 'weekly.csv', 'payload': [], 'status': 200},
+            ]))
+        assert_that(self.posted(post_records_patch), equal_to({
+            'carers-allowance/volumetrics': [{'foo': 1}],
+            'carers-allowance/weekly': [{'bar': 2}],
+        }))
+
+    @signed_in()
+    @patch('performanceplatform.client.admin.AdminAPI.get_data_set')
+    @patch('application.files.uploaded.UploadedFile.is_virus')
+    @patch('application.controllers.upload.post_records')
+    def test_sheets_of_a_workbook_go_to_their_data_sets(
+            self,
+            post_records_patch,
+            is_virus_patch,
+            get_data_set_patch,
+            client):
+        is_virus_patch.return_value = False
+        get_data_set_patch.side_effect = self.get_data_set
+        post_records_patch.return_value = ([], False)
+
+        with open(fixture_path('multiple_sheets.xlsx')) as workbook:
+            response = client.post(
+                '/upload-data/bulk',
+                data={
+                    'workbook': (workbook, 'multiple_sheets.xlsx'),
+                    'carers-allowance/first': 'First',
+                    'carers-allowance/second': 'Second',
+                    'carers-allowance/third': 'Third',
+                },
+                headers={'Accept': 'application/json'})
+
+        results = dict((r['data_type'], r) for r in response.json['results'])
+        assert_that(response.status_code, equal_to(400))
+        assert_that(results['first']['status'], equal_to(200))
+        assert_that(results['second']['sheet'], equal_to('Second'))
+        assert_that(results['second']['status'], equal_to(200))
+        assert_that(results['third']['payload'],
+                    equal_to(['There is no sheet named "Third"']))
+        assert_that(self.posted(post_records_patch), equal_to({
+            'carers-allowance/first':
+                [{'Sheet 1 content': 'Nothing exciting'}],
+            'carers-allowance/second':
+                [{'Sheet 2 content': 'Sheet Name', None: 'Sheet Index'},
+                 {'Sheet 2 content': 'First', None: 0},
+                 {'Sheet 2 content': 'Second', None: 1}],
+        }))
+
+    @signed_in()
+    @patch('performanceplatform.client.admin.AdminAPI.get_data_set')
+    @patch('application.files.uploaded.UploadedFile.is_virus')
+    @patch('application.controllers.upload.post_records')
+    def test_a_workbook_is_scanned_and_opened_once_for_all_its_sheets(
+            self,
+            post_records_patch,
+            is_virus_patch,
+            get_data_set_patch,
+            client):
+        is_virus_patch.return_value = False
+        get_data_set_patch.side_effect = self.get_data_set
+        post_records_patch.return_value = ([], False)
+        self.configure(VIRUS_CHECK=True)
+
+        with open(fixture_path('multiple_sheets.xls')) as workbook, \
+                patch('application.files.spreadsheet.open_excel',
+                      wraps=open_excel) as open_excel_patch:
+            response = client.post(
+                '/upload-data/bulk',
+                data={
+                    'workbook': (workbook, 'multiple_sheets.xls'),
+                    'carers-allowance/first': 'First',
+                    'carers-allowance/second': 'Second',
+                },
+                headers={'Accept': 'application/json'})
+
+        assert_that(response.status_code, equal_to(200))
+        assert_that(is_virus_patch.call_count, equal_to(1))
+        assert_that(open_excel_patch.call_count, equal_to(1))
+        assert_that(sorted(self.posted(post_records_patch)), equal_to(
+            ['carers-allowance/first', 'carers-allowance/second']))
+
+    @signed_in()
+    @patch('performanceplatform.client.admin.AdminAPI.get_data_set')
+    @patch('application.files.uploaded.UploadedFile.is_virus')
+    @patch('application.controllers.upload.post_records')
+    def test_unknown_data_sets_are_reported(
+            self,
+            post_records_patch,
+            is_virus_patch,
+            get_data_set_patch,
+            client):
+        is_virus_patch.return_value = False
+        get_data_set_patch.side_effect = self.get_data_set
+        post_records_patch.return_value = ([], False)
+
+        response = client.post(
+            '/upload-data/bulk',
+            data={
+                'carers-allowance/volumetrics': (StringIO('foo\n1'),
+                                                 'volumetrics.csv'),
+                'carers-allowance/missing': (StringIO('bar\n2'),
+                                             'missing.csv'),
+            },
+            headers={'Accept': 'application/json'})
+
+        results = dict((r['data_type'], r) for r in response.json['results'])
+        assert_that(response.status_code, equal_to(404))
+        assert_that(results['missing']['status'], equal_to(404))
+        assert_that(results['volumetrics']['status'], equal_to(200))
+        assert_that(post_records_patch.call_count, equal_to(1))
+
+    @signed_in()
+    @patch('performanceplatform.client.admin.AdminAPI.get_data_set')
+    @patch('application.files.uploaded.UploadedFile.is_virus')
+    @patch('application.controllers.upload.post_records')
+    def test_each_file_is_held_to_its_data_sets_size_limit(
+            self,
+            post_records_patch,
+            is_virus_patch,
+            get_data_set_patch,
+            client):
+        is_virus_patch.return_value = False
+        get_data_set_patch.side_effect = self.get_data_set
+        post_records_patch.return_value = ([], False)
+        self.configure(UPLOAD_MAX_FILE_SIZES={'carers-allowance/small': 5})
+
+        response = client.post(
+            '/upload-data/bulk',
+            data={
+                'carers-allowance/small': (StringIO('foo\n123456'),
+                                           'small.csv'),
+                'carers-allowance/large': (StringIO('foo\n123456'),
+                                           'large.csv'),
+            },
+            headers={'Accept': 'application/json'})
+
+        results = dict((r['data_type'], r) for r in response.json['results'])
+        assert_that(results['small']['payload'],
+                    equal_to(['File is too big (10)']))
+        assert_that(results['large']['status'], equal_to(200))
+
+    @signed_in()
+    def test_nothing_to_upload(self, client):
+        response = client.post('/upload-data/bulk', data={},
+                               headers={'Accept': 'application/json'})
+
+        assert_that(response.status_code, equal_to(400))
+
+
+def fixture_path(name):
+    return os.path.abspath(os.path.join(
+        os.path.dirname(__file__), '..', '..', 'fixtures', name))
+
+
 def backdrop_response(status_code, return_value):
     bad_response = requests.Response()
     bad_response.status_code = status_code
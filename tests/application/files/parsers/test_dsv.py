@@ -1,11 +1,15 @@
 # -*- coding: utf-8 -*-
 
-from application.files.parsers.dsv import parse_csv, lines
+from application.files.parsers.dsv import (
+    parse_csv, parse_numbered_csv, lines, parse_as_number,
+    parse_cells_as_numbers, Undecoded)
 from application.files.parsers import ParseError
+from application.files.parsers.util import record_pipeline
 
 import unittest
 
 from cStringIO import StringIO
+from mock import patch
 from hamcrest import assert_that, only_contains, is_, contains
 
 
@@ -22,6 +26,17 @@ class ParseCsvTestCase(unittest.TestCase):
             ["q", "w"],
         ))
 
+    def test_rows_are_numbered_by_the_line_they_end_on(self):
+        csv_stream = _string_io('# note\na,b\n\n,\n"x\ny",z\n1,2')
+
+        data = parse_numbered_csv(csv_stream)
+
+        assert_that(data, contains(
+            (2, ["a", "b"]),
+            (6, ["x\ny", "z"]),
+            (7, [1, 2]),
+        ))
+
     def test_parse_empty_csv(self):
         csv_stream = _string_io("")
 
@@ -141,6 +156,52 @@ class ParseCsvTestCase(unittest.TestCase):
         ))
 
 
+class ParseCellsAsNumbersTest(unittest.TestCase):
+
+    AWKWARD_CELLS = [
+        u'12', u' 12 ', u'-3', u'+4', u'12.0', u'12.5', u'.5', u'1e3',
+        u'inf', u'-Infinity', u'nan', u'1' * 400, u'\u0663', u'',
+        u'-', u'.', u'foo', u'2014-08-05', u'2014-08-05T00:00:00Z',
+        u'12 monkeys',
+    ]
+
+    def _assert_same_as_parse_as_number(self, rows):
+        expected = [[parse_as_number(cell) for cell in row] for row in rows]
+
+        actual = list(parse_cells_as_numbers(rows))
+
+        assert_that(repr(actual), is_(repr(expected)))
+
+    def test_converts_each_column_by_its_type(self):
+        rows = [
+            [u'count', u'rate', u'_timestamp', u'name'],
+            [u'1', u'1.5', u'2014-08-05T00:00:00Z', u'foo'],
+            [u'2', u'3', u'2014-08-12T00:00:00Z', u'bar'],
+        ]
+
+        assert_that(list(parse_cells_as_numbers(rows)), contains(
+            [u'count', u'rate', u'_timestamp', u'name'],
+            [1, 1.5, u'2014-08-05T00:00:00Z', u'foo'],
+            [2, 3, u'2014-08-12T00:00:00Z', u'bar'],
+        ))
+
+    @patch('application.files.parsers.dsv.TYPE_SAMPLE_SIZE', 1)
+    def test_cells_that_do_not_fit_their_column_match_parse_as_number(self):
+        for sample in [u'1', u'1.5', u'2014-08-05T00:00:00Z', u'foo']:
+            rows = [[u'column'], [sample]]
+            rows += [[cell] for cell in self.AWKWARD_CELLS]
+
+            self._assert_same_as_parse_as_number(rows)
+
+    def test_ragged_rows_match_parse_as_number(self):
+        self._assert_same_as_parse_as_number([
+            [u'a', u'b'],
+            [u'1', u'foo'],
+            [u'2', u'bar', u'3.5'],
+            [u'4.5'],
+        ])
+
+
 class LinesGeneratorTest(unittest.TestCase):
 
     def test_handles_CR_LF_and_CRLF(self):
@@ -165,6 +226,66 @@ class LinesGeneratorTest(unittest.TestCase):
         assert_that(lines_list, is_(["asd\n"]))
 
 
+class CheckCsvRowsTestCase(unittest.TestCase):
+
+    def test_a_good_file_has_no_problems(self):
+        assert_that(_row_problems("a,b\n1,2\n\n,\n3,4"), is_([]))
+
+    def test_every_ragged_row_is_found(self):
+        problems = _row_problems("a,b\n1\n# comment\n1,2\n1,2,3")
+
+        assert_that(problems, is_([
+            "Row 2 contains fewer values than columns",
+            "Row 5 contains more values than columns",
+        ]))
+
+    def test_rows_are_named_by_their_line_of_the_file(self):
+        problems = _row_problems("# comment\na,b\n1,2\n\n,\n3,4,5\n6\n")
+
+        assert_that(problems, is_([
+            "Row 6 contains more values than columns",
+            "Row 7 contains fewer values than columns",
+        ]))
+
+    def test_comment_column_is_left_out(self):
+        problems = _row_problems("a,comment,b\n1,note,2\n3\n,only a note")
+
+        assert_that(problems, is_([
+            "Row 3 contains fewer values than columns",
+        ]))
+
+    def test_non_utf8_rows_are_found(self):
+        problems = _row_problems(u"a\nß\nb\nä".encode("latin-1"))
+
+        assert_that(problems, is_([
+            "Row 2 contains non-UTF8 characters",
+            "Row 4 contains non-UTF8 characters",
+        ]))
+
+    def test_non_utf8_cells_are_left_undecoded_unless_strict(self):
+        rows = parse_csv(_string_io(u"a,b\nß,c".encode("latin-1")),
+                         strict=False)
+
+        assert_that(list(rows), contains(
+            ["a", "b"], [Undecoded(u"ß".encode("latin-1")), "c"]))
+
+    def test_checking_stops_at_the_most_problems(self):
+        problems = _row_problems("a,b\n" + "1\n" * 100, max_problems=3)
+
+        assert_that(problems, is_([
+            "Row 2 contains fewer values than columns",
+            "Row 3 contains fewer values than columns",
+            "Row 4 contains fewer values than columns",
+        ]))
+
+
+def _row_problems(content, max_problems=10):
+    pipeline = record_pipeline(max_problems=max_problems)
+    list(pipeline.run_numbered(
+        parse_numbered_csv(_string_io(content), strict=False)))
+    return pipeline.problems()
+
+
 def _string_io(content, encoding=None):
     if encoding is not None:
         content = content.encode(encoding)
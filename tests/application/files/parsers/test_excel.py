@@ -1,9 +1,15 @@
-from application.files.parsers.excel import parse_excel, EXCEL_ERROR
+from application.files.parsers.excel import (
+    iter_workbook_rows, open_excel, sniff_excel_format, EXCEL_ERROR)
+from application.files.parsers import ParseError
+from application.files.parsers.util import make_dicts, record_pipeline
 
 import os
 import unittest
 
-from hamcrest import assert_that, contains, instance_of
+from cStringIO import StringIO
+from hamcrest import (
+    assert_that, contains, instance_of, is_, none, only_contains)
+from mock import patch
 
 
 def fixture_path(name):
@@ -14,8 +20,8 @@ def fixture_path(name):
 class ParseExcelTestCase(unittest.TestCase):
 
     def _parse_excel(self, file_name):
-        file_stream = open(fixture_path(file_name))
-        return parse_excel(file_stream)
+        with open(fixture_path(file_name)) as file_stream:
+            return list(iter_workbook_rows(open_excel(file_stream)))
 
     def test_parse_an_xlsx_file(self):
         assert_that(self._parse_excel("data.xlsx"), contains(
@@ -67,3 +73,117 @@ class ParseExcelTestCase(unittest.TestCase):
             [None, None, None],
             ["The above row", "is full", "of nones"]
         ))
+
+
+class OpenExcelTestCase(unittest.TestCase):
+
+    def _sniff(self, file_name):
+        with open(fixture_path(file_name)) as file_stream:
+            return sniff_excel_format(file_stream)
+
+    def test_sniffs_xls_from_the_ole2_header(self):
+        assert_that(self._sniff("xlsfile.xls"), is_("xls"))
+
+    def test_sniffs_xlsx_from_the_zip_contents(self):
+        assert_that(self._sniff("data.xlsx"), is_("xlsx"))
+
+    def test_csv_is_not_excel(self):
+        assert_that(self._sniff("data.csv"), none())
+
+    def test_zip_without_content_types_is_not_excel(self):
+        assert_that(sniff_excel_format(StringIO("PK\x03\x04 not really")),
+                    none())
+
+    def test_stream_is_rewound_after_sniffing(self):
+        with open(fixture_path("data.csv")) as file_stream:
+            sniff_excel_format(file_stream)
+            assert_that(file_stream.tell(), is_(0))
+
+    @patch('xlrd.open_workbook')
+    def test_csv_is_never_opened_with_xlrd(self, open_workbook_patch):
+        with open(fixture_path("data.csv")) as file_stream:
+            assert_that(open_excel(file_stream), none())
+
+        assert_that(open_workbook_patch.called, is_(False))
+
+    def test_opened_workbook_can_be_parsed(self):
+        with open(fixture_path("data.xlsx")) as file_stream:
+            book = open_excel(file_stream)
+
+        assert_that(list(iter_workbook_rows(book)), contains(
+            ["name", "age", "nationality"],
+            ["Pawel", 27, "Polish"],
+            ["Max", 35, "Italian"],
+        ))
+
+
+class IterWorkbookRowsTestCase(unittest.TestCase):
+
+    def _open_excel(self, file_name):
+        with open(fixture_path(file_name)) as file_stream:
+            return open_excel(file_stream)
+
+    def test_xls_sheets_are_loaded_on_demand(self):
+        book = self._open_excel("xlsfile.xls")
+
+        assert_that(book.on_demand, is_(True))
+        assert_that(book.sheet_loaded(0), is_(False))
+
+    def test_only_the_chosen_xls_sheet_is_loaded(self):
+        book = self._open_excel("multiple_sheets.xls")
+        rows = iter_workbook_rows(book, "Second")
+
+        assert_that(next(rows), is_(["Sheet 2 content", None]))
+        assert_that(book.sheet_loaded(0), is_(False))
+        assert_that(book.sheet_loaded(1), is_(True))
+
+    def test_rows_are_read_one_at_a_time(self):
+        rows = iter_workbook_rows(self._open_excel("xlsfile.xls"))
+
+        assert_that(next(rows), is_(["date", "name", "number"]))
+        assert_that(next(rows),
+                    is_(["2013-12-03T13:30:00+00:00", "test1", 12]))
+
+    def test_rows_feed_straight_into_make_dicts(self):
+        rows = iter_workbook_rows(self._open_excel("data.xlsx"))
+
+        assert_that(make_dicts(rows), only_contains(
+            {"name": "Pawel", "age": 27, "nationality": "Polish"},
+            {"name": "Max", "age": 35, "nationality": "Italian"},
+        ))
+
+    def test_a_sheet_can_be_chosen_by_name(self):
+        rows = iter_workbook_rows(self._open_excel("multiple_sheets.xlsx"),
+                                  "Second")
+
+        assert_that(next(rows), is_(["Sheet 2 content", None]))
+
+    def test_choosing_a_missing_sheet_is_a_parse_error(self):
+        rows = iter_workbook_rows(self._open_excel("multiple_sheets.xlsx"),
+                                  "Third")
+
+        self.assertRaisesRegexp(ParseError, 'no sheet named "Third"',
+                                next, rows)
+
+
+class CheckWorkbookRowsTestCase(unittest.TestCase):
+
+    def _row_problems(self, file_name, max_problems=10):
+        with open(fixture_path(file_name)) as file_stream:
+            book = open_excel(file_stream)
+        pipeline = record_pipeline(max_problems=max_problems)
+        list(pipeline.run(iter_workbook_rows(book)))
+        return pipeline.problems()
+
+    def test_every_row_with_an_error_is_found(self):
+        assert_that(self._row_problems("error.xlsx"), is_([
+            "Row 2 contains a cell with an error",
+            "Row 3 contains a cell with an error",
+        ]))
+
+    def test_checking_stops_at_the_most_problems(self):
+        assert_that(self._row_problems("error.xlsx", max_problems=1),
+                    is_(["Row 2 contains a cell with an error"]))
+
+    def test_a_good_workbook_has_no_problems(self):
+        assert_that(self._row_problems("data.xlsx"), is_([]))
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+from application.files.parsers.records import encode_records, Record, Schema
+
+from collections import Mapping
+import datetime
+import json
+import sys
+import unittest
+
+from hamcrest import assert_that, contains_inanyorder, equal_to, less_than
+from performanceplatform.client.base import JsonEncoder
+
+
+class TestRecord(unittest.TestCase):
+
+    def test_compares_equal_to_a_dict_of_the_row(self):
+        record = Record(Schema(['name', 'size']), ['bottle', 123])
+
+        assert_that(record, equal_to({'name': 'bottle', 'size': 123}))
+        assert_that({'name': 'bottle', 'size': 123}, equal_to(record))
+
+    def test_repeated_keys_take_the_last_value_like_a_dict(self):
+        header = ['name', 'size', 'name']
+        row = ['bottle', 123, 'mug']
+
+        record = Record(Schema(header), row)
+
+        assert_that(record, equal_to(dict(zip(header, row))))
+        assert_that(list(record), contains_inanyorder('name', 'size'))
+
+    def test_records_share_the_schema(self):
+        schema = Schema(['name', 'size'])
+
+        first = Record(schema, ['bottle', 123])
+        second = Record(schema, ['mug', 12])
+
+        assert_that(first.schema is second.schema, equal_to(True))
+
+    def test_is_much_smaller_than_a_dict(self):
+        header = ['column_{0}'.format(i) for i in range(20)]
+        row = range(20)
+
+        record = Record(Schema(header), row)
+
+        assert_that(sys.getsizeof(record),
+                    less_than(sys.getsizeof(dict(zip(header, row))) / 5))
+
+    def test_has_no_instance_dictionary(self):
+        record = Record(Schema(['name']), ['bottle'])
+
+        assert_that(hasattr(record, '__dict__'), equal_to(False))
+        self.assertRaises(AttributeError, setattr, record, 'extra', 1)
+
+    def test_works_as_a_mapping(self):
+        record = Record(Schema(['name', 'size']), ['bottle', 123])
+
+        assert_that(isinstance(record, Mapping), equal_to(True))
+        assert_that(dict(record), equal_to({'name': 'bottle', 'size': 123}))
+        assert_that(record.get('size'), equal_to(123))
+        assert_that(record.get('colour', 'green'), equal_to('green'))
+        assert_that(record.values(), equal_to(['bottle', 123]))
+        assert_that(dict(record.iteritems()), equal_to(dict(record.items())))
+        assert_that(record != {'name': 'bottle', 'size': 12}, equal_to(True))
+
+
+class TestEncodeRecords(unittest.TestCase):
+
+    def assert_encodes_like_json(self, header, rows):
+        schema = Schema(header)
+        records = [Record(schema, row) for row in rows]
+        dicts = [dict(zip(header, row)) for row in rows]
+
+        assert_that(json.loads(encode_records(records)),
+                    equal_to(json.loads(json.dumps(dicts, cls=JsonEncoder))))
+
+    def test_encodes_values_as_json_would(self):
+        self.assert_encodes_like_json(
+            [u'_timestamp', u'name', u'count', u'rate', u'flag', u'notes'],
+            [[u'2014-08-05T00:00:00Z', u'bottle "one"', 12, 1.5, True, None],
+             [u'2014-08-12T00:00:00Z', u'ümlaut, comma', 10 ** 20, -0.1,
+              False, u'50%']])
+
+    def test_encodes_special_floats_as_json_would(self):
+        encoded = encode_records([Record(
+            Schema(['a', 'b', 'c']),
+            [float('nan'), float('inf'), float('-inf')])])
+
+        assert_that(encoded,
+                    equal_to('[{"a": NaN, "b": Infinity, "c": -Infinity}]'))
+
+    def test_encodes_keys_as_json_would(self):
+        self.assert_encodes_like_json(
+            [2014, 1.5, None, u'%s'],
+            [[1, 2, 3, 4]])
+
+    def test_encodes_other_values_with_the_client_encoder(self):
+        self.assert_encodes_like_json(
+            ['when'],
+            [[datetime.datetime(2014, 8, 5)]])
+
+    def test_encodes_dicts_as_well_as_records(self):
+        assert_that(json.loads(encode_records([{'a': 1}])),
+                    equal_to([{'a': 1}]))
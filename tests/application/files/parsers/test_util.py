@@ -1,9 +1,11 @@
 from application.files.parsers import ParseError
-from application.files.parsers.util import make_dicts
+from application.files.parsers.util import (
+    batches, make_dicts, record_pipeline, remove_blanks, RowPipeline, Stage)
 
 import unittest
 
-from hamcrest import only_contains, assert_that
+from hamcrest import (only_contains, assert_that, contains_string, contains,
+                      equal_to, greater_than_or_equal_to)
 
 
 class TestMakeRecords(unittest.TestCase):
@@ -46,6 +48,21 @@ class TestMakeRecords(unittest.TestCase):
                           lambda rows: list(make_dicts(rows)),
                           rows)
 
+    def test_error_names_the_row_that_failed(self):
+        rows = [
+            ["name", "size"],
+            ["bottle", 123],
+            ["", ""],
+            ["screen"],
+        ]
+
+        try:
+            list(make_dicts(rows))
+        except ParseError as err:
+            assert_that(str(err), contains_string('row 4'))
+        else:
+            raise AssertionError('ParseError not raised')
+
     def test_works_if_given_an_iterator(self):
         def rows():
             yield ("name", "size")
@@ -88,3 +105,148 @@ class TestMakeRecords(unittest.TestCase):
             {'count': 818},
             {'count': 602},
         ))
+
+
+class TestRemoveBlanks(unittest.TestCase):
+
+    def test_does_not_read_ahead(self):
+        consumed = []
+
+        def rows():
+            for row in [['a'], [''], ['b'], ['c']]:
+                consumed.append(row)
+                yield row
+
+        assert_that(next(remove_blanks(rows())), equal_to(['a']))
+        assert_that(consumed, contains(['a']))
+
+
+class TestRowPipeline(unittest.TestCase):
+
+    def test_counts_rows_in_and_out_of_each_stage(self):
+        rows = [
+            ["name", "size"],
+            ["bottle", 123],
+            ["", ""],
+            [None, None],
+            ["mug", 12],
+        ]
+        pipeline = record_pipeline()
+
+        list(pipeline.run(rows))
+
+        counters = dict(pipeline.counters())
+        assert_that(counters['skip_blanks']['rows_in'], equal_to(4))
+        assert_that(counters['skip_blanks']['rows_dropped'], equal_to(2))
+        assert_that(counters['skip_blanks']['rows_out'], equal_to(2))
+        assert_that(counters['check_columns']['rows_in'], equal_to(2))
+        assert_that(counters['make_records']['rows_out'], equal_to(2))
+
+    def test_yields_each_record_before_reading_the_next_row(self):
+        consumed = []
+
+        def rows():
+            for row in [["name"], ["bottle"], ["screen"], ["mug"]]:
+                consumed.append(row)
+                yield row
+
+        records = record_pipeline().run(rows())
+
+        assert_that(next(records), equal_to({"name": "bottle"}))
+        assert_that(consumed, contains(["name"], ["bottle"]))
+
+    def test_rows_can_be_given_their_numbers(self):
+        pipeline = record_pipeline()
+
+        with self.assertRaises(ParseError) as context:
+            list(pipeline.run_numbered([(2, ["name"]), (5, ["mug", 1])]))
+
+        assert_that(str(context.exception),
+                    contains_string('first found in row 5'))
+
+    def test_stages_can_be_composed(self):
+        class SkipSmall(Stage):
+            name = 'skip_small'
+
+            def process(self, row_number, row):
+                return self.DROP if row[1] < 100 else row
+
+        pipeline = RowPipeline([SkipSmall()])
+
+        rows = list(pipeline.run([["name", "size"],
+                                  ["bottle", 123],
+                                  ["mug", 12]]))
+
+        assert_that(rows, contains(["bottle", 123]))
+        assert_that(str(pipeline),
+                    equal_to('skip_small: 2 in, 1 dropped, 1 out'))
+
+    def test_timed_pipeline_records_time_in_each_stage(self):
+        pipeline = record_pipeline(timed=True)
+
+        list(pipeline.run([["name"], ["bottle"], [""]]))
+
+        for name, counts in pipeline.counters():
+            assert_that(counts['seconds'], greater_than_or_equal_to(0))
+        assert_that(dict(pipeline.counters())['skip_blanks']['rows_dropped'],
+                    equal_to(1))
+
+
+class TestCheckRows(unittest.TestCase):
+
+    def test_bad_rows_are_listed_and_left_out(self):
+        pipeline = record_pipeline(max_problems=10)
+
+        records = list(pipeline.run([["name", "size"],
+                                     ["bottle"],
+                                     ["mug", 12],
+                                     ["pan", 3, 4]]))
+
+        assert_that(records, contains({"name": "mug", "size": 12}))
+        assert_that(pipeline.problems(), equal_to([
+            'Row 2 contains fewer values than columns',
+            'Row 4 contains more values than columns',
+        ]))
+
+    def test_stops_reading_once_enough_problems_are_found(self):
+        consumed = []
+
+        def rows():
+            for row in [["name"], ["a", "b"], ["c", "d"], ["mug"]]:
+                consumed.append(row)
+                yield row
+
+        pipeline = record_pipeline(max_problems=1)
+
+        assert_that(list(pipeline.run(rows())), equal_to([]))
+        assert_that(consumed, contains(["name"], ["a", "b"]))
+
+    def test_a_pipeline_which_is_not_checking_has_no_problems(self):
+        pipeline = record_pipeline()
+
+        list(pipeline.run([["name"], ["mug"]]))
+
+        assert_that(pipeline.problems(), equal_to([]))
+
+
+class TestBatches(unittest.TestCase):
+
+    def test_splits_into_batches_of_the_given_size(self):
+        assert_that(batches(iter(range(5)), 2), contains(
+            [0, 1],
+            [2, 3],
+            [4],
+        ))
+
+    def test_does_not_read_ahead_of_the_current_batch(self):
+        consumed = []
+
+        def rows():
+            for i in range(6):
+                consumed.append(i)
+                yield i
+
+        first_batch = next(batches(rows(), 2))
+
+        assert_that(first_batch, contains(0, 1))
+        assert_that(consumed, contains(0, 1))
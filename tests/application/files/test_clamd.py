@@ -0,0 +1,82 @@
+from StringIO import StringIO
+import unittest
+
+from hamcrest import assert_that, calling, equal_to, raises
+
+from application.files.clamd import ClamdError, ClamdScanner
+from tests.application.support.fake_clamd import EICAR, FakeClamd
+
+
+class TestClamdScanner(unittest.TestCase):
+
+    def setUp(self):
+        self.clamd = FakeClamd().start()
+        self.scanner = ClamdScanner(self.clamd.address, timeout=5)
+
+    def tearDown(self):
+        self.scanner.clear()
+        self.clamd.stop()
+
+    def test_clean_file(self):
+        assert_that(self.scanner.scan(StringIO('foo,bar\n1,2\n')),
+                    equal_to(False))
+
+    def test_virus(self):
+        assert_that(self.scanner.scan(StringIO('foo\n' + EICAR)),
+                    equal_to(True))
+
+    def test_large_files_are_sent_in_chunks(self):
+        assert_that(self.scanner.scan(StringIO('x' * 200000 + EICAR)),
+                    equal_to(True))
+
+    def test_connections_are_reused(self):
+        for _ in range(3):
+            self.scanner.scan(StringIO('foo'))
+
+        assert_that(self.clamd.server.connections, equal_to(1))
+        assert_that(self.clamd.server.scans, equal_to(['stream: OK'] * 3))
+
+    def test_a_file_can_be_scanned_as_it_arrives(self):
+        scan = self.scanner.start_scan()
+        scan.write('foo\n')
+        scan.write(EICAR)
+
+        assert_that(scan.result(), equal_to(True))
+
+    def test_scans_again_if_clamd_dropped_the_connection(self):
+        self.clamd.server.close_after_reply = True
+        self.scanner.scan(StringIO('foo'))
+        self.clamd.server.close_after_reply = False
+
+        assert_that(self.scanner.scan(StringIO(EICAR)), equal_to(True))
+        assert_that(self.clamd.server.connections, equal_to(2))
+
+    def test_idle_connections_are_not_reused_past_the_idle_timeout(self):
+        scanner = ClamdScanner(self.clamd.address, idle_timeout=-1)
+
+        scanner.scan(StringIO('foo'))
+        scanner.scan(StringIO('foo'))
+
+        assert_that(self.clamd.server.connections, equal_to(2))
+
+    def test_errors_from_clamd_are_raised(self):
+        self.clamd.server.reply = 'INSTREAM size limit exceeded. ERROR'
+
+        assert_that(calling(self.scanner.scan).with_args(StringIO('foo')),
+                    raises(ClamdError))
+        assert_that(len(self.clamd.server.scans), equal_to(1))
+
+    def test_cannot_connect(self):
+        scanner = ClamdScanner('unix:/no/such/clamd.ctl')
+
+        assert_that(calling(scanner.scan).with_args(StringIO('foo')),
+                    raises(ClamdError))
+
+    def test_over_tcp(self):
+        clamd = FakeClamd(tcp=True).start()
+        try:
+            scanner = ClamdScanner(clamd.address, timeout=5)
+            assert_that(scanner.scan(StringIO(EICAR)), equal_to(True))
+            scanner.clear()
+        finally:
+            clamd.stop()
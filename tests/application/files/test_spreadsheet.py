@@ -0,0 +1,303 @@
+from os import path
+from StringIO import StringIO
+import threading
+import unittest
+
+from hamcrest import assert_that, contains_string, equal_to, less_than
+from mock import patch
+from werkzeug.datastructures import FileStorage
+
+from application import app
+from application.files.clamd import ScanCancelled
+from application.files.parsers import BadRows, ParseError
+from application.files.parsers.excel import open_excel
+from application.files.spreadsheet import Spreadsheet, Workbook
+from application.files.uploaded import clamd_scanner
+from tests.application.support.fake_clamd import EICAR, FakeClamd
+
+FIXTURES = path.join(path.dirname(__file__), '..', '..', 'fixtures')
+
+
+def spreadsheet(content, filename='file.csv'):
+    return Spreadsheet(FileStorage(stream=StringIO(content),
+                                   filename=filename))
+
+
+class TestSpoolReader(unittest.TestCase):
+
+    def test_readers_read_the_file_independently(self):
+        upload = spreadsheet('a,b\n1,2\n3,4\n')
+        lock = threading.Lock()
+        first = upload.open_reader(lock)
+        second = upload.open_reader(lock)
+
+        assert_that(first.readline(), equal_to('a,b\n'))
+        assert_that(second.read(6), equal_to('a,b\n1,'))
+        assert_that(first.readline(), equal_to('1,2\n'))
+        assert_that(list(second), equal_to(['2\n', '3,4\n']))
+        assert_that(first.tell(), equal_to(8))
+
+    def test_seek_from_the_end(self):
+        reader = spreadsheet('a,b\n1,2\n').open_reader(threading.Lock())
+
+        reader.seek(-2, 2)
+
+        assert_that(reader.read(), equal_to('2\n'))
+
+
+class TestParse(unittest.TestCase):
+
+    def test_every_bad_row_of_a_csv_is_found(self):
+        problems, records = spreadsheet('a,b\n1\n2,3\n4,5,6').parse(10)
+
+        assert_that(problems, equal_to([
+            'Row 2 contains fewer values than columns',
+            'Row 4 contains more values than columns',
+        ]))
+        assert_that(records, equal_to(None))
+
+    def test_bad_rows_are_named_by_their_line_of_the_file(self):
+        upload = spreadsheet('# comment\na,b\n1,2\n\n,\n3,4,5\n6\n')
+
+        problems, records = upload.parse(10)
+
+        assert_that(problems, equal_to([
+            'Row 6 contains more values than columns',
+            'Row 7 contains fewer values than columns',
+        ]))
+
+    def test_cells_with_errors_are_found_in_excel_files(self):
+        with open(path.join(FIXTURES, 'error.xlsx'), 'rb') as fixture:
+            upload = spreadsheet(fixture.read(), 'error.xlsx')
+
+        assert_that(upload.parse(1),
+                    equal_to((['Row 2 contains a cell with an error'], None)))
+
+    def test_rows_are_checked_as_they_are_parsed(self):
+        with open(path.join(FIXTURES, 'data.xlsx'), 'rb') as fixture:
+            upload = spreadsheet(fixture.read(), 'data.xlsx')
+
+        with patch('application.files.spreadsheet.open_excel',
+                   wraps=open_excel) as open_excel_patch:
+            problems, records = upload.parse(10)
+
+        assert_that(problems, equal_to([]))
+        assert_that(len(records), equal_to(2))
+        assert_that(open_excel_patch.call_count, equal_to(1))
+
+    def test_only_the_first_bad_row_is_found_unless_asked(self):
+        problems, records = spreadsheet('a,b\n1\n2,3\n4,5,6').parse()
+
+        assert_that(problems, equal_to([
+            'Some rows in the CSV file contain fewer values than columns '
+            '(first found in row 2)']))
+
+    def test_a_bad_row_is_named_by_its_line_of_the_file(self):
+        upload = spreadsheet('# comment\na,b\n1,2\n\n,\n3,4,5\n6\n')
+
+        problems, records = upload.parse()
+
+        assert_that(problems, equal_to([
+            'Some rows in the CSV file contain more values than columns '
+            '(first found in row 6)']))
+
+    def test_checked_records_are_yielded_until_a_bad_row(self):
+        records = spreadsheet('a\n1\n2\n3,4\n5\n6,7').iter_json(
+            max_problems=10)
+
+        assert_that(next(records), equal_to({'a': 1}))
+        assert_that(next(records), equal_to({'a': 2}))
+        with self.assertRaises(BadRows) as context:
+            next(records)
+        assert_that(context.exception.problems(), equal_to([
+            'Row 4 contains more values than columns',
+            'Row 6 contains more values than columns',
+        ]))
+
+    def test_only_excel_files_have_sheets(self):
+        upload = Spreadsheet(FileStorage(stream=StringIO('a\n1'),
+                                         filename='file.csv'), sheet='Data')
+
+        assert_that(upload.parse(10), equal_to(
+            (['Only excel files have sheets to choose from'], None)))
+
+
+class TestValidateAndParse(unittest.TestCase):
+
+    def setUp(self):
+        self.clamd = FakeClamd().start()
+        self.old_config = dict(app.config)
+        app.config.update({
+            'VIRUS_CHECK': True,
+            'VIRUS_SCANNER': 'clamd',
+            'CLAMD_ADDRESS': self.clamd.address,
+        })
+
+    def tearDown(self):
+        clamd_scanner().clear()
+        app.config.clear()
+        app.config.update(self.old_config)
+        self.clamd.stop()
+
+    def test_clean_file_is_scanned_and_parsed(self):
+        problems, records = spreadsheet('a,b\n1,2\n3,4').validate_and_parse()
+
+        assert_that(problems, equal_to([]))
+        assert_that(records, equal_to([{'a': 1, 'b': 2}, {'a': 3, 'b': 4}]))
+        assert_that(self.clamd.server.scans, equal_to(['stream: OK']))
+
+    def test_excel_files_can_be_read_while_they_are_scanned(self):
+        with open(path.join(FIXTURES, 'data.xlsx'), 'rb') as fixture:
+            content = fixture.read()
+
+        problems, records = spreadsheet(
+            content, 'data.xlsx').validate_and_parse()
+
+        assert_that(problems, equal_to([]))
+        assert_that(records, equal_to(
+            spreadsheet(content, 'data.xlsx').as_json()))
+        assert_that(len(records), equal_to(2))
+
+    def test_no_records_are_returned_for_a_virus(self):
+        problems, records = spreadsheet(
+            'a\n1\n' + EICAR + '\n').validate_and_parse()
+
+        assert_that(problems, equal_to(['File may contain a virus']))
+        assert_that(records, equal_to(None))
+
+    def test_parse_errors_are_problems(self):
+        problems, records = spreadsheet(
+            'a,b\n1,2\n3').validate_and_parse()
+
+        assert_that(problems[0], contains_string('first found in row 3'))
+        assert_that(records, equal_to(None))
+
+    def test_every_bad_row_is_returned_when_asked_for(self):
+        problems, records = spreadsheet(
+            'a,b\n1,2\n3\n4,5\n6').validate_and_parse(max_row_problems=10)
+
+        assert_that(problems, equal_to([
+            'Row 3 contains fewer values than columns',
+            'Row 5 contains fewer values than columns',
+        ]))
+        assert_that(records, equal_to(None))
+
+    def test_a_virus_is_reported_rather_than_bad_rows(self):
+        with patch.object(Spreadsheet, 'is_virus', return_value=True):
+            problems, records = spreadsheet(
+                'a,b\n1\n2\n').validate_and_parse(max_row_problems=10)
+
+        assert_that(problems, equal_to(['File may contain a virus']))
+
+    def test_invalid_files_are_neither_scanned_nor_parsed(self):
+        problems, records = spreadsheet(
+            'a\n1', 'file.png').validate_and_parse()
+
+        assert_that(problems,
+                    equal_to(['Invalid content type for file "image/png"']))
+        assert_that(self.clamd.server.connections, equal_to(0))
+
+    def test_parse_error_cancels_the_scan(self):
+        scan = {}
+
+        def slow_scan(stream, cancelled):
+            scan['cancelled'] = cancelled.wait(5)
+            raise ScanCancelled()
+
+        with patch.object(Spreadsheet, 'is_virus', side_effect=slow_scan):
+            problems, records = spreadsheet(
+                'a,b\n1,2\n3').validate_and_parse()
+
+        assert_that(scan['cancelled'], equal_to(True))
+        assert_that(problems[0], contains_string('first found in row 3'))
+
+    def test_virus_cancels_the_parse(self):
+        parsed = []
+
+        def endless_records(stream, max_problems=None):
+            while len(parsed) < 10 ** 7:
+                parsed.append({'a': 1})
+                yield parsed[-1]
+
+        with patch.object(Spreadsheet, 'is_virus', return_value=True), \
+                patch.object(Spreadsheet, 'iter_json',
+                             side_effect=endless_records):
+            problems, records = spreadsheet('a\n1').validate_and_parse()
+
+        assert_that(problems, equal_to(['File may contain a virus']))
+        assert_that(records, equal_to(None))
+        assert_that(len(parsed), less_than(10 ** 7))
+
+    def test_without_virus_check_the_file_is_only_parsed(self):
+        app.config['VIRUS_CHECK'] = False
+
+        problems, records = spreadsheet('a\n' + EICAR).validate_and_parse()
+
+        assert_that(problems, equal_to([]))
+        assert_that(records, equal_to([{'a': EICAR}]))
+        assert_that(self.clamd.server.connections, equal_to(0))
+
+
+class TestWorkbook(unittest.TestCase):
+
+    def setUp(self):
+        with open(path.join(FIXTURES, 'multiple_sheets.xlsx'), 'rb') as f:
+            self.content = f.read()
+        self.old_config = dict(app.config)
+        app.config['VIRUS_CHECK'] = True
+
+    def tearDown(self):
+        app.config.clear()
+        app.config.update(self.old_config)
+
+    def workbook(self, sheet_names, content=None, filename='data.xlsx'):
+        return Workbook(FileStorage(stream=StringIO(content or self.content),
+                                    filename=filename), sheet_names)
+
+    def test_each_sheet_is_read_from_one_opening(self):
+        workbook = self.workbook(['First', 'Second'])
+
+        with patch('application.files.spreadsheet.open_excel',
+                   wraps=open_excel) as open_excel_patch:
+            first = workbook.sheet('First').as_json()
+            second = workbook.sheet('Second').as_json()
+
+        assert_that(first, equal_to([{'Sheet 1 content': 'Nothing exciting'}]))
+        assert_that(len(second), equal_to(3))
+        assert_that(open_excel_patch.call_count, equal_to(1))
+
+    def test_the_workbook_is_scanned_once_for_all_its_sheets(self):
+        workbook = self.workbook(['First', 'Second'])
+
+        with patch.object(Workbook, 'is_virus',
+                          return_value=False) as is_virus:
+            first = workbook.sheet('First').validate()
+            second, _ = workbook.sheet('Second').validate_and_parse()
+
+        assert_that(first + second, equal_to([]))
+        assert_that(is_virus.call_count, equal_to(1))
+
+    def test_sheets_share_the_workbooks_file(self):
+        workbook = self.workbook(['First'])
+        sheet = workbook.sheet('First', max_file_size=10)
+
+        assert_that(sheet.file, equal_to(workbook.file))
+        assert_that(sheet.validate_without_scan(), equal_to(
+            ['File is too big ({0})'.format(len(self.content))]))
+
+        sheet.cleanup()
+        assert_that(workbook.file.closed, equal_to(False))
+
+    def test_missing_sheets_are_problems(self):
+        sheet = self.workbook(['Third']).sheet('Third')
+
+        assert_that(sheet.parse(10),
+                    equal_to((['There is no sheet named "Third"'], None)))
+        with self.assertRaises(ParseError):
+            sheet.as_json()
+
+    def test_only_excel_files_have_sheets(self):
+        sheet = self.workbook(['Data'], 'a\n1', 'file.csv').sheet('Data')
+
+        assert_that(sheet.parse(10), equal_to(
+            (['Only excel files have sheets to choose from'], None)))
@@ -0,0 +1,174 @@
+import hashlib
+import json
+import time
+import unittest
+import zlib
+
+from hamcrest import (
+    assert_that, equal_to, greater_than, has_entries, less_than)
+from mock import patch
+from performanceplatform.client.data_set import DataSet
+from requests import ConnectionError, HTTPError, ReadTimeout, Response
+
+from application import app
+from application.files.parsers import ParseError
+from application.files.parsers.records import (
+    encode_records, iter_encoded_records, Record, Schema)
+from application.files.streaming import (
+    CountedRecords, gzip_stream, MAX_TRIES, post_gzip_stream,
+    StreamingAdapter)
+from tests.application.support.fake_backdrop import FakeBackdrop
+
+
+def gunzip(data):
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+
+class TestGzipStream(unittest.TestCase):
+
+    def test_pieces_are_compressed_into_one_gzip(self):
+        pieces = ['{"a": %d}, ' % number for number in range(10000)]
+
+        chunks = list(gzip_stream(pieces, chunk_size=1024))
+
+        assert_that(len(chunks), greater_than(1))
+        assert_that(gunzip(''.join(chunks)), equal_to(''.join(pieces)))
+
+    def test_nothing_to_compress(self):
+        assert_that(gunzip(''.join(gzip_stream([]))), equal_to(''))
+
+    def test_encoded_pieces_join_to_the_encoded_records(self):
+        schema = Schema(['name', 'size'])
+        records = [Record(schema, [u'bottle', 1.5]), {'a': None}]
+
+        assert_that(''.join(iter_encoded_records(records)),
+                    equal_to(encode_records(records)))
+        assert_that(''.join(iter_encoded_records([])), equal_to('[]'))
+
+    def test_records_are_counted_as_they_are_taken(self):
+        records = CountedRecords(iter([{'a': 1}, {'a': 2}]))
+
+        assert_that(list(records), equal_to([{'a': 1}, {'a': 2}]))
+        assert_that(records.count, equal_to(2))
+
+
+class TestPostGzipStream(unittest.TestCase):
+
+    def setUp(self):
+        self.backdrop = FakeBackdrop().start()
+        self.data_set = DataSet(self.backdrop.url + '/data/group/type',
+                                'abc123', retry_on_error=False)
+
+    def tearDown(self):
+        self.backdrop.stop()
+
+    def test_records_are_posted_compressed_in_chunks(self):
+        records = [{'_timestamp': '2014-01-01', 'count': n}
+                   for n in range(5000)]
+
+        post_gzip_stream(self.data_set, iter(records))
+
+        request = self.backdrop.server.requests[0]
+        assert_that(request['path'], equal_to('/data/group/type'))
+        assert_that(request['payload'], equal_to(records))
+        assert_that(request['headers'], has_entries({
+            'authorization': 'Bearer abc123',
+            'content-encoding': 'gzip',
+            'content-type': 'application/json',
+            'transfer-encoding': 'chunked',
+            'govuk-request-id': 'Not-Set',
+        }))
+        assert_that(request['body_size'],
+                    less_than(len(json.dumps(records)) / 5))
+
+    def test_error_responses_raise_http_errors(self):
+        self.backdrop.server.reply = (400, {'messages': ['bad count']})
+
+        with self.assertRaises(HTTPError) as raised:
+            post_gzip_stream(self.data_set, [{'count': 'x'}])
+
+        assert_that(raised.exception.response.json(),
+                    equal_to({'messages': ['bad count']}))
+
+    def test_parse_error_stops_the_request_part_way(self):
+        def records():
+            for n in range(5000):
+                yield {'count': n, 'id': hashlib.sha1(str(n)).hexdigest()}
+            raise ParseError('Bad row')
+
+        with self.assertRaises(ParseError):
+            post_gzip_stream(self.data_set, records())
+
+        for _ in range(100):
+            if self.backdrop.server.incomplete:
+                break
+            time.sleep(0.01)
+        assert_that(self.backdrop.server.requests, equal_to([]))
+        assert_that(self.backdrop.server.incomplete, equal_to(1))
+
+    def test_the_clients_request_id_is_sent(self):
+        data_set = DataSet(self.backdrop.url + '/data/group/type', 'abc123',
+                           retry_on_error=False,
+                           request_id_fn=lambda: 'request-123')
+
+        post_gzip_stream(data_set, [{'count': 1}])
+
+        assert_that(self.backdrop.server.requests[0]['headers'],
+                    has_entries({'govuk-request-id': 'request-123'}))
+
+    def test_a_stalled_backdrop_times_out(self):
+        self.backdrop.server.delay = 0.5
+        app.config['BACKDROP_READ_TIMEOUT'] = 0.1
+        try:
+            with self.assertRaises(ReadTimeout):
+                post_gzip_stream(self.data_set, [{'count': 1}])
+        finally:
+            app.config['BACKDROP_READ_TIMEOUT'] = 300
+
+    @patch('application.files.streaming.time.sleep')
+    @patch('requests.Session.post')
+    def test_is_tried_again_if_it_could_not_connect(self, post, sleep):
+        data_set = DataSet(self.backdrop.url + '/data/group/type', 'abc123')
+        post.side_effect = [ConnectionError('refused'),
+                            ConnectionError('refused'),
+                            self.backdrop_response(200)]
+
+        post_gzip_stream(data_set, [{'count': 1}])
+
+        assert_that(post.call_count, equal_to(3))
+
+    @patch('requests.Session.post')
+    def test_is_not_tried_again_once_records_were_sent(self, post):
+        data_set = DataSet(self.backdrop.url + '/data/group/type', 'abc123')
+
+        def send(url, data, **kwargs):
+            list(data)
+            raise ConnectionError('reset')
+        post.side_effect = send
+
+        with self.assertRaises(ConnectionError):
+            post_gzip_stream(data_set, [{'count': 1}])
+        assert_that(post.call_count, equal_to(1))
+
+    @patch('application.files.streaming.time.sleep')
+    def test_refused_connections_raise_connection_errors(self, sleep):
+        data_set = DataSet('http://127.0.0.1:1/data/group/type', 'abc123')
+
+        with patch.object(StreamingAdapter, 'send', autospec=True,
+                          side_effect=StreamingAdapter.send) as send:
+            with self.assertRaises(ConnectionError):
+                post_gzip_stream(data_set, [{'count': 1}])
+        assert_that(send.call_count, equal_to(MAX_TRIES))
+
+    @patch('requests.Session.post')
+    def test_is_not_tried_again_when_the_client_would_not(self, post):
+        post.side_effect = ConnectionError('refused')
+
+        with self.assertRaises(ConnectionError):
+            post_gzip_stream(self.data_set, [{'count': 1}])
+        assert_that(post.call_count, equal_to(1))
+
+    def backdrop_response(self, status):
+        response = Response()
+        response.status_code = status
+        return response
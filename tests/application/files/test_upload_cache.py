@@ -0,0 +1,104 @@
+import unittest
+
+from hamcrest import assert_that, equal_to, less_than_or_equal_to
+
+from application import app
+from application.files.parsers.records import Record, Schema
+from application.files.upload_cache import CachedUpload, UploadCache
+
+DATA_SET = {
+    'data_group': 'carers-allowance',
+    'data_type': 'volumetrics',
+}
+
+OTHER_DATA_SET = {
+    'data_group': 'carers-allowance',
+    'data_type': 'weekly-claims',
+}
+
+
+class TestUploadCache(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = app.redis_instance
+        self.cache = UploadCache(self.redis, ttl=60, max_bytes=1000)
+
+    def tearDown(self):
+        for key in self.redis.keys(UploadCache.PREFIX + '*'):
+            self.redis.delete(key)
+
+    def test_unknown_uploads_are_not_found(self):
+        assert_that(self.cache.find('abc', DATA_SET), equal_to(None))
+
+    def test_stored_upload_is_found_for_its_data_set_only(self):
+        schema = Schema(['foo'])
+        self.cache.store('abc', DATA_SET, is_virus=False,
+                         records=[Record(schema, [1]), Record(schema, [2])])
+
+        assert_that(self.cache.find('abc', DATA_SET), equal_to(CachedUpload(
+            is_virus=False, records=[{'foo': 1}, {'foo': 2}])))
+        assert_that(self.cache.find('abc', OTHER_DATA_SET), equal_to(None))
+
+    def test_upload_which_was_not_scanned(self):
+        self.cache.store('abc', DATA_SET, is_virus=None)
+
+        assert_that(self.cache.find('abc', DATA_SET), equal_to(CachedUpload(
+            is_virus=None, records=None)))
+
+    def test_only_the_last_content_posted_to_a_data_set_is_kept(self):
+        assert_that(self.cache.last_posted(DATA_SET), equal_to(None))
+
+        self.cache.store_posted('abc', DATA_SET)
+        self.cache.store_posted('def', DATA_SET)
+
+        assert_that(self.cache.last_posted(DATA_SET), equal_to('def'))
+        assert_that(self.cache.last_posted(OTHER_DATA_SET), equal_to(None))
+        ttl = self.redis.ttl(self.cache.last_posted_key(DATA_SET))
+        assert_that(0 < ttl <= 60, equal_to(True))
+
+        self.cache.forget_posted(DATA_SET)
+
+        assert_that(self.cache.last_posted(DATA_SET), equal_to(None))
+
+    def test_entries_expire(self):
+        self.cache.store('abc', DATA_SET, is_virus=True)
+
+        ttl = self.redis.ttl(self.cache.key('abc', DATA_SET))
+        assert_that(0 < ttl <= 60, equal_to(True))
+
+    def test_records_too_big_for_the_cache_are_not_kept(self):
+        self.cache.store('abc', DATA_SET, is_virus=False,
+                         records=[{'foo': 'x' * 1000}])
+
+        assert_that(self.cache.find('abc', DATA_SET).records, equal_to(None))
+
+    def test_oldest_entries_are_removed_to_stay_under_the_limit(self):
+        for content_hash in ['first', 'second', 'third']:
+            self.cache.store(content_hash, DATA_SET, is_virus=False,
+                             records=[{'foo': 'x' * 400}])
+
+        assert_that(self.cache.find('first', DATA_SET), equal_to(None))
+        assert_that(self.cache.find('third', DATA_SET).records,
+                    equal_to([{'foo': 'x' * 400}]))
+        assert_that(
+            sum(int(size) for size in
+                self.redis.hvals(UploadCache.SIZES)),
+            less_than_or_equal_to(1000))
+
+    def test_storing_an_upload_again_replaces_it(self):
+        self.cache.store('abc', DATA_SET, is_virus=False,
+                         records=[{'foo': 1}])
+        self.cache.store('abc', DATA_SET, is_virus=False)
+
+        assert_that(self.cache.find('abc', DATA_SET), equal_to(CachedUpload(
+            is_virus=False, records=None)))
+        assert_that(self.redis.zcard(UploadCache.INDEX), equal_to(1))
+
+    def test_expired_entries_are_forgotten(self):
+        self.cache.store('abc', DATA_SET, is_virus=False)
+        self.redis.delete(self.cache.key('abc', DATA_SET))
+
+        self.cache.store('def', DATA_SET, is_virus=False)
+
+        assert_that(self.redis.zrange(UploadCache.INDEX, 0, -1),
+                    equal_to([self.cache.key('def', DATA_SET)]))
@@ -0,0 +1,101 @@
+import unittest
+
+from hamcrest import assert_that, equal_to
+
+from application import app
+from application.files.parsers.records import Record, Schema
+from application.files.upload_deltas import (
+    auto_ids, row_fingerprints, RowFingerprints)
+
+DATA_SET = {
+    'data_group': 'carers-allowance',
+    'data_type': 'digital-takeup',
+    'auto_ids': '_timestamp, channel',
+}
+
+
+class TestRowFingerprints(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = app.redis_instance
+
+    def tearDown(self):
+        for key in self.redis.keys(RowFingerprints.PREFIX + '*'):
+            self.redis.delete(key)
+        app.config['UPLOAD_DELTAS'] = False
+
+    def fingerprints(self):
+        return RowFingerprints(self.redis, DATA_SET,
+                               auto_ids(DATA_SET), ttl=60)
+
+    def test_every_row_is_new_at_first(self):
+        records = [{'_timestamp': 'a', 'channel': 'web', 'count': 1}]
+        fingerprints = self.fingerprints()
+
+        assert_that(list(fingerprints.changed(records)), equal_to(records))
+
+    def test_only_new_and_changed_rows_are_sent_after_a_save(self):
+        first = self.fingerprints()
+        list(first.changed([
+            {'_timestamp': 'a', 'channel': 'web', 'count': 1},
+            {'_timestamp': 'a', 'channel': 'phone', 'count': 2},
+        ]))
+        first.save()
+
+        second = self.fingerprints()
+        changed = list(second.changed([
+            {'_timestamp': 'a', 'channel': 'web', 'count': 1},
+            {'_timestamp': 'a', 'channel': 'phone', 'count': 3},
+            {'_timestamp': 'b', 'channel': 'web', 'count': 4},
+        ]))
+
+        assert_that(changed, equal_to([
+            {'_timestamp': 'a', 'channel': 'phone', 'count': 3},
+            {'_timestamp': 'b', 'channel': 'web', 'count': 4},
+        ]))
+        assert_that(str(second),
+                    equal_to('2 of 3 rows sent, the rest unchanged'))
+
+    def test_rows_are_not_remembered_until_saved(self):
+        records = [{'_timestamp': 'a', 'channel': 'web', 'count': 1}]
+        list(self.fingerprints().changed(records))
+
+        assert_that(list(self.fingerprints().changed(records)),
+                    equal_to(records))
+
+    def test_records_and_dictionaries_of_a_row_are_the_same(self):
+        first = self.fingerprints()
+        list(first.changed([Record(Schema(['_timestamp', 'channel', 'n']),
+                                   ['a', 'web', 1.5])]))
+        first.save()
+
+        assert_that(list(self.fingerprints().changed([
+            {u'n': 1.5, u'channel': u'web', u'_timestamp': u'a'}])),
+            equal_to([]))
+
+    def test_rows_missing_an_id_are_always_sent(self):
+        records = [{'_timestamp': 'a', 'count': 1}]
+        first = self.fingerprints()
+        list(first.changed(records))
+        first.save()
+
+        assert_that(list(self.fingerprints().changed(records)),
+                    equal_to(records))
+
+    def test_fingerprints_expire(self):
+        fingerprints = self.fingerprints()
+        list(fingerprints.changed([{'_timestamp': 'a', 'channel': 'web'}]))
+        fingerprints.save()
+
+        assert_that(0 < self.redis.ttl(fingerprints.key) <= 60,
+                    equal_to(True))
+
+    def test_only_data_sets_with_auto_ids_are_sent_deltas(self):
+        app.config['UPLOAD_DELTAS'] = True
+
+        assert_that(row_fingerprints(DATA_SET) is not None, equal_to(True))
+        assert_that(row_fingerprints(dict(DATA_SET, auto_ids=[])),
+                    equal_to(None))
+
+    def test_deltas_are_off_by_default(self):
+        assert_that(row_fingerprints(DATA_SET), equal_to(None))
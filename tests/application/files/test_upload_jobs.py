@@ -0,0 +1,254 @@
+from io import BytesIO
+import threading
+import time
+import unittest
+
+from hamcrest import assert_that, equal_to, has_entries, is_not, has_key
+from werkzeug.datastructures import FileStorage
+
+from application import app
+from application.files.upload_jobs import UploadJob, UploadWorkers
+
+DATA_SET = {
+    'data_group': 'carers-allowance',
+    'data_type': 'volumetrics',
+    'bearer_token': 'abc123',
+}
+
+
+def file_storage(content='foo\n1\n'):
+    return FileStorage(stream=BytesIO(content), filename='data.csv')
+
+
+class TestUploadJob(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = app.redis_instance
+
+    def tearDown(self):
+        for key in self.redis.keys(UploadJob.PREFIX + '*'):
+            self.redis.delete(key)
+
+    def test_a_new_job_is_queued(self):
+        job = UploadJob.create(self.redis, DATA_SET, file_storage())
+
+        assert_that(job.state(), has_entries({
+            'job_id': job.job_id,
+            'data_group': 'carers-allowance',
+            'data_type': 'volumetrics',
+            'filename': 'data.csv',
+            'stage': 'queued',
+            'rows': 0,
+        }))
+        assert_that(UploadJob.next_queued(self.redis).job_id,
+                    equal_to(job.job_id))
+        assert_that(UploadJob.next_queued(self.redis), equal_to(None))
+
+    def test_jobs_are_taken_from_the_queue_in_order(self):
+        first = UploadJob.create(self.redis, DATA_SET, file_storage())
+        second = UploadJob.create(self.redis, DATA_SET, file_storage())
+
+        assert_that(UploadJob.next_queued(self.redis).job_id,
+                    equal_to(first.job_id))
+        assert_that(UploadJob.next_queued(self.redis).job_id,
+                    equal_to(second.job_id))
+
+    def test_expired_jobs_are_skipped(self):
+        expired = UploadJob.create(self.redis, DATA_SET, file_storage())
+        queued = UploadJob.create(self.redis, DATA_SET, file_storage())
+        self.redis.delete(expired.key)
+
+        assert_that(UploadJob.next_queued(self.redis).job_id,
+                    equal_to(queued.job_id))
+
+    def test_the_state_does_not_include_the_bearer_token(self):
+        job = UploadJob.create(self.redis, DATA_SET, file_storage())
+
+        assert_that(job.state(), is_not(has_key('data_set')))
+        assert_that(self.redis.hgetall(job.key), is_not(has_key('data_set')))
+        assert_that(job.data_set(), equal_to(DATA_SET))
+
+    def test_the_file_is_kept_for_the_worker(self):
+        job = UploadJob.create(self.redis, DATA_SET, file_storage('a\n1\n'))
+
+        uploaded = job.file_storage()
+
+        assert_that(uploaded.filename, equal_to('data.csv'))
+        assert_that(uploaded.stream.read(), equal_to('a\n1\n'))
+
+    def test_progress_is_recorded(self):
+        job = UploadJob.create(self.redis, DATA_SET, file_storage())
+
+        job.update('uploading', 200)
+
+        assert_that(job.state(), has_entries({
+            'stage': 'uploading',
+            'rows': 200,
+        }))
+
+    def test_finishing_records_the_result_and_removes_the_file(self):
+        job = UploadJob.create(self.redis, DATA_SET, file_storage())
+
+        job.finish(400, ['bad foo'])
+
+        assert_that(job.is_finished(), equal_to(True))
+        assert_that(job.state(), has_entries({
+            'stage': 'finished',
+            'status_code': 400,
+            'payload': ['bad foo'],
+        }))
+        assert_that(self.redis.exists(job.file_key), equal_to(False))
+        assert_that(self.redis.exists(job.data_set_key), equal_to(False))
+
+    def test_finished_job_says_whether_the_file_was_unchanged(self):
+        job = UploadJob.create(self.redis, DATA_SET, file_storage())
+        assert_that(job.state()['unchanged'], equal_to(False))
+
+        job.finish(200, [], unchanged=True)
+
+        assert_that(job.state()['unchanged'], equal_to(True))
+
+    def test_jobs_expire(self):
+        app.config['UPLOAD_JOB_TTL'] = 60
+        try:
+            job = UploadJob.create(self.redis, DATA_SET, file_storage())
+        finally:
+            app.config['UPLOAD_JOB_TTL'] = 24 * 60 * 60
+
+        assert_that(self.redis.ttl(job.key), equal_to(60))
+        assert_that(self.redis.ttl(job.file_key), equal_to(60))
+
+    def test_the_file_and_token_expire_before_the_job(self):
+        job = UploadJob.create(self.redis, DATA_SET, file_storage())
+
+        assert_that(self.redis.ttl(job.key), equal_to(24 * 60 * 60))
+        assert_that(self.redis.ttl(job.file_key), equal_to(60 * 60))
+        assert_that(self.redis.ttl(job.data_set_key), equal_to(60 * 60))
+
+        self.redis.delete(job.data_set_key)
+        assert_that(job.data_set(), equal_to(None))
+
+    def test_unknown_jobs_are_not_found(self):
+        assert_that(UploadJob.find(self.redis, 'no-such-job'), equal_to(None))
+
+
+class TestStaleUploadJobs(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = app.redis_instance
+
+    def tearDown(self):
+        for key in self.redis.keys(UploadJob.PREFIX + '*'):
+            self.redis.delete(key)
+
+    def processing(self):
+        return self.redis.lrange(UploadJob.PROCESSING, 0, -1)
+
+    def test_a_taken_job_is_worked_on_with_a_heartbeat(self):
+        queued = UploadJob.create(self.redis, DATA_SET, file_storage())
+
+        job = UploadJob.next_queued(self.redis)
+
+        assert_that(job.job_id, equal_to(queued.job_id))
+        assert_that(self.processing(), equal_to([job.job_id]))
+        assert_that(self.redis.ttl(job.heartbeat_key), equal_to(60))
+
+        job.finish(200, [])
+
+        assert_that(self.processing(), equal_to([]))
+        assert_that(self.redis.exists(job.heartbeat_key), equal_to(False))
+
+    def test_jobs_with_a_heartbeat_are_left_alone(self):
+        UploadJob.create(self.redis, DATA_SET, file_storage())
+        job = UploadJob.next_queued(self.redis)
+
+        assert_that(UploadJob.recover_stale(self.redis), equal_to([]))
+        assert_that(self.processing(), equal_to([job.job_id]))
+
+    def test_a_job_which_died_before_posting_is_queued_again(self):
+        UploadJob.create(self.redis, DATA_SET, file_storage())
+        waiting = UploadJob.create(self.redis, DATA_SET, file_storage())
+        job = UploadJob.next_queued(self.redis)
+        job.update('validating')
+        self.redis.delete(job.heartbeat_key)
+
+        UploadJob.recover_stale(self.redis)
+
+        assert_that(job.state()['stage'], equal_to('queued'))
+        assert_that(self.processing(), equal_to([]))
+        assert_that(UploadJob.next_queued(self.redis).job_id,
+                    equal_to(job.job_id))
+        assert_that(UploadJob.next_queued(self.redis).job_id,
+                    equal_to(waiting.job_id))
+
+    def test_a_job_which_died_while_posting_fails(self):
+        UploadJob.create(self.redis, DATA_SET, file_storage())
+        job = UploadJob.next_queued(self.redis)
+        job.update('uploading', 1000)
+        self.redis.delete(job.heartbeat_key)
+
+        UploadJob.recover_stale(self.redis)
+
+        state = job.state()
+        assert_that(state['stage'], equal_to('finished'))
+        assert_that(state['status_code'], equal_to(500))
+        assert_that(self.redis.exists(job.data_set_key), equal_to(False))
+        assert_that(UploadJob.next_queued(self.redis), equal_to(None))
+
+    def test_a_job_which_keeps_dying_fails(self):
+        UploadJob.create(self.redis, DATA_SET, file_storage())
+        for _ in range(UploadJob.MAX_ATTEMPTS):
+            job = UploadJob.next_queued(self.redis)
+            self.redis.delete(job.heartbeat_key)
+            UploadJob.recover_stale(self.redis)
+
+        assert_that(job.is_finished(), equal_to(True))
+        assert_that(UploadJob.next_queued(self.redis), equal_to(None))
+
+
+class TestUploadWorkers(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = app.redis_instance
+        self.workers = UploadWorkers('UPLOAD_JOB_WORKERS', 2,
+                                     poll_interval=0.05)
+
+    def tearDown(self):
+        self.workers.stop()
+        for key in self.redis.keys(UploadJob.PREFIX + '*'):
+            self.redis.delete(key)
+
+    def test_queued_jobs_are_run_without_being_asked(self):
+        ran = threading.Event()
+
+        def run_job(job):
+            job.finish(200, [])
+            ran.set()
+
+        job = UploadJob.create(self.redis, DATA_SET, file_storage())
+        self.workers.start(self.redis, run_job)
+
+        assert_that(ran.wait(5), equal_to(True))
+        assert_that(job.is_finished(), equal_to(True))
+
+    def test_a_running_job_keeps_its_heartbeat(self):
+        app.config['UPLOAD_JOB_HEARTBEAT_TIMEOUT'] = 1
+        running = threading.Event()
+        release = threading.Event()
+
+        def run_job(job):
+            running.set()
+            release.wait(5)
+            job.finish(200, [])
+
+        try:
+            job = UploadJob.create(self.redis, DATA_SET, file_storage())
+            self.workers.start(self.redis, run_job)
+            running.wait(5)
+            time.sleep(1.5)
+
+            assert_that(self.redis.exists(job.heartbeat_key), equal_to(True))
+            assert_that(UploadJob.recover_stale(self.redis), equal_to([]))
+        finally:
+            release.set()
+            app.config['UPLOAD_JOB_HEARTBEAT_TIMEOUT'] = 60
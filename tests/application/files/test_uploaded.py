@@ -1,4 +1,6 @@
+from StringIO import StringIO
 import os
+import tempfile
 import unittest
 
 from functools import wraps
@@ -6,8 +8,10 @@ from mock import patch
 from nose.tools import eq_
 from werkzeug.datastructures import FileStorage
 
-from application.files.uploaded import UploadedFile
+from application.files.uploaded import (
+    clamd_scanner, UploadedFile, UploadSpool)
 from application import app
+from tests.application.support.fake_clamd import EICAR, FakeClamd
 
 TEST_FILE_PATH = '/tmp/test-uploaded-file'
 
@@ -84,15 +88,66 @@ class TestUploadedFile(unittest.TestCase):
     def test_file_gets_cleaned_up(self):
         uploaded_file = UploadedFile(create_file_storage(''))
 
-        eq_(os.path.isfile(uploaded_file.filename), True)
+        eq_(uploaded_file.file.closed, False)
         uploaded_file.cleanup()
-        eq_(os.path.isfile(uploaded_file.filename), False)
+        eq_(uploaded_file.file.closed, True)
 
         with UploadedFile(create_file_storage('')) as with_ufile:
-            filename = with_ufile.filename
-            eq_(os.path.isfile(with_ufile.filename), True)
+            eq_(with_ufile.file.closed, False)
+
+        eq_(with_ufile.file.closed, True)
+
+    def test_small_files_are_kept_in_memory(self):
+        uploaded_file = UploadedFile(create_file_storage('a,b\n1,2'))
+
+        eq_(uploaded_file.file._rolled, False)
+        eq_(uploaded_file.open().read(), 'a,b\n1,2')
+
+    def test_large_files_are_spooled_to_disk(self):
+        old = app.config.get('UPLOAD_SPOOL_SIZE')
+        app.config['UPLOAD_SPOOL_SIZE'] = 10
+        try:
+            uploaded_file = UploadedFile(create_file_storage('a' * 100))
+        finally:
+            app.config['UPLOAD_SPOOL_SIZE'] = old
+
+        eq_(uploaded_file.file._rolled, True)
+        eq_(uploaded_file.open().read(), 'a' * 100)
+
+    def test_files_are_spooled_to_the_configured_directory(self):
+        directory = tempfile.mkdtemp()
+        try:
+            spool = UploadSpool(1000, spool_size=10, directory=directory)
+            spool.write('a' * 100)
+
+            stat = os.fstat(spool.fileno())
+            eq_(stat.st_dev, os.stat(directory).st_dev)
+            eq_(stat.st_nlink, 0)
+            eq_(os.listdir(directory), [])
+            spool.close()
+        finally:
+            os.rmdir(directory)
+
+    def test_uploads_with_the_same_name_do_not_share_a_file(self):
+        first = UploadedFile(FileStorage(
+            stream=StringIO('a' * 100), filename='data.csv'), 1000)
+        second = UploadedFile(FileStorage(
+            stream=StringIO('b' * 100), filename='data.csv'), 1000)
+        first.file.rollover()
+        second.file.rollover()
+
+        first.cleanup()
+
+        eq_(second.open().read(), 'b' * 100)
+        second.cleanup()
+
+    def test_stops_storing_files_past_the_size_limit(self):
+        uploaded_file = UploadedFile(create_file_storage('a' * 100),
+                                     max_file_size=10)
 
-        eq_(os.path.isfile(filename), False)
+        eq_(uploaded_file.is_too_big(), True)
+        eq_(uploaded_file.file_size, 100)
+        eq_(uploaded_file.open().read(), 'a' * 10)
 
     @patch('application.files.uploaded.Popen')
     def test_virus_scanning(self, mock_Popen):
@@ -111,3 +166,78 @@ class TestUploadedFile(unittest.TestCase):
         app.config['VIRUS_CHECK'] = True
         eq_(uploaded_file.validate(), ['File may contain a virus'])
         app.config['VIRUS_CHECK'] = old
+
+
+class TestClamdVirusScanning(unittest.TestCase):
+
+    def setUp(self):
+        self.clamd = FakeClamd().start()
+        self.old_config = dict(app.config)
+        app.config.update({
+            'VIRUS_CHECK': True,
+            'VIRUS_SCANNER': 'clamd',
+            'CLAMD_ADDRESS': self.clamd.address,
+        })
+
+    def tearDown(self):
+        clamd_scanner().clear()
+        app.config.clear()
+        app.config.update(self.old_config)
+        self.clamd.stop()
+        if os.path.isfile(TEST_FILE_PATH):
+            os.remove(TEST_FILE_PATH)
+
+    def test_clean_file(self):
+        uploaded_file = UploadedFile(create_file_storage('a,b\n1,2'))
+
+        eq_(uploaded_file.validate(), [])
+
+    def test_virus(self):
+        uploaded_file = UploadedFile(create_file_storage(EICAR))
+
+        eq_(uploaded_file.validate(), ['File may contain a virus'])
+
+    def test_connections_are_reused_between_uploads(self):
+        for _ in range(3):
+            UploadedFile(create_file_storage('a,b\n1,2')).validate()
+
+        eq_(self.clamd.server.connections, 1)
+
+    def test_clamd_not_running(self):
+        app.config['CLAMD_ADDRESS'] = 'unix:/no/such/clamd.ctl'
+        uploaded_file = UploadedFile(create_file_storage('a,b\n1,2'))
+
+        problems = uploaded_file.validate()
+
+        eq_(len(problems), 1)
+        eq_(problems[0].startswith('Error running the virus scanner'), True)
+
+    def test_upload_scanned_as_it_arrived_is_not_scanned_again(self):
+        spool = UploadSpool(1000, scan=clamd_scanner().start_scan())
+        spool.write('a,b\n')
+        spool.write(EICAR)
+        uploaded_file = UploadedFile(FileStorage(stream=spool,
+                                                 filename='file.csv'))
+
+        eq_(uploaded_file.is_virus(), True)
+        eq_(self.clamd.server.scans,
+            ['stream: Eicar-Test-Signature FOUND'])
+
+    def test_upload_is_scanned_again_if_scanning_as_it_arrived_failed(self):
+        spool = UploadSpool(1000, scan=clamd_scanner().start_scan())
+        spool.write('a,b\n')
+        spool.scan.connection.socket.close()
+        spool.write(EICAR)
+        uploaded_file = UploadedFile(FileStorage(stream=spool,
+                                                 filename='file.csv'))
+
+        eq_(uploaded_file.is_virus(), True)
+
+    @patch('application.files.uploaded.Popen')
+    def test_clamdscan_can_still_be_chosen(self, mock_Popen):
+        app.config['VIRUS_SCANNER'] = 'clamdscan'
+        mock_Popen.return_value = FakeProcess(1)
+        uploaded_file = UploadedFile(create_file_storage('a,b\n1,2'))
+
+        eq_(uploaded_file.validate(), ['File may contain a virus'])
+        eq_(self.clamd.server.connections, 0)
@@ -0,0 +1,94 @@
+"""A stand in for backdrop's write API, which records what it is sent
+
+It accepts chunked and gzipped request bodies as backdrop does, and keeps
+the decoded JSON of every request it could read in full.
+"""
+import BaseHTTPServer
+import json
+import SocketServer
+import threading
+import time
+import zlib
+
+
+class FakeBackdropHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        try:
+            body = self.read_body()
+        except ValueError:
+            # The client gave up part way through the request
+            self.server.incomplete += 1
+            return
+
+        self.server.requests.append({
+            'path': self.path,
+            'headers': dict(self.headers),
+            'body_size': len(body),
+            'payload': json.loads(self.decode(body)),
+        })
+
+        time.sleep(self.server.delay)
+        status, reply = self.server.reply
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(json.dumps(reply))
+
+    def read_body(self):
+        if self.headers.get('Transfer-Encoding') != 'chunked':
+            return self.rfile.read(int(self.headers['Content-Length']))
+
+        chunks = []
+        while True:
+            size_line = self.rfile.readline()
+            if not size_line.strip():
+                raise ValueError('Request ended before its last chunk')
+            size = int(size_line.split(';')[0], 16)
+            chunk = self.rfile.read(size)
+            if len(chunk) < size:
+                raise ValueError('Request ended part way through a chunk')
+            self.rfile.readline()
+            if size == 0:
+                return ''.join(chunks)
+            chunks.append(chunk)
+
+    def decode(self, body):
+        if self.headers.get('Content-Encoding') == 'gzip':
+            return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        return body
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeBackdrop(object):
+    """Runs a fake backdrop in a thread until stopped
+
+    On its server, `requests` holds what each complete request sent,
+    `incomplete` counts requests which stopped part way, `reply` is the
+    status and JSON every request is answered with and `delay` is how many
+    seconds it waits before answering.
+    """
+
+    def __init__(self):
+        self.server = SocketServer.ThreadingTCPServer(
+            ('127.0.0.1', 0), FakeBackdropHandler)
+        self.server.daemon_threads = True
+        self.server.requests = []
+        self.server.incomplete = 0
+        self.server.reply = (200, {'status': 'ok'})
+        self.server.delay = 0
+        self.url = 'http://127.0.0.1:{0}'.format(
+            self.server.server_address[1])
+
+    def start(self):
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  kwargs={'poll_interval': 0.01})
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,134 @@
+"""A stand in for clamd which understands enough of its protocol for tests
+
+It answers IDSESSION, INSTREAM, PING and END on a unix socket or on a
+local TCP port, and reports a virus in any stream containing the EICAR test
+string.
+"""
+import os
+import shutil
+import SocketServer
+import struct
+import tempfile
+import threading
+
+EICAR = ('X5O!P%@AP[4\\PZX54(P^)7CC)7}$EICAR-STANDARD-ANTIVIRUS-TEST-FILE!'
+         '$H+H*')
+
+
+class FakeClamdHandler(SocketServer.BaseRequestHandler):
+
+    def handle(self):
+        self.server.connections += 1
+        self.buffer = ''
+        request_id = 0
+        in_session = False
+
+        while True:
+            command = self.read_command()
+            if command is None or command == 'END':
+                return
+            if command == 'IDSESSION':
+                in_session = True
+                continue
+
+            request_id += 1
+            if command == 'PING':
+                reply = 'PONG'
+            elif command == 'INSTREAM':
+                reply = self.scan_stream()
+                if reply is None:
+                    return
+            else:
+                reply = 'UNKNOWN COMMAND'
+            self.server.scans.append(reply)
+
+            close = not in_session or self.server.close_after_reply
+            if in_session:
+                reply = '{0}: {1}'.format(request_id, reply)
+            self.request.sendall(reply + '\0')
+
+            if close:
+                return
+
+    def read(self, size):
+        while len(self.buffer) < size:
+            data = self.request.recv(4096)
+            if not data:
+                return None
+            self.buffer += data
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def read_command(self):
+        while '\0' not in self.buffer:
+            data = self.request.recv(4096)
+            if not data:
+                return None
+            self.buffer += data
+        command, self.buffer = self.buffer.split('\0', 1)
+        return command[1:]
+
+    def scan_stream(self):
+        content = ''
+        while True:
+            size = self.read(4)
+            if size is None:
+                return None
+            length = struct.unpack('!L', size)[0]
+            if length == 0:
+                break
+            chunk = self.read(length)
+            if chunk is None:
+                return None
+            content += chunk
+
+        if self.server.reply is not None:
+            return self.server.reply
+        if EICAR in content:
+            return 'stream: Eicar-Test-Signature FOUND'
+        return 'stream: OK'
+
+
+class FakeClamd(object):
+    """Runs a fake clamd in a thread until stopped
+
+    On its server, `connections` counts the connections made to it, `scans`
+    holds its replies, `reply` replaces the answer to every scan and
+    `close_after_reply` makes it drop the connection after answering, as
+    clamd does once a session has been idle too long.
+    """
+
+    def __init__(self, tcp=False):
+        if tcp:
+            server_class = SocketServer.ThreadingTCPServer
+            location = ('127.0.0.1', 0)
+        else:
+            server_class = SocketServer.ThreadingUnixStreamServer
+            self.directory = tempfile.mkdtemp()
+            location = os.path.join(self.directory, 'clamd.ctl')
+
+        self.server = server_class(location, FakeClamdHandler)
+        self.server.daemon_threads = True
+        self.server.connections = 0
+        self.server.scans = []
+        self.server.reply = None
+        self.server.close_after_reply = False
+
+        if tcp:
+            self.address = 'tcp:127.0.0.1:{0}'.format(
+                self.server.server_address[1])
+        else:
+            self.address = 'unix:{0}'.format(location)
+
+    def start(self):
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  kwargs={'poll_interval': 0.01})
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if hasattr(self, 'directory'):
+            shutil.rmtree(self.directory)
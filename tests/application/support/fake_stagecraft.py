@@ -0,0 +1,64 @@
+"""A stand in for stagecraft's API, which keeps connections alive
+
+Every GET is answered with the same JSON, and the headers of each request
+are kept.
+"""
+import BaseHTTPServer
+import json
+import SocketServer
+import threading
+import time
+
+
+class FakeStagecraftHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.requests.append({
+            'path': self.path,
+            'headers': dict(self.headers),
+        })
+        time.sleep(self.server.delay)
+
+        body = json.dumps(self.server.reply)
+        self.send_response(self.server.status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Set-Cookie', 'visitor=1; Path=/')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeStagecraft(object):
+    """Runs a fake stagecraft in a thread until stopped
+
+    On its server, `requests` holds the path and headers of each request,
+    `reply` is the JSON every request is answered with, `status` is the
+    status it is answered with and `delay` is how many seconds it waits
+    before answering.
+    """
+
+    def __init__(self):
+        self.server = SocketServer.ThreadingTCPServer(
+            ('127.0.0.1', 0), FakeStagecraftHandler)
+        self.server.daemon_threads = True
+        self.server.requests = []
+        self.server.reply = []
+        self.server.status = 200
+        self.server.delay = 0
+        self.url = 'http://127.0.0.1:{0}'.format(
+            self.server.server_address[1])
+
+    def start(self):
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  kwargs={'poll_interval': 0.01})
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -81,6 +81,21 @@ class DashboardTestCase(TestCase):
         except Exception:
             self.fail('convert_to_dashboard_form raised Exception')
 
+    def test_organisation_choices_already_fetched_are_used(self):
+        dashboard_dict = json.loads(self.dashboard_json)
+        choices = [('org-uuid', 'Cabinet Office')]
+
+        dashboard_form = convert_to_dashboard_form(dashboard_dict,
+                                                   self.mock_admin_client,
+                                                   self.mock_module_types,
+                                                   self.mock_data_sources,
+                                                   choices)
+
+        assert_that(dashboard_form.owning_organisation.choices,
+                    equal_to(choices))
+        assert_that(self.mock_admin_client.list_organisations.called,
+                    equal_to(False))
+
 
 class DataSourcesTestCase(TestCase):
 
@@ -1,3 +1,4 @@
+import time
 import unittest
 from application import app
 from application.helpers import(
@@ -10,8 +11,9 @@ from application.helpers import(
     has_user_with_token,
     view_helpers,
     user_has_feature,
+    prefetch,
 )
-from hamcrest import assert_that, equal_to, is_
+from hamcrest import assert_that, equal_to, is_, less_than
 from mock import patch
 
 
@@ -238,3 +240,20 @@ class HelpersTestCase(unittest.TestCase):
     def test_user_with_permissions_not_in_list_features(self):
         user = {'permissions': ['signin']}
         assert_that(user_has_feature('big-edit', user), equal_to(False))
+
+    def test_prefetched_calls_run_at_the_same_time(self):
+        def slowly(value):
+            time.sleep(0.2)
+            return value
+
+        started = time.time()
+        results = prefetch((slowly, 'a'), (slowly, 'b'), (slowly, 'c'))
+
+        assert_that([result.get() for result in results],
+                    equal_to(['a', 'b', 'c']))
+        assert_that(time.time() - started, less_than(0.5))
+
+    def test_prefetched_call_raises_when_its_result_is_got(self):
+        results = prefetch((int, 'one'))
+
+        self.assertRaises(ValueError, results[0].get)
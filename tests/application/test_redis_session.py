@@ -0,0 +1,298 @@
+from datetime import datetime
+import pickle
+import time
+import unittest
+
+from flask import Response, request
+from hamcrest import (
+    assert_that, contains_string, equal_to, greater_than, less_than,
+    less_than_or_equal_to, none)
+from mock import patch
+import pytz
+
+from application import app
+from application.redis_session import (
+    CompactSerializer, RedisSessionInterface, session_serializer)
+
+SESSION = {
+    'oauth_user': {'name': u'Bob', 'permissions': ['signin', 'admin']},
+    'oauth_token': {'access_token': 'abc', 'expires_at': 1400000000.5},
+    '_flashes': [('info', u'Uploaded')],
+    'signed_in_at': datetime(2014, 5, 1, 12, 30, 5, 250),
+    'raw': '\xff\x00',
+    'count': 3,
+    '_permanent': True,
+}
+
+
+class CompactSerializerTestCase(unittest.TestCase):
+
+    def test_sessions_load_as_they_were_stored(self):
+        serializer = CompactSerializer('json')
+
+        assert_that(serializer.loads(serializer.dumps(SESSION)),
+                    equal_to(SESSION))
+
+    def test_datetimes_keep_their_timezone(self):
+        serializer = CompactSerializer('json')
+        session = {
+            'utc': datetime(2014, 5, 1, 12, 30, tzinfo=pytz.UTC),
+            'bst': datetime(2014, 5, 1, 13, 30, 5, 250,
+                            tzinfo=pytz.FixedOffset(60)),
+            'west': datetime(2014, 5, 1, 7, 0, tzinfo=pytz.FixedOffset(-330)),
+        }
+
+        loaded = serializer.loads(serializer.dumps(session))
+
+        assert_that(loaded, equal_to(session))
+        assert_that(dict((key, value.utcoffset())
+                         for key, value in loaded.iteritems()),
+                    equal_to(dict((key, value.utcoffset())
+                                  for key, value in session.iteritems())))
+
+    def test_large_sessions_are_compressed(self):
+        serializer = CompactSerializer('json', compress_over=1024)
+        session = dict(SESSION, pending_dashboard={
+            'modules': [{'slug': 'module-{0}'.format(n), 'info': ['x']}
+                        for n in range(100)]})
+
+        stored = serializer.dumps(session)
+
+        assert_that(stored[:1], equal_to(CompactSerializer.JSON_ZLIB))
+        assert_that(len(stored), less_than(len(pickle.dumps(session)) / 4))
+        assert_that(serializer.loads(stored), equal_to(session))
+
+    def test_small_sessions_are_not_compressed(self):
+        serializer = CompactSerializer('json', compress_over=1024)
+
+        assert_that(serializer.dumps({'a': 1})[:1],
+                    equal_to(CompactSerializer.JSON))
+
+    def test_pickled_sessions_are_still_read(self):
+        serializer = CompactSerializer('json')
+
+        assert_that(serializer.loads(pickle.dumps(SESSION)),
+                    equal_to(SESSION))
+        assert_that(serializer.loads(pickle.dumps(SESSION, 2)),
+                    equal_to(SESSION))
+
+    def test_msgpack_sessions_load_as_they_were_stored(self):
+        serializer = CompactSerializer('msgpack', compress_over=100)
+        stored = serializer.dumps(SESSION)
+
+        assert_that(serializer.loads(stored), equal_to(SESSION))
+        assert_that(CompactSerializer('json').loads(stored),
+                    equal_to(SESSION))
+
+    def test_unknown_formats_are_refused(self):
+        self.assertRaises(ValueError, CompactSerializer, 'yaml')
+
+    def test_pickle_can_still_be_chosen(self):
+        assert_that(session_serializer({'SESSION_SERIALIZER': 'pickle'}),
+                    equal_to(pickle))
+
+
+class RedisSessionInterfaceTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = app.redis_instance
+        self.interface = RedisSessionInterface(
+            redis=self.redis, prefix='test:',
+            serializer=CompactSerializer('json', compress_over=1024))
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+        self.old_interface = app.session_interface
+        app.session_interface = self.interface
+
+    def tearDown(self):
+        app.session_interface = self.old_interface
+        for key in self.redis.keys('test:session:*'):
+            self.redis.delete(key)
+
+    def test_pickled_session_is_stored_compactly_when_next_saved(self):
+        self.redis.set('test:session:abc', pickle.dumps({'user': 'Bob'}))
+        self.client.set_cookie('localhost', app.session_cookie_name, 'abc')
+
+        with self.client.session_transaction() as session:
+            assert_that(session['user'], equal_to('Bob'))
+            session['seen'] = True
+
+        stored = self.redis.get('test:session:abc')
+        assert_that(stored[:1], equal_to(CompactSerializer.JSON))
+        assert_that(self.interface.serializer.loads(stored),
+                    equal_to({'user': 'Bob', 'seen': True}))
+
+    def open_and_save(self, stored, ttl, change=None):
+        self.redis.setex('test:session:abc', stored, ttl)
+        with app.test_request_context(headers={
+                'Cookie': '{0}=abc'.format(app.session_cookie_name)}):
+            session = self.interface.open_session(app, request)
+            session.get('user')
+            if change is not None:
+                change(session)
+            response = Response()
+            self.interface.save_session(app, session, response)
+        return response
+
+    def test_unchanged_session_is_not_stored_again(self):
+        stored = pickle.dumps({'user': 'Bob'})
+
+        response = self.open_and_save(stored, 7190)
+
+        assert_that(self.redis.get('test:session:abc'), equal_to(stored))
+        assert_that(self.redis.ttl('test:session:abc'),
+                    less_than_or_equal_to(7190))
+        assert_that(response.headers.get('Set-Cookie'), none())
+
+    def test_unchanged_session_has_its_expiry_moved_once_due(self):
+        stored = pickle.dumps({'user': 'Bob'})
+
+        response = self.open_and_save(stored, 7000)
+
+        assert_that(self.redis.get('test:session:abc'), equal_to(stored))
+        assert_that(self.redis.ttl('test:session:abc'), greater_than(7100))
+        assert_that(response.headers.get('Set-Cookie'), none())
+
+    def test_permanent_session_cookie_is_set_when_its_expiry_moves(self):
+        stored = pickle.dumps({'user': 'Bob', '_permanent': True})
+
+        response = self.open_and_save(stored, 7000)
+
+        assert_that(self.redis.get('test:session:abc'), equal_to(stored))
+        assert_that(response.headers['Set-Cookie'],
+                    contains_string('Expires='))
+
+    def test_changed_session_is_stored(self):
+        def change(session):
+            session['seen'] = True
+
+        response = self.open_and_save(pickle.dumps({'user': 'Bob'}), 7190,
+                                      change)
+
+        assert_that(
+            self.interface.serializer.loads(
+                self.redis.get('test:session:abc')),
+            equal_to({'user': 'Bob', 'seen': True}))
+        assert_that(response.headers['Set-Cookie'],
+                    contains_string('session=abc'))
+
+    def test_session_is_only_read_once_it_is_used(self):
+        self.redis.setex('test:session:abc', pickle.dumps({'user': 'Bob'}),
+                         7000)
+        with app.test_request_context(headers={
+                'Cookie': '{0}=abc'.format(app.session_cookie_name)}):
+            with patch.object(self.redis, 'pipeline') as pipeline:
+                session = self.interface.open_session(app, request)
+                self.interface.save_session(app, session, Response())
+
+            assert_that(pipeline.called, equal_to(False))
+            assert_that(session['user'], equal_to('Bob'))
+            assert_that(session.sid, equal_to('abc'))
+
+    def test_skipped_routes_never_read_the_session(self):
+        self.redis.set('test:session:abc', pickle.dumps({'user': 'Bob'}))
+        self.client.set_cookie('localhost', app.session_cookie_name, 'abc')
+
+        with patch.object(self.interface, 'load_session') as load_session:
+            response = self.client.get('/static/css/does-not-exist.css')
+
+        assert_that(load_session.called, equal_to(False))
+        assert_that(response.headers.get('Set-Cookie'), none())
+
+    def test_skipped_sessions_cannot_be_changed(self):
+        with app.test_request_context('/_status'):
+            session = self.interface.open_session(app, request)
+
+        assert_that(session.get('user'), none())
+        self.assertRaisesRegexp(RuntimeError, 'SESSION_SKIP_ENDPOINTS',
+                                session.__setitem__, 'user', 'Bob')
+
+    def test_session_which_expired_while_open_is_stored_again(self):
+        def expire(session):
+            self.redis.delete('test:session:abc')
+
+        self.open_and_save(pickle.dumps({'user': 'Bob'}), 7000, expire)
+
+        assert_that(
+            self.interface.serializer.loads(
+                self.redis.get('test:session:abc')),
+            equal_to({'user': 'Bob'}))
+
+
+class UserSessionsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = app.redis_instance
+        self.interface = RedisSessionInterface(redis=self.redis,
+                                               prefix='test:')
+
+    def tearDown(self):
+        for key in self.redis.keys('test:session:*'):
+            self.redis.delete(key)
+
+    def save(self, sid, user=None, permanent=False):
+        session = self.interface.session_class(
+            redis=self.redis, sid=sid, new=True,
+            prefix=self.interface.prefix)
+        session['oauth_user'] = user or {'uid': 'user-uid'}
+        session.permanent = permanent
+        with app.test_request_context():
+            self.interface.save_session(app, session, Response())
+        return session
+
+    def test_signed_in_sessions_are_kept_until_they_expire(self):
+        session = self.save('abc')
+
+        key = session.user_sessions_key('user-uid')
+        assert_that(self.redis.zrange(key, 0, -1), equal_to(['abc']))
+        assert_that(self.redis.zscore(key, 'abc'),
+                    greater_than(time.time() + 7100))
+        assert_that(self.redis.ttl(key), greater_than(7100))
+
+    def test_sessions_are_only_kept_once(self):
+        self.save('abc')
+        session = self.save('abc')
+
+        assert_that(
+            self.redis.zcard(session.user_sessions_key('user-uid')),
+            equal_to(1))
+
+    def test_expired_sessions_are_removed(self):
+        session = self.save('abc')
+        key = session.user_sessions_key('user-uid')
+        self.redis.zadd(key, old=time.time() - 1)
+
+        self.save('def')
+
+        assert_that(sorted(self.redis.zrange(key, 0, -1)),
+                    equal_to(['abc', 'def']))
+
+    def test_a_shorter_session_does_not_cut_short_the_set(self):
+        session = self.save('abc', permanent=True)
+        self.save('def')
+
+        key = session.user_sessions_key('user-uid')
+        assert_that(self.redis.ttl(key), greater_than(7 * 24 * 60 * 60))
+        assert_that(sorted(self.redis.zrange(key, 0, -1)),
+                    equal_to(['abc', 'def']))
+
+    def test_all_of_a_users_sessions_are_deleted(self):
+        sids = ['sid-{0}'.format(n) for n in range(300)]
+        for sid in sids:
+            session = self.save(sid)
+        other = self.save('other', {'uid': 'other-uid'})
+        # Once redis has loaded the script, it is run by its hash alone
+        session.delete_sessions_for_user('nobody')
+
+        with patch.object(self.redis, 'execute_command',
+                          wraps=self.redis.execute_command) as commands:
+            session.delete_sessions_for_user('user-uid')
+
+        assert_that(commands.call_count, equal_to(1))
+        assert_that(self.redis.keys('test:session:sid-*'), equal_to([]))
+        assert_that(self.redis.exists(session.user_sessions_key('user-uid')),
+                    equal_to(False))
+        assert_that(self.redis.exists('test:session:other'), equal_to(True))
+        assert_that(
+            self.redis.zrange(other.user_sessions_key('other-uid'), 0, -1),
+            equal_to(['other']))
@@ -0,0 +1,110 @@
+import json
+import time
+import unittest
+
+from hamcrest import assert_that, equal_to
+from mock import Mock
+
+from application import app
+from application.reference_cache import ReferenceCache
+
+
+class ReferenceCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = app.redis_instance
+        self.cache = ReferenceCache(self.redis, {'module-types': 60},
+                                    stale_for=600)
+
+    def tearDown(self):
+        for key in self.redis.keys(ReferenceCache.PREFIX + '*'):
+            self.redis.delete(key)
+
+    def make_stale(self, scope=''):
+        key = self.cache.key('module-types', scope)
+        entry = json.loads(self.redis.get(key))
+        entry['fetched_at'] -= 100
+        self.redis.set(key, json.dumps(entry))
+
+    def wait_for_refresh(self, scope=''):
+        key = self.cache.key('module-types', scope) + ':refreshing'
+        for _ in range(100):
+            if not self.redis.exists(key):
+                return
+            time.sleep(0.01)
+
+    def test_resource_is_loaded_once_while_it_is_fresh(self):
+        load = Mock(return_value=[{'name': 'kpi'}])
+
+        for _ in range(3):
+            assert_that(self.cache.fetch('module-types', load),
+                        equal_to([{'name': 'kpi'}]))
+
+        assert_that(load.call_count, equal_to(1))
+        assert_that(self.redis.ttl(self.cache.key('module-types')),
+                    equal_to(660))
+
+    def test_scopes_are_cached_separately(self):
+        self.cache.fetch('module-types', lambda: ['first'], 'a')
+
+        assert_that(self.cache.fetch('module-types', lambda: ['second'], 'b'),
+                    equal_to(['second']))
+
+    def test_stale_resource_is_returned_while_it_is_refreshed(self):
+        self.cache.fetch('module-types', lambda: ['old'])
+        self.make_stale()
+
+        assert_that(self.cache.fetch('module-types', lambda: ['new']),
+                    equal_to(['old']))
+        self.wait_for_refresh()
+        assert_that(self.cache.fetch('module-types', lambda: ['newer']),
+                    equal_to(['new']))
+
+    def test_stale_resource_is_refreshed_by_one_process(self):
+        self.cache.fetch('module-types', lambda: ['old'])
+        self.make_stale()
+        self.redis.set(self.cache.key('module-types') + ':refreshing', 1)
+        load = Mock(return_value=['new'])
+
+        assert_that(self.cache.fetch('module-types', load),
+                    equal_to(['old']))
+        assert_that(load.called, equal_to(False))
+
+    def test_failed_refresh_leaves_the_stale_resource(self):
+        self.cache.fetch('module-types', lambda: ['old'])
+        self.make_stale()
+
+        self.cache.fetch('module-types', Mock(side_effect=ValueError))
+        self.wait_for_refresh()
+
+        assert_that(self.cache.fetch('module-types', lambda: ['new']),
+                    equal_to(['old']))
+
+    def test_invalidated_resource_is_loaded_again_in_every_scope(self):
+        self.cache.fetch('module-types', lambda: ['old'], 'a')
+        self.cache.fetch('module-types', lambda: ['old'], 'b')
+
+        self.cache.invalidate('module-types')
+
+        assert_that(self.cache.fetch('module-types', lambda: ['new'], 'a'),
+                    equal_to(['new']))
+        assert_that(self.cache.fetch('module-types', lambda: ['new'], 'b'),
+                    equal_to(['new']))
+
+    def test_stale_scoped_resource_is_loaded_again_at_once(self):
+        self.cache.fetch('module-types', lambda: ['old'], 'token')
+        self.make_stale('token')
+
+        assert_that(self.cache.fetch('module-types', lambda: ['new'], 'token'),
+                    equal_to(['new']))
+
+    def test_forgotten_scope_is_loaded_again(self):
+        self.cache.fetch('module-types', lambda: ['old'], 'a')
+        self.cache.fetch('module-types', lambda: ['old'], 'b')
+
+        self.cache.forget('module-types', 'a')
+
+        assert_that(self.cache.fetch('module-types', lambda: ['new'], 'a'),
+                    equal_to(['new']))
+        assert_that(self.cache.fetch('module-types', lambda: ['new'], 'b'),
+                    equal_to(['old']))
@@ -0,0 +1,170 @@
+import unittest
+
+from hamcrest import (
+    assert_that, equal_to, has_entries, is_, is_not, has_key)
+from mock import patch
+from performanceplatform.client import base as client_base
+from performanceplatform.client.admin import AdminAPI
+import requests
+from requests import HTTPError, Timeout
+
+from application import app
+from application.reference_cache import ReferenceCache
+from application.stagecraft import PooledAdminAPI, StagecraftPool
+from tests.application.support.fake_stagecraft import FakeStagecraft
+
+
+class PooledAdminAPITestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.stagecraft = FakeStagecraft().start()
+        self.pool = StagecraftPool()
+        self.old_config = dict(app.config)
+
+    def tearDown(self):
+        app.config.clear()
+        app.config.update(self.old_config)
+        if self.pool.session is not None:
+            self.pool.session.close()
+        self.stagecraft.stop()
+
+    def client(self, token):
+        return PooledAdminAPI(self.stagecraft.url, token, pool=self.pool)
+
+    def test_connections_are_reused_by_every_user(self):
+        for token in ['first-token', 'second-token', 'first-token']:
+            assert_that(self.client(token).list_data_sets(), equal_to([]))
+
+        assert_that(self.pool.stats(), equal_to(
+            {'requests': 3, 'connections': 1, 'reused': 2}))
+
+    def test_each_request_sends_its_own_token(self):
+        self.client('first-token').list_data_sets()
+        self.client(None).list_data_sets()
+
+        first, second = self.stagecraft.server.requests
+        assert_that(first['path'], equal_to('/data-sets'))
+        assert_that(first['headers'], has_entries(
+            {'authorization': 'Bearer first-token'}))
+        assert_that(second['headers'], is_not(has_key('authorization')))
+
+    def test_cookies_are_not_kept(self):
+        self.client('token').list_data_sets()
+        self.client('token').list_data_sets()
+
+        assert_that(self.stagecraft.server.requests[1]['headers'],
+                    is_not(has_key('cookie')))
+
+    def test_connections_can_be_closed_after_each_request(self):
+        app.config['STAGECRAFT_KEEP_ALIVE'] = False
+
+        for _ in range(3):
+            self.client('token').list_data_sets()
+
+        assert_that(self.pool.stats(), equal_to(
+            {'requests': 3, 'connections': 3, 'reused': 0}))
+
+    def test_slow_replies_time_out(self):
+        app.config['STAGECRAFT_READ_TIMEOUT'] = 0.05
+        self.stagecraft.server.delay = 0.5
+
+        self.assertRaises(Timeout, self.client('token').list_data_sets)
+
+    def test_errors_are_raised_as_the_client_raises_them(self):
+        self.stagecraft.server.status = 403
+
+        self.assertRaises(HTTPError, self.client('token').list_data_sets)
+
+    def test_other_clients_do_not_use_the_pool(self):
+        AdminAPI(self.stagecraft.url, 'token').list_data_sets()
+
+        assert_that(self.pool.stats()['requests'], equal_to(0))
+        assert_that(len(self.stagecraft.server.requests), equal_to(1))
+
+    def test_the_clients_own_module_is_left_as_it_is(self):
+        self.client('token').list_data_sets()
+
+        assert_that(client_base.requests, is_(requests))
+
+    def test_stats_are_logged_every_so_many_requests(self):
+        app.config['STAGECRAFT_STATS_LOG_INTERVAL'] = 2
+
+        with patch.object(app.logger, 'info') as info:
+            for _ in range(5):
+                self.client('token').list_data_sets()
+
+        assert_that([c[0][0] for c in info.call_args_list], equal_to([
+            'Stagecraft connections: 2 requests, 1 connections opened, '
+            '1 reused',
+            'Stagecraft connections: 4 requests, 1 connections opened, '
+            '3 reused',
+        ]))
+
+
+class CachedReferenceDataTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.stagecraft = FakeStagecraft().start()
+        self.stagecraft.server.reply = [
+            {'data_group': 'group', 'data_type': 'type'}]
+        self.pool = StagecraftPool()
+        app.config['STAGECRAFT_CACHE'] = True
+
+    def tearDown(self):
+        app.config['STAGECRAFT_CACHE'] = False
+        for key in app.redis_instance.keys(ReferenceCache.PREFIX + '*'):
+            app.redis_instance.delete(key)
+        if self.pool.session is not None:
+            self.pool.session.close()
+        self.stagecraft.stop()
+
+    def client(self, token):
+        return PooledAdminAPI(self.stagecraft.url, token, pool=self.pool)
+
+    def test_reference_data_is_fetched_once(self):
+        for _ in range(3):
+            self.client('token').list_module_types()
+            self.client('token').list_organisations({'type': ['agency']})
+
+        assert_that([r['path'] for r in self.stagecraft.server.requests],
+                    equal_to(['/module-type',
+                              '/organisation/node?type=agency']))
+
+    def test_data_sets_are_cached_for_each_token(self):
+        for token in ['first-token', 'second-token', 'first-token']:
+            assert_that(self.client(token).list_data_sets(), equal_to(
+                [{'data_group': 'group', 'data_type': 'type'}]))
+
+        assert_that(
+            [r['headers']['authorization']
+             for r in self.stagecraft.server.requests],
+            equal_to(['Bearer first-token', 'Bearer second-token']))
+
+    @patch.object(AdminAPI, 'create_data_group')
+    @patch.object(AdminAPI, 'create_data_set')
+    def test_creating_data_sets_or_groups_forgets_the_data_sets(
+            self, create_data_set_patch, create_data_group_patch):
+        self.client('token').list_data_sets()
+
+        self.client('token').create_data_set({'name': 'group_type'})
+        self.client('token').list_data_sets()
+        self.client('token').create_data_group({'name': 'group'})
+        self.client('token').list_data_sets()
+
+        assert_that(len(self.stagecraft.server.requests), equal_to(3))
+
+    def test_a_refused_token_forgets_its_data_sets(self):
+        self.client('token').list_data_sets()
+        self.stagecraft.server.status = 401
+
+        self.assertRaises(HTTPError, self.client('token').get_data_set,
+                          'group', 'type')
+        self.assertRaises(HTTPError, self.client('token').list_data_sets)
+
+    def test_nothing_is_cached_when_it_is_off(self):
+        app.config['STAGECRAFT_CACHE'] = False
+
+        self.client('token').list_module_types()
+        self.client('token').list_module_types()
+
+        assert_that(len(self.stagecraft.server.requests), equal_to(2))
@@ -0,0 +1,71 @@
+import time
+import unittest
+
+from hamcrest import assert_that, equal_to, none
+
+from application import app
+from application.token_cache import CachedToken, TokenCache
+
+USER = {'user': {'uid': 'abc', 'permissions': ['user_update_permission']}}
+
+
+class TokenCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = app.redis_instance
+        self.cache = TokenCache(self.redis, ttl=60, invalid_ttl=10,
+                                max_size=2)
+
+    def tearDown(self):
+        for key in self.redis.keys(TokenCache.PREFIX + '*'):
+            self.redis.delete(key)
+
+    def test_unknown_tokens_are_not_found(self):
+        assert_that(self.cache.find('token'), none())
+
+    def test_users_are_found_by_their_token(self):
+        self.cache.store('token', USER)
+
+        assert_that(self.cache.find('token'),
+                    equal_to(CachedToken(USER, None, None)))
+        assert_that(self.cache.find('other-token'), none())
+
+    def test_rejected_tokens_are_remembered_for_less_time(self):
+        self.cache.store_rejected('token', 401, 'Unauthorized')
+
+        assert_that(self.cache.find('token'),
+                    equal_to(CachedToken(None, 401, 'Unauthorized')))
+        assert_that(self.redis.ttl(self.cache.key('token')),
+                    equal_to(10))
+
+    def test_tokens_are_shared_through_redis(self):
+        self.cache.store('token', USER)
+        other_process = TokenCache(self.redis, ttl=60, invalid_ttl=10,
+                                   max_size=2)
+
+        assert_that(other_process.find('token').user, equal_to(USER))
+
+    def test_tokens_are_only_stored_as_a_hash(self):
+        self.cache.store('secret-token', USER)
+
+        assert_that(self.redis.keys('*secret-token*'), equal_to([]))
+
+    def test_least_recently_used_tokens_are_forgotten_first(self):
+        for token in ['first', 'second']:
+            self.cache.store(token, USER)
+        self.cache.find('first')
+
+        self.cache.store('third', USER)
+
+        assert_that(sorted(self.cache.entries),
+                    equal_to(sorted(self.cache.key(token)
+                                    for token in ['first', 'third'])))
+
+    def test_expired_tokens_are_not_found(self):
+        self.cache.store('token', USER)
+        self.redis.delete(self.cache.key('token'))
+        key = self.cache.key('token')
+        self.cache.entries[key] = (time.time() - 1,
+                                   self.cache.entries[key][1])
+
+        assert_that(self.cache.find('token'), none())
@@ -0,0 +1,230 @@
+"""Synthetic spreadsheets for tools/benchmark_parsers.py
+
+Each shape describes the columns of a sheet and how to fill in a row, in
+the same style as the hand made files in tests/fixtures. Every shape can
+be written as csv, xlsx (built directly as zipped XML) or xls (using
+xlwt, which is in requirements_for_tests.txt).
+"""
+from xml.sax.saxutils import escape
+import csv
+import datetime
+import os
+import shutil
+import tempfile
+import zipfile
+
+# The most rows an xls sheet can hold
+XLS_MAX_ROWS = 65536
+
+ERROR = object()
+
+CHANNELS = ['digital', 'paper-form', 'telephone-human', 'face-to-face']
+
+START = datetime.datetime(2014, 1, 6)
+
+
+def _timestamp(i):
+    return (START + datetime.timedelta(weeks=i % 520)).isoformat() + 'Z'
+
+
+def _narrow_row(i):
+    return [_timestamp(i), i * 7 % 1000]
+
+
+def _wide_row(i):
+    return [_timestamp(i), CHANNELS[i % 4]] + [
+        (i * column) % 1000 if column % 2 else (i * column % 1000) / 8.0
+        for column in range(48)]
+
+
+def _comment_row(i):
+    return [_timestamp(i), CHANNELS[i % 4], i * 7 % 1000,
+            'checked by the service team' if i % 3 == 0 else '']
+
+
+def _blank_rows_row(i):
+    if i % 10 == 9:
+        return None
+    return [_timestamp(i), CHANNELS[i % 4], i * 7 % 1000, i / 4.0]
+
+
+def _error_cells_row(i):
+    return [_timestamp(i), CHANNELS[i % 4], i * 7 % 1000,
+            ERROR if i % 10 == 9 else i / 4.0]
+
+
+SHAPES = {
+    'narrow': (['_timestamp', 'count'], _narrow_row),
+    'wide': (['_timestamp', 'channel'] +
+             ['metric_{0}'.format(column) for column in range(48)],
+             _wide_row),
+    'comment': (['_timestamp', 'channel', 'count', 'comment'],
+                _comment_row),
+    'blank-rows': (['_timestamp', 'channel', 'count', 'rate'],
+                   _blank_rows_row),
+    'error-cells': (['_timestamp', 'channel', 'count', 'rate'],
+                    _error_cells_row),
+}
+
+FORMATS = ['csv', 'xlsx', 'xls']
+
+
+def rows_for(shape, row_count):
+    """Return the header and an iterator of rows for a shape
+
+    Blank rows are None and error cells are ERROR.
+    """
+    header, make_row = SHAPES[shape]
+    return header, (make_row(i) for i in xrange(row_count))
+
+
+def write_fixture(directory, file_format, shape, row_count):
+    """Write a synthetic spreadsheet and return its path"""
+    if file_format == 'xls' and row_count >= XLS_MAX_ROWS:
+        raise ValueError(
+            'xls sheets hold at most {0} rows'.format(XLS_MAX_ROWS))
+
+    path = os.path.join(directory, '{0}-{1}.{2}'.format(
+        shape, row_count, file_format))
+    header, rows = rows_for(shape, row_count)
+    WRITERS[file_format](path, header, rows)
+    return path
+
+
+def write_csv(path, header, rows):
+    with open(path, 'wb') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(header)
+        for row in rows:
+            if row is None:
+                writer.writerow([''] * len(header))
+            else:
+                writer.writerow(
+                    ['#DIV/0!' if value is ERROR else value
+                     for value in row])
+
+
+def write_xls(path, header, rows):
+    import xlwt
+
+    book = xlwt.Workbook()
+    sheet = book.add_sheet('Sheet1')
+    for colx, value in enumerate(header):
+        sheet.write(0, colx, value)
+
+    for rowx, row in enumerate(rows, start=1):
+        if row is None:
+            continue
+        for colx, value in enumerate(row):
+            if value is ERROR:
+                sheet.row(rowx).set_cell_error(colx, '#DIV/0!')
+            else:
+                sheet.write(rowx, colx, value)
+        if rowx % 1000 == 0:
+            sheet.flush_row_data()
+
+    book.save(path)
+
+
+XLSX_PARTS = {
+    '[Content_Types].xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/'
+        'content-types">'
+        '<Default Extension="rels" ContentType="application/'
+        'vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" ContentType="application/'
+        'vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" ContentType='
+        '"application/vnd.openxmlformats-officedocument.spreadsheetml.'
+        'worksheet+xml"/>'
+        '</Types>'),
+    '_rels/.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/'
+        '2006/relationships">'
+        '<Relationship Target="xl/workbook.xml" Type="http://schemas.'
+        'openxmlformats.org/officeDocument/2006/relationships/'
+        'officeDocument" Id="rId1"/>'
+        '</Relationships>'),
+    'xl/workbook.xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/'
+        '2006/main" xmlns:r="http://schemas.openxmlformats.org/'
+        'officeDocument/2006/relationships">'
+        '<sheets><sheet sheetId="1" name="Sheet1" r:id="rId1"/></sheets>'
+        '</workbook>'),
+    'xl/_rels/workbook.xml.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/'
+        '2006/relationships">'
+        '<Relationship Target="worksheets/sheet1.xml" Type="http://schemas.'
+        'openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+        'Id="rId1"/>'
+        '</Relationships>'),
+}
+
+
+def _column_name(colx):
+    name = ''
+    colx += 1
+    while colx:
+        colx, remainder = divmod(colx - 1, 26)
+        name = chr(ord('A') + remainder) + name
+    return name
+
+
+def _xlsx_cell(name, value):
+    if value is ERROR:
+        return '<c r="{0}" t="e"><v>#DIV/0!</v></c>'.format(name)
+    if isinstance(value, basestring):
+        return '<c r="{0}" t="inlineStr"><is><t>{1}</t></is></c>'.format(
+            name, escape(value))
+    return '<c r="{0}"><v>{1!r}</v></c>'.format(name, value)
+
+
+def write_xlsx(path, header, rows):
+    columns = [_column_name(colx) for colx in range(len(header))]
+    sheet_file = tempfile.NamedTemporaryFile(suffix='.xml', delete=False)
+
+    try:
+        with sheet_file:
+            sheet_file.write(
+                '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                '<worksheet xmlns="http://schemas.openxmlformats.org/'
+                'spreadsheetml/2006/main"><sheetData>')
+            for rowx, row in enumerate([header], start=1):
+                sheet_file.write(_xlsx_row(columns, rowx, row))
+            for rowx, row in enumerate(rows, start=2):
+                if row is not None:
+                    sheet_file.write(_xlsx_row(columns, rowx, row))
+            sheet_file.write('</sheetData></worksheet>')
+
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as xlsx:
+            for name, content in sorted(XLSX_PARTS.items()):
+                xlsx.writestr(name, content)
+            xlsx.write(sheet_file.name, 'xl/worksheets/sheet1.xml')
+    finally:
+        os.remove(sheet_file.name)
+
+
+def _xlsx_row(columns, rowx, row):
+    return '<row r="{0}">{1}</row>'.format(rowx, ''.join(
+        _xlsx_cell('{0}{1}'.format(column, rowx), value)
+        for column, value in zip(columns, row)))
+
+
+WRITERS = {
+    'csv': write_csv,
+    'xlsx': write_xlsx,
+    'xls': write_xls,
+}
+
+
+def make_fixture_directory():
+    return tempfile.mkdtemp(prefix='benchmark-fixtures-')
+
+
+def remove_fixture_directory(directory):
+    shutil.rmtree(directory, ignore_errors=True)
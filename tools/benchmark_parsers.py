@@ -0,0 +1,284 @@
+"""Benchmark the spreadsheet parsers as files get bigger
+
+Generates csv, xlsx and xls files of each shape in tools/benchmark_fixtures.py
+and times each parser stage over them, one case per python process so that
+peak memory is measured for that case alone:
+
+    python tools/benchmark_parsers.py run --output before.json
+    python tools/benchmark_parsers.py run --output after.json
+    python tools/benchmark_parsers.py compare before.json after.json
+
+The stages are:
+
+    parse          parse_csv or iter_workbook_rows, reading the file
+    remove_blanks  remove_blanks over rows which are already parsed
+    make_dicts     make_dicts over rows which are already parsed
+    pipeline       reading the file through to records, as an upload is
+
+Each result records the time taken, rows per second, the peak resident set
+size of the process and how much it grew while the stage ran, and
+peak_containers_per_row, the most objects the garbage collector tracks,
+such as lists, dicts and tuples, alive at once during the stage divided by
+the number of rows. It is not a count of every allocation, as strings and
+numbers are not tracked, but a stage which streams keeps it close to zero
+while one which holds every row keeps it at one or more. Nothing needs the
+network; the app is configured with a REDIS_URL if none is set but the
+parsers never connect to it.
+"""
+from os import path
+import datetime
+import gc
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from argh import arg, dispatch_commands
+
+project_root = path.dirname(path.dirname(path.realpath(__file__)))
+sys.path.insert(0, project_root)
+
+import benchmark_fixtures
+
+SIZES = [1000, 10000, 100000, 1000000]
+STAGES = ['parse', 'remove_blanks', 'make_dicts', 'pipeline']
+
+# Cases with more cells than this are skipped unless asked for, as a million
+# row wide sheet takes a long time to write and read
+MAX_CELLS = 10000000
+
+
+def _split(value, convert=str):
+    return [convert(item) for item in value.split(',') if item]
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=project_root).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _peak_rss_kb():
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _read_rows(input_path, file_format):
+    from application.files.parsers.dsv import parse_csv
+    from application.files.parsers.excel import (
+        iter_workbook_rows, open_excel)
+
+    with open(input_path, 'rb') as stream:
+        if file_format == 'csv':
+            for row in parse_csv(stream):
+                yield row
+        else:
+            for row in iter_workbook_rows(open_excel(stream)):
+                yield row
+
+
+def _stage(input_path, file_format, stage):
+    """Return a function which starts the stage and returns its rows"""
+    from application.files.parsers.util import (
+        make_dicts, record_pipeline, remove_blanks)
+
+    if stage == 'parse':
+        return lambda: _read_rows(input_path, file_format)
+
+    if stage == 'pipeline':
+        return lambda: record_pipeline().run(
+            _read_rows(input_path, file_format))
+
+    rows = list(_read_rows(input_path, file_format))
+    if stage == 'remove_blanks':
+        return lambda: remove_blanks(rows)
+    if stage == 'make_dicts':
+        return lambda: make_dicts(rows)
+
+    raise ValueError('Unknown stage {0}'.format(stage))
+
+
+def _count(rows):
+    count = 0
+    for _ in rows:
+        count += 1
+    return count
+
+
+def _peak_containers(rows):
+    """Return the most container objects alive at once while consuming rows
+
+    With the collector switched off the first generation count goes up for
+    every container allocated and down for every one freed.
+    """
+    gc.collect()
+    gc.disable()
+    try:
+        peak = 0
+        for _ in rows:
+            live = gc.get_count()[0]
+            if live > peak:
+                peak = live
+        return peak
+    finally:
+        gc.enable()
+
+
+@arg('file_format', choices=benchmark_fixtures.FORMATS)
+@arg('stage', choices=STAGES)
+def measure(input_path, file_format, stage, result_path):
+    """Measure one stage over one file, writing the result as JSON"""
+    run_stage = _stage(input_path, file_format, stage)
+
+    gc.collect()
+    rss_before = _peak_rss_kb()
+    started = time.time()
+    rows = _count(run_stage())
+    seconds = time.time() - started
+    rss_after = _peak_rss_kb()
+
+    containers = _peak_containers(run_stage())
+
+    result = {
+        'rows': rows,
+        'seconds': seconds,
+        'rows_per_second': rows / seconds if seconds else None,
+        'peak_rss_kb': rss_after,
+        'rss_growth_kb': rss_after - rss_before,
+        'peak_containers_per_row': (float(containers) / rows
+                                    if rows else None),
+    }
+    with open(result_path, 'w') as result_file:
+        json.dump(result, result_file)
+
+
+def _measure_in_subprocess(input_path, file_format, stage):
+    environment = dict(os.environ)
+    environment.setdefault('REDIS_URL', 'redis://localhost:6379/0')
+
+    result_file = tempfile.NamedTemporaryFile(suffix='.json', delete=False)
+    result_file.close()
+    try:
+        process = subprocess.Popen(
+            [sys.executable, path.realpath(__file__), 'measure',
+             input_path, file_format, stage, result_file.name],
+            env=environment, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output, _ = process.communicate()
+        if process.returncode != 0:
+            raise RuntimeError('Measuring {0} over {1} failed:\n{2}'.format(
+                stage, input_path, output))
+        with open(result_file.name) as measured:
+            return json.load(measured)
+    finally:
+        os.remove(result_file.name)
+
+
+@arg('--sizes', help='comma separated row counts')
+@arg('--shapes', help='comma separated, from: {0}'.format(
+    ', '.join(sorted(benchmark_fixtures.SHAPES))))
+@arg('--formats', help='comma separated, from: {0}'.format(
+    ', '.join(benchmark_fixtures.FORMATS)))
+@arg('--stages', help='comma separated, from: {0}'.format(', '.join(STAGES)))
+@arg('--max-cells', help='skip files with more cells than this')
+@arg('--output', help='where to write the results, as JSON')
+def run(sizes=','.join(str(size) for size in SIZES),
+        shapes=','.join(sorted(benchmark_fixtures.SHAPES)),
+        formats=','.join(benchmark_fixtures.FORMATS),
+        stages=','.join(STAGES),
+        max_cells=MAX_CELLS,
+        output='parser-benchmark.json'):
+    """Generate spreadsheets and measure every stage over each of them"""
+    results = []
+    directory = benchmark_fixtures.make_fixture_directory()
+
+    try:
+        for shape in _split(shapes):
+            columns = len(benchmark_fixtures.SHAPES[shape][0])
+            for size in _split(sizes, int):
+                for file_format in _split(formats):
+                    case = {'shape': shape, 'rows_written': size,
+                            'format': file_format}
+
+                    if size * columns > int(max_cells):
+                        skipped = 'more than {0} cells'.format(max_cells)
+                    elif (file_format == 'xls' and
+                          size >= benchmark_fixtures.XLS_MAX_ROWS):
+                        skipped = 'xls sheets hold at most {0} rows'.format(
+                            benchmark_fixtures.XLS_MAX_ROWS)
+                    else:
+                        skipped = None
+
+                    if skipped:
+                        for stage in _split(stages):
+                            results.append(dict(case, stage=stage,
+                                                skipped=skipped))
+                        yield '{0} {1} {2}: skipped, {3}'.format(
+                            shape, size, file_format, skipped)
+                        continue
+
+                    input_path = benchmark_fixtures.write_fixture(
+                        directory, file_format, shape, size)
+                    case['file_size'] = path.getsize(input_path)
+                    try:
+                        for stage in _split(stages):
+                            result = dict(case, stage=stage)
+                            result.update(_measure_in_subprocess(
+                                input_path, file_format, stage))
+                            results.append(result)
+                            yield '{0} {1} {2} {3}: {4:.0f} rows/s'.format(
+                                shape, size, file_format, stage,
+                                result['rows_per_second'] or 0)
+                    finally:
+                        os.remove(input_path)
+    finally:
+        benchmark_fixtures.remove_fixture_directory(directory)
+
+    with open(output, 'w') as output_file:
+        json.dump({
+            'commit': _git_commit(),
+            'created': datetime.datetime.utcnow().isoformat() + 'Z',
+            'python': platform.python_version(),
+            'results': results,
+        }, output_file, indent=2, sort_keys=True)
+    yield 'Results written to {0}'.format(output)
+
+
+def _case_key(result):
+    return (result['shape'], result['rows_written'], result['format'],
+            result['stage'])
+
+
+def compare(before, after):
+    """Show the change in throughput and memory between two result files"""
+    with open(before) as before_file:
+        before = json.load(before_file)
+    with open(after) as after_file:
+        after = json.load(after_file)
+
+    yield '{0} -> {1}'.format(before['commit'], after['commit'])
+
+    earlier = dict((_case_key(result), result)
+                   for result in before['results']
+                   if 'skipped' not in result)
+    for result in after['results']:
+        previous = earlier.get(_case_key(result))
+        if previous is None or 'skipped' in result:
+            continue
+        yield '{0:<12} {1:>8} {2:<4} {3:<13} {4:>6.2f}x rows/s  ' \
+              'rss {5:+d}kb  containers/row {6:.2f} -> {7:.2f}'.format(
+                  result['shape'], result['rows_written'], result['format'],
+                  result['stage'],
+                  result['rows_per_second'] / previous['rows_per_second'],
+                  result['peak_rss_kb'] - previous['peak_rss_kb'],
+                  previous['peak_containers_per_row'],
+                  result['peak_containers_per_row'])
+
+
+if __name__ == '__main__':
+    dispatch_commands([run, measure, compare])
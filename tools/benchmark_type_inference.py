@@ -0,0 +1,82 @@
+"""Time parse_csv's cell conversion with and without column type inference
+
+Generates a 100,000 row CSV in memory with a timestamp, text, integer,
+float and mostly empty comment-like column, then converts it by calling
+parse_as_number on every cell and by parse_cells_as_numbers, checking that
+both give the same rows. Run it from the project root with the
+environment the app needs to start:
+
+    export REDIS_URL=redis://localhost:6379/12
+    python tools/benchmark_type_inference.py
+"""
+from cStringIO import StringIO
+from os import path
+import datetime
+import random
+import sys
+import time
+
+project_root = path.dirname(path.dirname(path.realpath(__file__)))
+sys.path.insert(0, project_root)
+
+from application.files.parsers.dsv import (
+    ignore_comment_lines, ignore_empty_rows, lines, parse_as_number,
+    parse_cells_as_numbers, unicode_csv_reader)
+
+ROWS = 100000
+CHANNELS = ['digital', 'paper-form', 'telephone-human', 'face-to-face']
+
+
+def generate_csv(row_count):
+    random.seed(0)
+    start = datetime.datetime(2014, 1, 6)
+    csv = StringIO()
+    csv.write('_timestamp,channel,count,rate,notes\n')
+    for i in xrange(row_count):
+        csv.write('{0}Z,{1},{2},{3:.2f},{4}\n'.format(
+            (start + datetime.timedelta(weeks=i % 52)).isoformat(),
+            random.choice(CHANNELS),
+            random.randint(0, 100000),
+            random.random() * 100,
+            'late return' if i % 10 == 0 else ''))
+    csv.seek(0)
+    return csv
+
+
+def read_rows(csv):
+    csv.seek(0)
+    return list(ignore_empty_rows(unicode_csv_reader(
+        ignore_comment_lines(lines(csv)), 'utf-8')))
+
+
+def per_cell(rows):
+    return [[parse_as_number(cell) for cell in row] for row in rows]
+
+
+def per_column(rows):
+    return list(parse_cells_as_numbers(rows))
+
+
+def best_of(runs, convert, rows):
+    timings = []
+    for _ in range(runs):
+        started = time.time()
+        result = convert(rows)
+        timings.append(time.time() - started)
+    return min(timings), result
+
+
+if __name__ == '__main__':
+    rows = read_rows(generate_csv(ROWS))
+
+    per_cell_time, expected = best_of(3, per_cell, rows)
+    per_column_time, actual = best_of(3, per_column, rows)
+
+    if repr(actual) != repr(expected):
+        sys.exit('Column type inference changed the parsed values')
+
+    print('rows:                   {0}'.format(ROWS))
+    print('parse_as_number:        {0:.3f}s'.format(per_cell_time))
+    print('parse_cells_as_numbers: {0:.3f}s'.format(per_column_time))
+    print('speed up:               {0:.1f}x'.format(
+        per_cell_time / per_column_time))